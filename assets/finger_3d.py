@@ -1,14 +1,58 @@
 import os
-import os
+import functools
 import numpy as np 
-from geomdl import BSpline
-from geomdl import utilities
-from geomdl import exchange
 import trimesh
-import time
 import xml.etree.ElementTree as ET
 
-TMP_DIR = './tmp'
+from assets.mesh_io import MESH_FORMAT, mesh_path, save_mesh
+
+# control grid of a finger surface, 7 points along x by 3 along z
+CTRLPTS_SIZE_U = 7
+CTRLPTS_SIZE_V = 3
+
+def knot_vector(degree, num_ctrlpts):
+    """Clamped uniform knot vector, as geomdl's utilities.generate_knot_vector."""
+    return np.concatenate([np.zeros(degree), np.linspace(0.0, 1.0, num_ctrlpts - degree + 1), np.ones(degree)])
+
+@functools.lru_cache(maxsize=None)
+def basis_matrix(degree, num_ctrlpts, sample_size):
+    """(sample_size, num_ctrlpts) B-spline basis functions at `sample_size` evenly spaced parameters in [0, 1]."""
+    knots = knot_vector(degree, num_ctrlpts)
+    params = np.linspace(0.0, 1.0, sample_size)[:, None]
+    # degree 0 (Cox-de Boor), the parameter 1 belongs to the last non-empty span
+    basis = ((knots[:-1] <= params) & (params < knots[1:])).astype(np.float64)
+    basis[-1, :] = 0.0
+    basis[-1, num_ctrlpts - 1] = 1.0
+    for p in range(1, degree + 1):
+        left = knots[:-p - 1], knots[p:-1]
+        right = knots[1:-p], knots[p + 1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w_left = np.where(left[1] > left[0], (params - left[0]) / (left[1] - left[0]), 0.0)
+            w_right = np.where(right[1] > right[0], (right[1] - params) / (right[1] - right[0]), 0.0)
+        basis = w_left * basis[:, :-1] + w_right * basis[:, 1:]
+    return basis
+
+@functools.lru_cache(maxsize=None)
+def surface_matrix(degree_u, degree_v, sample_size):
+    """(sample_size**2, 21) map from the control points to the surface points, in geomdl's evalpts order."""
+    return np.kron(basis_matrix(degree_u, CTRLPTS_SIZE_U, sample_size), basis_matrix(degree_v, CTRLPTS_SIZE_V, sample_size))
+
+@functools.lru_cache(maxsize=None)
+def surface_faces(sample_size):
+    """Triangles of the sampled surface grid, as geomdl's tessellation exported to obj."""
+    grid = np.arange(sample_size**2).reshape(sample_size, sample_size)
+    a, b, c, d = grid[:-1, :-1], grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:]
+    faces = np.stack([np.stack([a, b, c], axis=-1), np.stack([a, c, d], axis=-1)], axis=2)
+    faces = faces.reshape(-1, 3)
+    faces.flags.writeable = False
+    return faces
+
+def evaluate_surfaces(control_points, degree_u=3, degree_v=2, sample_size=100):
+    """
+    Evaluates the B-spline surfaces of a batch of (..., 21, 3) control points (7x3 grid, clamped uniform knots),
+    returns their (..., sample_size**2, 3) surface points in geomdl's evalpts order.
+    """
+    return surface_matrix(degree_u, degree_v, sample_size) @ np.asarray(control_points, dtype=np.float64)
 
 def generate_3d_finger_shape(control_points, degree_u=3, degree_v=2, sample_size=100):
     """Generate 3D finger shape from 3D control points.
@@ -19,29 +63,14 @@ def generate_3d_finger_shape(control_points, degree_u=3, degree_v=2, sample_size
         degree_v (int, optional): Degree of the Bezier surface in v-direction. Defaults to 2.
         sample_size (int, optional): Number of samples. Defaults to 100.
     """
-    surf = BSpline.Surface()
-    surf.degree_u = degree_u
-    surf.degree_v = degree_v
-    surf.set_ctrlpts(control_points, 7, 3)
-    surf.knotvector_u = utilities.generate_knot_vector(surf.degree_u, surf.ctrlpts_size_u)
-    surf.knotvector_v = utilities.generate_knot_vector(surf.degree_v, surf.ctrlpts_size_v)
-    surf.sample_size = sample_size
-    surf.evaluate()
-    os.makedirs(TMP_DIR, exist_ok=True)
-    tmp_file = os.path.join(TMP_DIR, '%f.obj' % time.time())
-    exchange.export_obj(surf, tmp_file)
-    mesh = trimesh.load(tmp_file)
-    vertices = mesh.vertices
-    faces = mesh.faces
-    return vertices, faces
-
-def generate_3d_finger_mesh(control_points, degree_u=3, degree_v=2, sample_size=25, width=0.12):
-    surf_vertices, surf_faces = generate_3d_finger_shape(control_points, degree_u, degree_v, sample_size)
-    num_surf_vertices = surf_vertices.shape[0]
-    all_vertices = np.concatenate([
-        surf_vertices,
-        surf_vertices + [0, width, 0]
-    ])
+    vertices = evaluate_surfaces(control_points, degree_u, degree_v, sample_size)
+    return vertices, surface_faces(sample_size).copy()
+
+@functools.lru_cache(maxsize=None)
+def finger_faces(sample_size):
+    """Triangles of a finger mesh: the surface, its copy offset by the width and the sides between them."""
+    num_surf_vertices = sample_size**2
+    surf_faces = surface_faces(sample_size)
     surf_contour_indices = np.concatenate([np.arange(sample_size-1), np.arange(sample_size-1, sample_size**2-sample_size, sample_size), np.arange(sample_size**2-1, sample_size**2-sample_size, -1), np.arange(sample_size**2-sample_size, 0, -sample_size)])
     side_faces_upper = np.stack([surf_contour_indices, np.roll(surf_contour_indices, -1), np.roll(surf_contour_indices, -1)+num_surf_vertices], axis=-1)
     side_faces_lower = np.stack([surf_contour_indices, np.roll(surf_contour_indices, -1)+num_surf_vertices, surf_contour_indices+num_surf_vertices], axis=-1)
@@ -53,31 +82,33 @@ def generate_3d_finger_mesh(control_points, degree_u=3, degree_v=2, sample_size=
         side_faces_upper,
         side_faces_lower,
     ])
-    mesh = trimesh.Trimesh(vertices=all_vertices, faces=all_faces)
-    return mesh, surf_vertices
+    all_faces.flags.writeable = False
+    return all_faces
+
+def finger_mesh(surf_vertices, sample_size=25, width=0.12):
+    all_vertices = np.concatenate([
+        surf_vertices,
+        surf_vertices + [0, width, 0]
+    ])
+    return trimesh.Trimesh(vertices=all_vertices, faces=finger_faces(sample_size).copy())
+
+def generate_3d_finger_mesh(control_points, degree_u=3, degree_v=2, sample_size=25, width=0.12):
+    surf_vertices = evaluate_surfaces(control_points, degree_u, degree_v, sample_size)
+    return finger_mesh(surf_vertices, sample_size, width), surf_vertices
 
 def generate_3d_finger_vertices(control_points, degree_u=3, degree_v=2, sample_size=25):
-    surf = BSpline.Surface()
-    surf.degree_u = degree_u
-    surf.degree_v = degree_v
-    surf.set_ctrlpts(control_points, 7, 3)
-    surf.knotvector_u = utilities.generate_knot_vector(surf.degree_u, surf.ctrlpts_size_u)
-    surf.knotvector_v = utilities.generate_knot_vector(surf.degree_v, surf.ctrlpts_size_v)
-    surf.sample_size = sample_size
-    return np.array(surf.evalpts).reshape(-1, 3)
-
-def save_3d_gripper(yl, yr, width=0.12, sample_size=25, save_gripper_dir=''):
-    x = np.linspace(-0.12, 0.12, 7)
-    z = np.linspace(0, 0.12, 3)
-    x_n, z_n = np.meshgrid(x, z)
-    ctrlpts_l = np.stack([x_n.T.reshape(-1), yl, z_n.T.reshape(-1)], axis=-1)
-    ctrlpts_r = np.stack([x_n.T.reshape(-1), yr, z_n.T.reshape(-1)], axis=-1)
-    mesh_l, vertices_l = generate_3d_finger_mesh(ctrlpts_l.tolist(), width=width, sample_size=sample_size)
-    mesh_r, vertices_r = generate_3d_finger_mesh(ctrlpts_r.tolist(), width=width, sample_size=sample_size)
+    return evaluate_surfaces(control_points, degree_u, degree_v, sample_size)
+
+def save_3d_gripper(yl, yr, width=0.12, sample_size=25, save_gripper_dir='', mesh_format=MESH_FORMAT):
+    ctrlpts = generate_3d_ctrlpts(yl, yr)
+    # both fingers in one evaluation
+    vertices_l, vertices_r = evaluate_surfaces(ctrlpts.reshape(2, -1, 3), sample_size=sample_size)
+    mesh_l = finger_mesh(vertices_l, sample_size=sample_size, width=width)
+    mesh_r = finger_mesh(vertices_r, sample_size=sample_size, width=width)
     os.makedirs(save_gripper_dir, exist_ok=True)
-    mesh_l.export(os.path.join(save_gripper_dir, 'fingerl.obj'))
-    mesh_r.export(os.path.join(save_gripper_dir, 'fingerr.obj'))
-    return np.concatenate((ctrlpts_l, ctrlpts_r), axis=0), np.concatenate((vertices_l, vertices_r), axis=0)
+    save_mesh(mesh_l, mesh_path(os.path.join(save_gripper_dir, 'fingerl'), mesh_format))
+    save_mesh(mesh_r, mesh_path(os.path.join(save_gripper_dir, 'fingerr'), mesh_format))
+    return ctrlpts, np.concatenate((vertices_l, vertices_r), axis=0)
 
 def generate_3d_ctrlpts(yl, yr):
     x = np.linspace(-0.12, 0.12, 7)
@@ -88,18 +119,18 @@ def generate_3d_ctrlpts(yl, yr):
     return np.concatenate((ctrlpts_l, ctrlpts_r), axis=0)
 
 def generate_3d_gripper(yl, yr, sample_size=25):
-    x = np.linspace(-0.12, 0.12, 7)
-    z = np.linspace(0, 0.12, 3)
-    x_n, z_n = np.meshgrid(x, z)
-    ctrlpts_l = np.stack([x_n.T.reshape(-1), yl, z_n.T.reshape(-1)], axis=-1)
-    ctrlpts_r = np.stack([x_n.T.reshape(-1), yr, z_n.T.reshape(-1)], axis=-1)
-    vertices_l, _ = generate_3d_finger_shape(ctrlpts_l.tolist(), sample_size=sample_size)
-    vertices_r, _ = generate_3d_finger_shape(ctrlpts_r.tolist(), sample_size=sample_size)
-    return np.concatenate((ctrlpts_l, ctrlpts_r), axis=0), np.concatenate((vertices_l, vertices_r), axis=0)
+    ctrlpts = generate_3d_ctrlpts(yl, yr)
+    return ctrlpts, evaluate_surfaces(ctrlpts.reshape(2, -1, 3), sample_size=sample_size).reshape(-1, 3)
+
+def generate_3d_grippers(yl, yr, sample_size=25):
+    """generate_3d_gripper of a batch of designs, yl and yr (num_designs, 21), in one evaluation."""
+    ctrlpts = np.stack([generate_3d_ctrlpts(l, r) for l, r in zip(yl, yr)], axis=0)
+    allpts = evaluate_surfaces(ctrlpts.reshape(len(ctrlpts), 2, -1, 3), sample_size=sample_size)
+    return ctrlpts, allpts.reshape(len(ctrlpts), -1, 3)
 
-def create_mesh_elements(num_meshes, mesh_prefix, gripper_idx):
+def create_mesh_elements(num_meshes, mesh_prefix, gripper_idx, mesh_format=MESH_FORMAT):
    """ Create mesh elements for a given prefix and number of meshes. """
-   return [ET.Element("mesh", name=f"{mesh_prefix}{i:03d}", file=f"grippers/{gripper_idx}/{mesh_prefix}{i:03d}.obj") 
+   return [ET.Element("mesh", name=f"{mesh_prefix}{i:03d}", file=f"grippers/{gripper_idx}/{mesh_prefix}{i:03d}.{mesh_format}") 
          for i in range(num_meshes)]
 
 def create_geom_elements(num_meshes, mesh_prefix):
@@ -107,14 +138,14 @@ def create_geom_elements(num_meshes, mesh_prefix):
    return [ET.Element("geom", mesh=f"{mesh_prefix}{i:03d}", type="mesh", attrib={"class": "collision"})
          for i in range(num_meshes)]
 
-def generate_gripper_3d_xml(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path):
+def generate_gripper_3d_xml(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path, mesh_format=MESH_FORMAT):
    root = ET.Element("mujoco", model="gripper_3d")
    asset = ET.SubElement(root, "asset")
    # Creating mesh elements for left and right
-   left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx)
-   right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx)
-   asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.obj"), 
-               ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.obj")] + left_meshes + right_meshes)
+   left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx, mesh_format)
+   right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx, mesh_format)
+   asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.{mesh_format}"), 
+               ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.{mesh_format}")] + left_meshes + right_meshes)
 
    default = ET.SubElement(root, "default")
 
@@ -1,14 +1,40 @@
 import os
+import functools
 import numpy as np 
 from scipy.interpolate import CubicSpline
 import trimesh
 import xml.etree.ElementTree as ET
 
-def generate_finger_shape(x, y, width, height, num_points=100):
-   # Create spline (cubic curve, also degree=3 b-spline)
-   cs = CubicSpline(x, y)
+from assets.mesh_io import MESH_FORMAT, mesh_path, save_mesh
+
+@functools.lru_cache(maxsize=64)
+def _spline_matrix(x, num_points):
+   # the spline is linear in y for fixed knots x: its samples are the splines through the unit vectors, weighted by y
+   x = np.asarray(x)
    x_new = np.linspace(x.min(), x.max(), num_points)
-   y_new = cs(x_new)
+   matrix = CubicSpline(x, np.eye(len(x)))(x_new)
+   x_new.flags.writeable = False
+   matrix.flags.writeable = False
+   return x_new, matrix
+
+def spline_matrix(x, num_points):
+   """The `num_points` sample positions of a finger with knots `x` and the (num_points, len(x)) map from knot values to samples."""
+   return _spline_matrix(tuple(float(v) for v in x), num_points)
+
+@functools.lru_cache(maxsize=None)
+def finger_faces(num_points):
+   """Quads of a finger extruded from a curve of `num_points` samples."""
+   bottom = [[i+num_points, i+num_points+1, i+1, i] for i in range(num_points-1)]
+   top = [[i+2*num_points, i+3*num_points, i+3*num_points+1, i+2*num_points+1] for i in range(num_points-1)]
+   left = [[i, i+1, i+3*num_points+1, i+3*num_points] for i in range(num_points-1)]
+   right = [[i+2*num_points, i+2*num_points+1, i+num_points+1, i+num_points] for i in range(num_points-1)]
+   front = [[3*num_points, 2*num_points, num_points, 0]]
+   back = [[num_points-1, 2*num_points-1, 3*num_points-1, 4*num_points-1]]
+   faces = np.array(left + right + front + back + top + bottom)
+   faces.flags.writeable = False
+   return faces
+
+def finger_mesh(x_new, y_new, width, height):
    z = np.zeros_like(x_new)
    vertices_2d = np.stack([x_new, y_new, z], axis=-1)
 
@@ -19,53 +45,45 @@ def generate_finger_shape(x, y, width, height, num_points=100):
       vertices_2d + [0, width, height],
       vertices_2d + [0, 0, height]
    ])
+   return trimesh.Trimesh(vertices=vertices_3d, faces=finger_faces(len(x_new)).copy())
 
-   # Create faces
-   bottom = [[i+num_points, i+num_points+1, i+1, i] for i in range(num_points-1)]
-   top = [[i+2*num_points, i+3*num_points, i+3*num_points+1, i+2*num_points+1] for i in range(num_points-1)]
-   left = [[i, i+1, i+3*num_points+1, i+3*num_points] for i in range(num_points-1)]
-   right = [[i+2*num_points, i+2*num_points+1, i+num_points+1, i+num_points] for i in range(num_points-1)]
-   front = [[3*num_points, 2*num_points, num_points, 0]]
-   back = [[num_points-1, 2*num_points-1, 3*num_points-1, 4*num_points-1]]
-
-   faces_3d = left + right + front + back + top + bottom
-
-   # Create mesh
-   mesh = trimesh.Trimesh(vertices=vertices_3d, faces=faces_3d) 
-
-   return mesh, x_new, y_new
+def generate_finger_shape(x, y, width, height, num_points=100):
+   # Create spline (cubic curve, also degree=3 b-spline)
+   x_new, matrix = spline_matrix(x, num_points)
+   y_new = matrix @ y
+   mesh = finger_mesh(x_new, y_new, width, height)
+   return mesh, x_new.copy(), y_new
+
+def generate_grippers(finger_x, finger_yl, finger_yr, num_points):
+   """
+   generate_gripper of a batch of designs sharing the knots `finger_x`, finger_yl and finger_yr (num_designs, len(finger_x)).
+   Returns ctrlpts (num_designs, 2*len(finger_x), 2) and allpts (num_designs, 2*num_points, 2).
+   """
+   finger_yl, finger_yr = np.asarray(finger_yl), np.asarray(finger_yr)
+   x_new, matrix = spline_matrix(finger_x, num_points)
+   num_designs = len(finger_yl)
+   # (num_designs, 2, len(finger_x)) knot values of the left and right fingers to their samples, one matmul
+   y_new = np.stack([finger_yl, finger_yr], axis=1) @ matrix.T
+   ctrlpts = np.stack([np.broadcast_to(np.tile(finger_x, 2), (num_designs, 2 * len(finger_x))), np.concatenate([finger_yl, finger_yr], axis=1)], axis=-1)
+   allpts = np.stack([np.broadcast_to(np.tile(x_new, 2), (num_designs, 2 * num_points)), y_new.reshape(num_designs, -1)], axis=-1)
+   return ctrlpts, allpts
 
 def generate_gripper(finger_x, finger_yl, finger_yr, num_points):
-   cs_l = CubicSpline(finger_x, finger_yl)
-   x_new = np.linspace(finger_x.min(), finger_x.max(), num_points)
-   y_new_l = cs_l(x_new)
-   cs_r = CubicSpline(finger_x, finger_yr)
-   y_new_r = cs_r(x_new)
-   ctrlptsl = np.stack([finger_x, finger_yl], axis=-1)
-   ctrlptsr = np.stack([finger_x, finger_yr], axis=-1)
-   ctrlpts = np.concatenate((ctrlptsl, ctrlptsr), axis=0)
-   allptsl = np.stack([x_new, y_new_l], axis=-1)
-   allptsr = np.stack([x_new, y_new_r], axis=-1)
-   allpts = np.concatenate((allptsl, allptsr), axis=0)
-   return ctrlpts, allpts
+   ctrlpts, allpts = generate_grippers(finger_x, [finger_yl], [finger_yr], num_points)
+   return ctrlpts[0], allpts[0]
 
-def save_gripper(finger_x, finger_yl, finger_yr, width, height, num_points, save_gripper_dir):
+def save_gripper(finger_x, finger_yl, finger_yr, width, height, num_points, save_gripper_dir, mesh_format=MESH_FORMAT):
     os.makedirs(save_gripper_dir, exist_ok=True)
-    meshl, x_new_l, y_new_l = generate_finger_shape(finger_x, finger_yl, width, height, num_points)
-    meshl.export(os.path.join(save_gripper_dir, 'fingerl.obj'))
-    meshr, x_new_r, y_new_r = generate_finger_shape(finger_x, finger_yr, width, height, num_points) 
-    meshr.export(os.path.join(save_gripper_dir, 'fingerr.obj'))
-    ctrlptsl = np.stack([finger_x, finger_yl], axis=-1)
-    ctrlptsr = np.stack([finger_x, finger_yr], axis=-1)
-    ctrlpts = np.concatenate((ctrlptsl, ctrlptsr), axis=0)
-    allptsl = np.stack([x_new_l, y_new_l], axis=-1)
-    allptsr = np.stack([x_new_r, y_new_r], axis=-1)
-    allpts = np.concatenate((allptsl, allptsr), axis=0)
+    ctrlpts, allpts = generate_gripper(finger_x, finger_yl, finger_yr, num_points)
+    meshl = finger_mesh(allpts[:num_points, 0], allpts[:num_points, 1], width, height)
+    save_mesh(meshl, mesh_path(os.path.join(save_gripper_dir, 'fingerl'), mesh_format))
+    meshr = finger_mesh(allpts[num_points:, 0], allpts[num_points:, 1], width, height)
+    save_mesh(meshr, mesh_path(os.path.join(save_gripper_dir, 'fingerr'), mesh_format))
     return ctrlpts, allpts
 
-def create_mesh_elements(num_meshes, mesh_prefix, gripper_idx):
+def create_mesh_elements(num_meshes, mesh_prefix, gripper_idx, mesh_format=MESH_FORMAT):
    """ Create mesh elements for a given prefix and number of meshes. """
-   return [ET.Element("mesh", name=f"{mesh_prefix}{i:03d}", file=f"grippers/{gripper_idx}/{mesh_prefix}{i:03d}.obj") 
+   return [ET.Element("mesh", name=f"{mesh_prefix}{i:03d}", file=f"grippers/{gripper_idx}/{mesh_prefix}{i:03d}.{mesh_format}") 
          for i in range(num_meshes)]
 
 def create_geom_elements(num_meshes, mesh_prefix):
@@ -73,15 +91,15 @@ def create_geom_elements(num_meshes, mesh_prefix):
    return [ET.Element("geom", mesh=f"{mesh_prefix}{i:03d}", type="mesh", attrib={"class": "collision"})
          for i in range(num_meshes)]
 
-def generate_xml_optimized(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path):
+def generate_xml_optimized(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path, mesh_format=MESH_FORMAT):
     root = ET.Element("mujoco", model="gripper_2d")
     asset = ET.SubElement(root, "asset")
 
     # Creating mesh elements for left and right
-    left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx)
-    right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx)
-    asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.obj"), 
-                  ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.obj")] + left_meshes + right_meshes)
+    left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx, mesh_format)
+    right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx, mesh_format)
+    asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.{mesh_format}"), 
+                  ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.{mesh_format}")] + left_meshes + right_meshes)
 
     default = ET.SubElement(root, "default")
     ET.SubElement(default, "joint", type="slide", axis="0 1 0", damping="1")
@@ -108,14 +126,14 @@ def generate_xml_optimized(left_num_collision_meshes, right_num_collision_meshes
     tree = ET.ElementTree(root)
     tree.write(save_path)
     
-def generate_xml(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path):
+def generate_xml(left_num_collision_meshes, right_num_collision_meshes, gripper_idx, save_path, mesh_format=MESH_FORMAT):
    root = ET.Element("mujoco", model="gripper_2d")
    asset = ET.SubElement(root, "asset")
    # Creating mesh elements for left and right
-   left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx)
-   right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx)
-   asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.obj"), 
-               ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.obj")] + left_meshes + right_meshes)
+   left_meshes = create_mesh_elements(left_num_collision_meshes, "fingerl", gripper_idx, mesh_format)
+   right_meshes = create_mesh_elements(right_num_collision_meshes, "fingerr", gripper_idx, mesh_format)
+   asset.extend([ET.Element("mesh", name="fingerl", file=f"grippers/{gripper_idx}/fingerl.{mesh_format}"), 
+               ET.Element("mesh", name="fingerr", file=f"grippers/{gripper_idx}/fingerr.{mesh_format}")] + left_meshes + right_meshes)
 
    default = ET.SubElement(root, "default")
    ET.SubElement(default, "joint", type="slide", axis="0 1 0", damping="1")
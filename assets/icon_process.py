@@ -1,9 +1,12 @@
 import os
+import functools
 import cv2
 import numpy as np
 import trimesh
 import triangle
 
+from assets.mesh_io import MESH_FORMAT, mesh_path, save_mesh
+
 def resample_contour(contour, num_points):
     # Flatten the contour array
     contour = contour.reshape(-1, 2)
@@ -59,8 +62,33 @@ def draw_contour(image):
     cv2.drawContours(image_with_contour, [contour], -1, (0, 255, 0), 1)
     return contour, image_with_contour
 
-def generate_icon_mesh(img, height, num_points=100):
-    contour = extract_contours(img, num_points)
+@functools.lru_cache(maxsize=None)
+def icon_side_faces(num_points):
+    """Side triangles of an icon extruded from a contour of `num_points` points, the same for every icon."""
+    indices = np.arange(0, num_points)
+    side_faces_upper = np.stack([indices, np.roll(indices, -1) + num_points, np.roll(indices, -1)], axis=1)
+    side_faces_lower = np.stack([indices, indices + num_points, np.roll(indices, -1) + num_points], axis=1)
+    sides = np.concatenate([side_faces_upper, side_faces_lower])
+    sides.flags.writeable = False
+    return sides
+
+@functools.lru_cache(maxsize=4096)
+def _cap_faces(contour_bytes, num_points):
+    contour = np.frombuffer(contour_bytes, dtype=np.float64).reshape(num_points, 2).copy()
+    indices = np.arange(0, num_points)
+    # keep the boundary-edges of the triangulation
+    top_faces = triangle.triangulate({'vertices': contour, 'segments': np.stack([indices, np.roll(indices, -1)], axis=1)}, 'p')['triangles']
+    top_faces.flags.writeable = False
+    return top_faces
+
+def cap_faces(contour):
+    """Triangulation of the area inside `contour`, cached by the contour: icons of the library share their contours across runs and fidelities."""
+    contour = np.ascontiguousarray(contour, dtype=np.float64)
+    return _cap_faces(contour.tobytes(), len(contour))
+
+def generate_icon_mesh(img, height, num_points=100, contour=None):
+    # `contour` is extract_contours(img, num_points) when the caller looked it up already
+    contour = extract_contours(img, num_points) if contour is None else contour
     x = contour[..., 0]
     y = contour[..., 1]
     z = np.zeros_like(x)
@@ -71,29 +99,20 @@ def generate_icon_mesh(img, height, num_points=100):
         vertices_2d + [0, 0, height]
     ])
 
-    # Generate indices for side faces
-    indices = np.arange(0, num_points)
-    side_faces_upper = np.stack([indices, np.roll(indices, -1) + num_points, np.roll(indices, -1)], axis=1)
-    side_faces_lower = np.stack([indices, indices + num_points, np.roll(indices, -1) + num_points], axis=1)
-    sides = np.concatenate([side_faces_upper, side_faces_lower])
-
     # Triangulate top and bottom faces
-    # keep the boundary-edges of the triangulation
-    top_faces = triangle.triangulate({'vertices': contour, 'segments': np.stack([indices, np.roll(indices, -1)], axis=1)}, 'p')['triangles']
+    top_faces = cap_faces(contour).copy()
     bottom_faces = top_faces + num_points
     top_faces[:, [1, 2]] = top_faces[:, [2, 1]]
 
     # Combine faces
-    faces_3d = np.concatenate([sides, top_faces, bottom_faces])
+    faces_3d = np.concatenate([icon_side_faces(num_points), top_faces, bottom_faces])
 
     # Create mesh
     mesh = trimesh.Trimesh(vertices=vertices_3d, faces=faces_3d) 
 
     return mesh, contour
 
-def save_icon_mesh(img, height, num_points, save_dir):
+def save_icon_mesh(img, height, num_points, save_dir, mesh_format=MESH_FORMAT):
     os.makedirs(save_dir, exist_ok=True)
     mesh, contour = generate_icon_mesh(img, height, num_points)
-    mesh_path = os.path.join(save_dir, 'object.obj')
-    mesh.export(mesh_path)
-    return contour, mesh_path
\ No newline at end of file
+    return contour, save_mesh(mesh, mesh_path(os.path.join(save_dir, 'object'), mesh_format))
\ No newline at end of file
@@ -0,0 +1,106 @@
+import os
+import glob
+import numpy as np
+import trimesh
+
+# mesh files written for the simulation: text obj, binary stl, or MuJoCo's binary msh
+MESH_FORMATS = ['obj', 'stl', 'msh']
+MESH_FORMAT = 'obj'
+
+# one triangle of a binary stl: normal, 3 vertices, attribute byte count
+STL_RECORD = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+STL_HEADER = 80
+
+
+def mesh_path(stem, mesh_format=MESH_FORMAT):
+    return '%s.%s' % (stem, mesh_format)
+
+
+def mesh_format_of(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+
+def find_mesh(stem):
+    """Returns the path of the mesh saved as `stem` in any of MESH_FORMATS, None if there is none."""
+    for mesh_format in MESH_FORMATS:
+        if os.path.exists(mesh_path(stem, mesh_format)):
+            return mesh_path(stem, mesh_format)
+    return None
+
+
+def save_mesh(mesh, path):
+    """Writes a trimesh to `path`, in the format of its extension. Binary formats are written with one memcpy per array."""
+    mesh_format = mesh_format_of(path)
+    if mesh_format == 'obj':
+        mesh.export(path)
+    elif mesh_format == 'stl':
+        triangles = np.asarray(mesh.vertices)[np.asarray(mesh.faces)]
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+        records = np.zeros(len(triangles), dtype=STL_RECORD)
+        records['normal'] = normals
+        records['vertices'] = triangles
+        with open(path, 'wb') as f:
+            f.write(np.zeros(STL_HEADER, dtype=np.uint8).tobytes())
+            f.write(np.uint32(len(records)).tobytes())
+            f.write(records.tobytes())
+    elif mesh_format == 'msh':
+        # nvertex, nnormal, ntexcoord, nface, then the float32 vertices and int32 faces
+        vertices = np.ascontiguousarray(mesh.vertices, dtype=np.float32)
+        faces = np.ascontiguousarray(mesh.faces, dtype=np.int32)
+        with open(path, 'wb') as f:
+            f.write(np.array([len(vertices), 0, 0, len(faces)], dtype=np.int32).tobytes())
+            f.write(vertices.tobytes())
+            f.write(faces.tobytes())
+    else:
+        raise ValueError('mesh format %s not supported' % mesh_format)
+    return path
+
+
+def load_mesh(path):
+    """Reads a mesh written by `save_mesh` (or any obj) into a trimesh, vertices of stl triangles are merged."""
+    mesh_format = mesh_format_of(path)
+    if mesh_format == 'obj':
+        return trimesh.load(path)
+    if mesh_format == 'stl':
+        with open(path, 'rb') as f:
+            f.seek(STL_HEADER)
+            num_triangles = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+            records = np.frombuffer(f.read(num_triangles * STL_RECORD.itemsize), dtype=STL_RECORD)
+        vertices, faces = np.unique(records['vertices'].reshape(-1, 3), axis=0, return_inverse=True)
+        return trimesh.Trimesh(vertices=vertices.astype(np.float64), faces=faces.reshape(-1, 3), process=False)
+    if mesh_format == 'msh':
+        with open(path, 'rb') as f:
+            num_vertices, num_normals, num_texcoords, num_faces = np.frombuffer(f.read(16), dtype=np.int32)
+            vertices = np.frombuffer(f.read(12 * num_vertices), dtype=np.float32).reshape(-1, 3)
+            f.seek(12 * num_normals + 8 * num_texcoords, os.SEEK_CUR)
+            faces = np.frombuffer(f.read(12 * num_faces), dtype=np.int32).reshape(-1, 3)
+        return trimesh.Trimesh(vertices=vertices.astype(np.float64), faces=faces, process=False)
+    raise ValueError('mesh format %s not supported' % mesh_format)
+
+
+def hull_paths(stem, mesh_format=MESH_FORMAT):
+    """The convex hulls V-HACD decomposed the mesh `stem` into, `stem`000, `stem`001, ..."""
+    return sorted(glob.glob('%s[0-9][0-9][0-9].%s' % (stem, mesh_format)))
+
+
+def decomposition_input(path):
+    """V-HACD reads obj: returns the obj to decompose the mesh at `path` from, written next to it for binary meshes."""
+    if mesh_format_of(path) == 'obj':
+        return path
+    obj_path = mesh_path(os.path.splitext(path)[0], 'obj')
+    load_mesh(path).export(obj_path)
+    return obj_path
+
+
+def finish_decomposition(path):
+    """Converts the obj hulls V-HACD wrote for the mesh at `path` to its format and removes the obj input written for it."""
+    mesh_format = mesh_format_of(path)
+    if mesh_format == 'obj':
+        return
+    stem = os.path.splitext(path)[0]
+    for hull_path in hull_paths(stem, 'obj'):
+        save_mesh(trimesh.load(hull_path), mesh_path(os.path.splitext(hull_path)[0], mesh_format))
+        os.remove(hull_path)
+    if os.path.exists(mesh_path(stem, 'obj')):
+        os.remove(mesh_path(stem, 'obj'))
@@ -1,15 +1,17 @@
 import xml.etree.ElementTree as ET
 
-def generate_object_xml(num_collision, object_idx, save_path):
+from assets.mesh_io import MESH_FORMAT
+
+def generate_object_xml(num_collision, object_idx, save_path, mesh_format=MESH_FORMAT):
     # Create the root element
     root = ET.Element("mujoco", model="object")
 
     # Create the 'asset' element
     asset = ET.SubElement(root, "asset")
-    ET.SubElement(asset, "mesh", name="object", file="objects/%d/object.obj" % object_idx)
+    ET.SubElement(asset, "mesh", name="object", file="objects/%d/object.%s" % (object_idx, mesh_format))
 
     for i in range(num_collision):
-        ET.SubElement(asset, "mesh", name=f"object{i:03d}", file=f"objects/{object_idx}/object{i:03d}.obj")
+        ET.SubElement(asset, "mesh", name=f"object{i:03d}", file=f"objects/{object_idx}/object{i:03d}.{mesh_format}")
 
     # Create the 'worldbody' element
     worldbody = ET.SubElement(root, "worldbody")
@@ -1,21 +1,98 @@
 import os
+import glob
+import hashlib
+import multiprocessing
+import concurrent.futures
+import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import open3d as o3d
 import xml.etree.ElementTree as ET
 
-def get_bbox(data_dir):
-    max = []
-    min = []
-    for root, dirs, files in os.walk(data_dir):
-        for dir in tqdm(dirs):
-            mesh_file = os.path.join(root, dir, 'model.obj')
-            mesh = o3d.io.read_triangle_mesh(mesh_file)
-            bbox = mesh.get_axis_aligned_bounding_box()
-            max.append(bbox.get_max_bound().reshape(-1))
-            min.append(bbox.get_min_bound().reshape(-1))
-    max = np.stack(max, axis=0)
+# metadata of every scanned object, written once by build_object_index and queried by the filters
+OBJECT_INDEX = 'assets/object_index.npz'
+# points of the footprint contours, the convex hull of the vertices projected on the xy plane
+FOOTPRINT_POINTS = 64
+# objects that fit between the open fingers, see filter_object
+OBJECT_BOUNDS = {'min_bound': [-0.1, -0.1, -np.inf], 'max_bound': [0.1, 0.1, 0.12]}
+
+def resample_footprint(points, num_points=FOOTPRINT_POINTS):
+    # closed polygon resampled to `num_points` points evenly spaced along its perimeter
+    closed = np.concatenate([points, points[:1]], axis=0)
+    distances = np.concatenate([[0], np.cumsum(np.linalg.norm(np.diff(closed, axis=0), axis=1))])
+    uniform = np.linspace(0, distances[-1], num_points, endpoint=False)
+    return np.stack([np.interp(uniform, distances, closed[:, 0]), np.interp(uniform, distances, closed[:, 1])], axis=-1)
+
+def index_object(object_dir):
+    """Metadata of the scanned object in `object_dir`, one row of the object index."""
+    mesh_file = os.path.join(object_dir, 'model.obj')
+    with open(mesh_file, 'rb') as f:
+        content_hash = hashlib.sha1(f.read()).hexdigest()
+    mesh = o3d.io.read_triangle_mesh(mesh_file)
+    vertices = np.asarray(mesh.vertices)
+    bbox = mesh.get_axis_aligned_bounding_box()
+    hull = cv2.convexHull(vertices[:, :2].astype(np.float32)).reshape(-1, 2).astype(np.float64)
+    stat = os.stat(mesh_file)
+    return {
+        'name': os.path.basename(object_dir),
+        'bbox_min': bbox.get_min_bound().reshape(-1),
+        'bbox_max': bbox.get_max_bound().reshape(-1),
+        'num_vertices': len(vertices),
+        'num_faces': len(mesh.triangles),
+        'num_hulls': len(glob.glob(os.path.join(object_dir, 'model_collision_*.obj'))),
+        'footprint': resample_footprint(hull),
+        'hash': content_hash,
+        'source': [stat.st_size, stat.st_mtime],
+    }
+
+def load_object_index(index_path=OBJECT_INDEX):
+    """The object index as a dict of arrays, one row per object, ordered by name."""
+    with np.load(index_path) as data:
+        return {key: data[key] for key in data.files}
+
+def build_object_index(data_dir, index_path=OBJECT_INDEX, num_workers=None):
+    """
+    Indexes every object directory of `data_dir` (mujoco_scanned_objects/models) in a pool of `num_workers`
+    processes and saves the table at `index_path`: name, bbox_min, bbox_max, num_vertices, num_faces, num_hulls,
+    footprint (FOOTPRINT_POINTS, 2) and the sha1 of model.obj. Objects whose model.obj did not change since the
+    index was written keep their rows, so the library is only loaded once.
+    """
+    object_dirs = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir) if os.path.exists(os.path.join(data_dir, name, 'model.obj')))
+    rows = {}
+    if os.path.exists(index_path):
+        index = load_object_index(index_path)
+        for i, name in enumerate(index['name']):
+            rows[str(name)] = {key: index[key][i] for key in index.keys()}
+    todo = []
+    for object_dir in object_dirs:
+        row = rows.get(os.path.basename(object_dir))
+        stat = os.stat(os.path.join(object_dir, 'model.obj'))
+        if row is None or list(row['source']) != [stat.st_size, stat.st_mtime]:
+            todo.append(object_dir)
+    if len(todo) > 0:
+        # spawned like the simulation process pools, open3d is not fork safe
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for row in tqdm(pool.map(index_object, todo, chunksize=8), total=len(todo)):
+                rows[row['name']] = row
+    names = [os.path.basename(object_dir) for object_dir in object_dirs]
+    index = {key: np.stack([np.asarray(rows[name][key]) for name in names], axis=0) for key in rows[names[0]].keys()}
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    tmp_path = '%s.%d.tmp.npz' % (index_path[:-len('.npz')], os.getpid())
+    np.savez(tmp_path, **index)
+    os.replace(tmp_path, index_path)
+    print('object index: %d objects, %d indexed' % (len(names), len(todo)))
+    return index
+
+def select_objects(index, min_bound=OBJECT_BOUNDS['min_bound'], max_bound=OBJECT_BOUNDS['max_bound']):
+    """Names of the indexed objects whose bounding box lies strictly inside [min_bound, max_bound]."""
+    inside = np.all(index['bbox_min'] > np.asarray(min_bound), axis=1) & np.all(index['bbox_max'] < np.asarray(max_bound), axis=1)
+    return [str(name) for name in index['name'][inside]]
+
+def get_bbox(data_dir, index_path=OBJECT_INDEX):
+    index = build_object_index(data_dir, index_path)
+    max = index['bbox_max']
+    min = index['bbox_min']
     # plot histogram
     plt.clf()
     plt.hist(max[..., 0], bins=100)
@@ -26,7 +103,6 @@ def get_bbox(data_dir):
     plt.clf()
     plt.hist(max[..., 2], bins=100)
     plt.savefig('max_z.png')
-    min = np.stack(min, axis=0)
     plt.clf()
     plt.hist(min[..., 0], bins=100)
     plt.savefig('min_x.png')
@@ -39,23 +115,17 @@ def get_bbox(data_dir):
     print('max: ', np.max(max, axis=0))
     print('min: ', np.min(min, axis=0))
 
-def filter_object(data_dir):
-    object_names = []
-    for root, dirs, files in os.walk(data_dir):
-        for dir in tqdm(dirs):
-            mesh_file = os.path.join(root, dir, 'model.obj')
-            mesh = o3d.io.read_triangle_mesh(mesh_file)
-            bbox = mesh.get_axis_aligned_bounding_box()
-            max = bbox.get_max_bound().reshape(-1)
-            min = bbox.get_min_bound().reshape(-1)
-            if max[0] < 0.1 and min[0] > -0.1 and max[1] < 0.1 and min[1] > -0.1 and max[2] < 0.12:
-                object_names.append(dir)
+def filter_object(data_dir, index_path=OBJECT_INDEX):
+    object_names = select_objects(build_object_index(data_dir, index_path))
     # save object names
     with open('assets/object_names.txt', 'w') as f:
         for name in object_names:
             f.write(name + '\n')
 
-def read_object_names(test=False):
+def read_object_names(test=False, index_path=None):
+    """The object names of the names files, or with `index_path` the objects of that index within OBJECT_BOUNDS."""
+    if index_path is not None and not test:
+        return select_objects(load_object_index(index_path))
     filename = 'assets/object_names_test.txt' if test else 'assets/object_names.txt'
     object_names = []
     with open(filename, 'r') as f:
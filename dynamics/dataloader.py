@@ -3,9 +3,22 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 from dynamics.utils import sample_pts_from_mesh
+from sim.aggregator import is_shard
+
+FIDELITY_TIERS = ['high', 'low']
+
+def fidelity_from_filename(filename):
+    # results of non-default tiers are saved as <object>_<gripper>_<tier>.npz
+    name = os.path.splitext(os.path.basename(filename))[0].split('_')
+    return name[2] if len(name) > 2 else 'high'
 
 class DynamicsDataset(Dataset):
-    def __init__(self, dataset_dir, object_mesh_dir, fingers_3d, gripper_pts_max_x, gripper_pts_min_x, gripper_pts_max_y, gripper_pts_min_y, gripper_pts_max_z, gripper_pts_min_z, object_max_num_vertices=10, object_pts_max_x=0.05, object_pts_min_x=-0.05, object_pts_max_y=0.05, object_pts_min_y=-0.05, object_pts_max_z=0.05, object_pts_min_z=-0.05):
+    def __init__(self, dataset_dir, object_mesh_dir, fingers_3d, gripper_pts_max_x, gripper_pts_min_x, gripper_pts_max_y, gripper_pts_min_y, gripper_pts_max_z, gripper_pts_min_z, object_max_num_vertices=10, object_pts_max_x=0.05, object_pts_min_x=-0.05, object_pts_max_y=0.05, object_pts_min_y=-0.05, object_pts_max_z=0.05, object_pts_min_z=-0.05, fidelity_weights=None, num_rot=None):
+        """
+        fidelity_weights: optional dict mapping fidelity tier to its loss weight, tiers not listed are skipped
+        num_rot: optional number of orientations kept per sample, finer grids are strided down to it so that
+            samples of different tiers can be batched together
+        """
         self.fingers_3d = fingers_3d
         if fingers_3d:
             self.threshold = np.array([0.02, 0.001, 0.001])
@@ -26,19 +39,44 @@ class DynamicsDataset(Dataset):
         self.object_pts_min_y = object_pts_min_y
         self.object_pts_max_z = object_pts_max_z
         self.object_pts_min_z = object_pts_min_z
+        self.fidelity_weights = fidelity_weights
+        self.num_rot = num_rot
+        # (file, entry) pairs, entry is None for single result files and the result name inside shards
         self.data_files = []
         for root, dirs, files in os.walk(dataset_dir):
             for file in files:
                 if file.endswith('.npz'):
-                    self.data_files.append(os.path.join(root, file))
+                    entries = np.load(os.path.join(root, file)).files if is_shard(file) else [None]
+                    for entry in entries:
+                        if fidelity_weights is not None and fidelity_from_filename(entry or file) not in fidelity_weights:
+                            continue
+                        self.data_files.append((os.path.join(root, file), entry))
         self.object_pts = {}    # used for caching object points
         self.object_mesh_dir = object_mesh_dir
 
     def __len__(self):
         return len(self.data_files)
     
+    def subsample_orientations(self, data):
+        num_rot = int(data.get('num_rot', 360))
+        if self.num_rot is None or num_rot == self.num_rot:
+            return data
+        if num_rot % self.num_rot != 0:
+            raise ValueError('cannot stride %d orientations down to %d' % (num_rot, self.num_rot))
+        stride = num_rot // self.num_rot
+        for k in ['obj_pos', 'obj_theta', 'delta_theta', 'delta_pos']:
+            # rows are ordered by (orientation, x, y)
+            rows = data[k].reshape((num_rot, -1) + data[k].shape[1:])
+            data[k] = rows[::stride].reshape((-1,) + data[k].shape[1:])
+        data['num_rot'] = self.num_rot
+        return data
+
     def __getitem__(self, idx):
-        data = np.load(self.data_files[idx], allow_pickle=True)['arr_0'].item()
+        data_file, entry = self.data_files[idx]
+        data = np.load(data_file, allow_pickle=True)[entry or 'arr_0'].item()
+        data = self.subsample_orientations(data)
+        fidelity = str(data.get('fidelity', fidelity_from_filename(entry or data_file)))
+        weight = 1.0 if self.fidelity_weights is None else self.fidelity_weights[fidelity]
         # normalize with std (already zero-mean)
         train_scores = np.stack([data['delta_theta']/self.std[0], data['delta_pos'][:, 0]/self.std[1], data['delta_pos'][:, 1]/self.std[2]], axis=1)
         train_scores = torch.from_numpy(train_scores).float()
@@ -76,4 +114,6 @@ class DynamicsDataset(Dataset):
             'input_ori': train_input_ori,
             'input_pos': train_input_pos,
             'object_vertices': object_vertices,
+            'fidelity': FIDELITY_TIERS.index(fidelity),
+            'weight': torch.tensor(weight, dtype=torch.float32),
         }
\ No newline at end of file
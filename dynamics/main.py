@@ -94,7 +94,9 @@ def train(args):
         object_pts_max_y=object_pts_max_y, 
         object_pts_min_y=object_pts_min_y, 
         object_pts_max_z=object_pts_max_z, 
-        object_pts_min_z=object_pts_min_z)
+        object_pts_min_z=object_pts_min_z,
+        fidelity_weights=args.fidelity_weights,
+        num_rot=args.fidelity_num_rot)
     threshold_std = train_dataset.threshold / train_dataset.std
     val_dataset = DynamicsDataset(
         dataset_dir=args.test_data_dir, 
@@ -112,7 +114,8 @@ def train(args):
         object_pts_max_y=object_pts_max_y, 
         object_pts_min_y=object_pts_min_y, 
         object_pts_max_z=object_pts_max_z, 
-        object_pts_min_z=object_pts_min_z)
+        object_pts_min_z=object_pts_min_z,
+        num_rot=args.fidelity_num_rot)
     train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=False)
     val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, drop_last=False)
     trainer = Trainer(args)
@@ -145,8 +148,11 @@ def train(args):
                 else:
                     ctrlpts = torch.cat([batch['ctrlpts'][..., 1] for _ in range(score.size(1))], 1).reshape((input_ori.shape[0], -1)).cuda()
                     object_vertices = torch.cat([batch['object_vertices'] for _ in range(score.size(1))], 1).reshape((input_ori.shape[0], -1)).cuda()
+                weights = None
+                if args.fidelity_weights is not None:
+                    weights = batch['weight'].repeat_interleave(score.size(1)).cuda()
                 score = score.reshape((-1, 3)).cuda()
-                loss, pred = trainer.step(ctrlpts, score, input_ori, input_pos, object_vertices)
+                loss, pred = trainer.step(ctrlpts, score, input_ori, input_pos, object_vertices, weights=weights)
 
                 accuracy = torch.mean(torch.Tensor([2 if score_ori > threshold_std[0] else 0 if score_ori < -threshold_std[0] else 1 for score_ori in score[..., 0]]) == torch.Tensor([2 if pred_ori > threshold_std[0] else 0 if pred_ori < -threshold_std[0] else 1 for pred_ori in pred[..., 0]]), dtype=torch.float32)
                 accuracy_x = torch.mean(torch.Tensor([2 if score_x > threshold_std[1] else 0 if score_x < -threshold_std[1] else 1 for score_x in score[..., 1]]) == torch.Tensor([2 if pred_x > threshold_std[1] else 0 if pred_x < -threshold_std[1] else 1 for pred_x in pred[..., 1]]), dtype=torch.float32)
@@ -64,6 +64,36 @@ def convergence_range_from_finals(finals, threshold=0.1):
         convergence_range.append((start, end))
     return convergence_range
 
+# the objective values used to pick the best designs of each objective, with whether the highest ('max') or the
+# lowest ('min') value is best
+BEST_METRICS = {
+    'rotate': [('num_zero_classes', 'min'), ('delta_theta_abs', 'max'), ('final_delta_theta_abs', 'max'), ('success_rate', 'max')],
+    'rotate_clockwise': [('num_clockwise_classes', 'max'), ('delta_theta', 'min'), ('final_delta_theta', 'min'), ('success_rate', 'max')],
+    'rotate_counterclockwise': [('num_counterclockwise_classes', 'max'), ('delta_theta', 'max'), ('final_delta_theta', 'max'), ('success_rate', 'max')],
+    'shift_up': [('num_up_classes', 'max'), ('delta_pos_x', 'min'), ('final_pos_x', 'min'), ('success_rate', 'max')],
+    'shift_down': [('num_down_classes', 'max'), ('delta_pos_x', 'max'), ('final_pos_x', 'max'), ('success_rate', 'max')],
+    'shift_left': [('num_left_classes', 'max'), ('delta_pos_y', 'min'), ('final_pos_y', 'min'), ('success_rate', 'max')],
+    'shift_right': [('num_right_classes', 'max'), ('delta_pos_y', 'max'), ('final_pos_y', 'max'), ('success_rate', 'max')],
+    'convergence': [('max_convergence_range_3deg', 'max'), ('max_convergence_range_5deg', 'max'), ('max_convergence_range_10deg', 'max')],
+}
+for rotation, theta in [('clockwise', 'min'), ('counterclockwise', 'max')]:
+    for shift, axis, pos in [('up', 'x', 'min'), ('down', 'x', 'max'), ('left', 'y', 'min'), ('right', 'y', 'max')]:
+        BEST_METRICS['%s_%s' % (rotation, shift)] = [
+            ('num_%s_%s_classes' % (rotation, shift), 'max'), ('num_%s_classes' % rotation, 'max'), ('delta_theta', theta), ('final_delta_theta', theta),
+            ('num_%s_classes' % shift, 'max'), ('delta_pos_%s' % axis, pos), ('final_pos_%s' % axis, pos), ('success_rate', 'max'),
+        ]
+
+def best_design_ids(objectives, opt_obj):
+    """Returns {metric: index of the best of `objectives`} for the metrics of `opt_obj` in BEST_METRICS, first index on ties."""
+    if opt_obj == 'rotate_in_place':
+        opt_obj = 'rotate'
+    if opt_obj not in BEST_METRICS:
+        raise ValueError('opt obj not supported')
+    keys = [k for k, _ in BEST_METRICS[opt_obj]]
+    signs = np.array([1.0 if direction == 'max' else -1.0 for _, direction in BEST_METRICS[opt_obj]])
+    values = np.array([[objective[k] for k in keys] for objective in objectives], dtype=np.float64)
+    return dict(zip(keys, np.argmax(values * signs, axis=0)))
+
 def metric2objective(metric, objective):
     if objective == 'rotate':
         return {
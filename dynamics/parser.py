@@ -1,5 +1,13 @@
 import argparse
 
+def fidelity_weights(value):
+    # e.g. 'high:1.0,low:0.3', tiers that are not listed are left out of the dataset
+    weights = {}
+    for item in value.split(','):
+        tier, weight = item.split(':')
+        weights[tier.strip()] = float(weight)
+    return weights
+
 def parse():
     parser = argparse.ArgumentParser()
     parser.add_argument('--batch_size', type=int, default=1024)
@@ -37,5 +45,14 @@ def parse():
     parser.add_argument('--fingers_3d', action='store_true', help='use 3d fingers')
     parser.add_argument('--render_video', action='store_true', help='render videos visualizing interactions of fingers and objects')
     parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--asset_budget_gb', type=float, default=None, help='archive validation meshes, plots and videos, evicting the least recently used archives above this many GB')
+    parser.add_argument('--sim_backend', type=str, default='auto', choices=['auto', 'serial', 'process', 'ray'], help='where validation simulations run, auto picks by the size of the batch')
+    parser.add_argument('--result_cache_dir', type=str, default=None, help='directory of simulation results reused across validations and runs, <save_dir>/result_cache by default')
+    parser.add_argument('--reuse_radius', type=float, default=0.0, help='reuse the cached results of a design within this rms distance of the control points (m), 0 simulates every new design')
+    parser.add_argument('--mesh_format', type=str, default='obj', choices=['obj', 'stl', 'msh'], help='file format of the finger meshes written for the simulations, stl and msh are binary and parse faster')
+    parser.add_argument('--results_db', type=str, default=None, help='sqlite file the validations add every evaluated design to, for best-design queries across runs (python sim/results_db.py)')
+    parser.add_argument('--plot_mode', type=str, default='raster', choices=['raster', 'matplotlib', 'defer', 'none'], help='how validation plots are written: small raster images, matplotlib figures, deferred to the logged designs or skipped')
+    parser.add_argument('--fidelity_weights', type=fidelity_weights, default=None, help='loss weight per fidelity tier, e.g. high:1.0,low:0.3')
+    parser.add_argument('--fidelity_num_rot', type=int, default=None, help='number of orientations each sample is strided down to when mixing fidelity tiers')
     args = parser.parse_args()  
     return args
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import glob
+import shutil
 import sys
 from os.path import join as pjoin
 
@@ -13,19 +14,41 @@ from transforms3d import euler, quaternions
 import numpy as np
 import subprocess
 from mujoco import viewer
-import ray
 import subprocess
-import time
-import imageio
 import cv2
 
 from assets.finger_sampler import generate_xml, generate_scene_xml, save_gripper
-from assets.icon_process import extract_contours
-from dynamics.utils import continuous_signed_delta
-from dynamics.utils import visualize_profile, visualize_finals, visualize_ctrlpts
+from assets.mesh_io import MESH_FORMAT, decomposition_input, finish_decomposition
+from dynamics.utils import continuous_signed_delta, pose_change
+from dynamics.utils import plot, PLOT_MODE
 from sim.sim_2d import OBJECT_DIR, prepare_icon_object
+from sim.object_library import ensure_object_library, open_object_library
+from sim.contour_store import cached_contour
+from sim.result_cache import design_key, group_key, array_hash
+from sim.scheduling import FAILED, files_ready, wait_for_files, gather_with_deadlines
+from sim.autotune import autotune, measure, chunk_ranges, DEFAULT_PLAN
+from sim.executor import make_executor
+from sim.pool import load_model
+from sim.threads import simulate_threads
+from sim.video import VideoStream, FrameBuffer
+from sim.replay import TRAJECTORY_SUFFIX, make_camera, trajectory_path, save_trajectory, load_trajectory, replay
 
 threshold = np.array([0.03, 0.002, 0.003])
+# seconds to wait for another task to finish writing a shared xml file
+ASSET_TIMEOUT = 600.0
+# prior on the runtime of one sim_test task, used for deadlines until enough tasks finished
+EXPECTED_SETUP_TIME = 60.0
+EXPECTED_TIME_PER_ROT = 2.0
+# priors on the V-HACD decompositions of the prepare stage, gripper (two fingers) and object tasks get their own deadlines
+EXPECTED_PREPARE_TIME = {"gripper": 60.0, "object": 30.0}
+# orientations simulated by the autotuner warm-up
+NUM_WARMUP_ROT = 2
+# an orientation stops regrasping once the object moved less than these between STEADY_CYCLES consecutive cycles
+STEADY_CYCLES = 3
+STEADY_POS_TOL = 1e-4
+STEADY_THETA_TOL = 1e-3
+# part of the result cache keys, bump when a change of the simulation changes its poses
+SIM_VERSION = 1
 # map segments shape [128, 128] to colors [128, 128, 3]
 color_map = np.asarray(
     [
@@ -38,6 +61,8 @@ color_map = np.asarray(
     dtype=np.uint8,
 )
 color_maps = np.concatenate([color_map for _ in range(32)], axis=0)
+# top-down view of the segmentation renders
+CAMERA = {"lookat": [0.0, 0.0, 0.0], "distance": 0.45, "azimuth": 180, "elevation": -90}
 
 
 def compute_collision(mesh_path, num_retries: int = 2):
@@ -64,7 +89,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
     """
     COMMAND = [
         "./TestVHACD",
-        mesh_path,
+        decomposition_input(mesh_path),
         "-r",
         "100000",
         "-o",
@@ -86,15 +111,17 @@ def compute_collision(mesh_path, num_retries: int = 2):
             continue
     if output is None or output.returncode != 0:
         raise RuntimeError("V-HACD failed to run on %s" % mesh_path)
+    finish_decomposition(mesh_path)
 
 
-def prepare_finger(idx: int, ctrlpts, model_root: str):
+def prepare_finger(idx: int, ctrlpts, model_root: str, mesh_format: str = MESH_FORMAT):
     save_gripper_dir = os.path.join(model_root, "grippers", str(idx))
 
-    # This part should be upgraded, have the dir does not mean the files are there
-    if os.path.exists(save_gripper_dir):
+    # the xml is written last, a dir without it is left by a prepare that failed or was cancelled
+    if os.path.exists(os.path.join(model_root, "gripper_%d.xml" % idx)):
         return save_gripper_dir
     else:
+        shutil.rmtree(save_gripper_dir, ignore_errors=True)
         save_gripper(
             ctrlpts[: ctrlpts.shape[0] // 2, 0],
             ctrlpts[: ctrlpts.shape[0] // 2, 1],
@@ -103,67 +130,105 @@ def prepare_finger(idx: int, ctrlpts, model_root: str):
             height=0.02,
             num_points=200,
             save_gripper_dir=save_gripper_dir,
+            mesh_format=mesh_format,
         )
-        meshl_path = os.path.join(save_gripper_dir, "fingerl.obj")
+        meshl_path = os.path.join(save_gripper_dir, "fingerl.%s" % mesh_format)
         print(meshl_path, "compute collision")
         compute_collision(meshl_path)
         print(meshl_path, "computed collision")
-        meshr_path = os.path.join(save_gripper_dir, "fingerr.obj")
+        meshr_path = os.path.join(save_gripper_dir, "fingerr.%s" % mesh_format)
         print(meshr_path, "compute collision")
         compute_collision(meshr_path)
         print(meshr_path, "computed collision")
         generate_xml(
-            len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.obj"))),
-            len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.obj"))),
+            len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.%s" % mesh_format))),
+            len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.%s" % mesh_format))),
             idx,
             os.path.join(model_root, "gripper_%d.xml" % idx),
+            mesh_format=mesh_format,
         )
         print("gripper_%d.xml" % idx, "generated")
         return save_gripper_dir
 
 
+def segmentation_stream(video_path: str):
+    """Returns a VideoStream coloring segmentations, with the object contour of the first frame drawn on every frame."""
+    init_contour = []
+
+    def transform(frame):
+        img = color_maps[frame]
+        if len(init_contour) == 0:
+            img_cp = img.copy()
+            img_cp[frame % 4 != 0, :] = 255
+            init_contour.append(cached_contour(img_cp, num_points=100, rescale=False))
+            assert init_contour[0].shape == (100, 2)
+        cv2.drawContours(img, init_contour, -1, (38, 80, 115), 1)
+        return img.astype(np.uint8)
+
+    return VideoStream(video_path, fps=20, transform=transform)
+
+
+def orientations(num_rot: int, ori_range: list):
+    return np.linspace(ori_range[0], ori_range[1], num_rot) * np.pi + np.pi
+
+
+def num_videos(num_rot: int):
+    # every 36th orientation is recorded
+    return max(1, num_rot // 36)
+
+
+def prepare_scene(gripper_idx: int, object_idx: int, model_root: str):
+    scene_path = os.path.join(model_root, "scene_%d_%d.xml" % (object_idx, gripper_idx))
+    generate_scene_xml(object_idx, gripper_idx, scene_path)
+    wait_for_files(
+        [
+            os.path.join(model_root, "object_%d.xml" % object_idx),
+            os.path.join(model_root, "gripper_%d.xml" % gripper_idx),
+        ],
+        timeout=ASSET_TIMEOUT,
+    )
+    return scene_path
+
+
 # @profile
-@ray.remote(num_cpus=2)
-def sim_test(
-    #Simulate the interaction between gripper and object
-    ctrlpts,
-    object_image,
-    gripper_idx: int = 0,
-    object_idx: int = 0,
-    object_order_idx: int = 0,
-    model_root: str = "assets",
-    save_dir: str = "sim",
+def simulate(
+    scene_path: str,
+    z_rots,
+    rot_ids,
+    num_videos: int,
     gui: bool = False,
     render: bool = True,
-    num_rot: int = 360,
-    ori_range: list = [-1.0, 1.0],
     render_last: bool = True,
+    record: bool = False,
+    video_dir: str = None,
+    steady_cycles: int = STEADY_CYCLES,
+    num_threads: int = 1,
 ):
-    save_gripper_dir = prepare_finger(gripper_idx, ctrlpts, model_root)
-    prepare_icon_object(object_idx, object_image, model_root)
-
-    scene_path = os.path.join(model_root, "scene_%d_%d.xml" % (object_idx, gripper_idx))
-    generate_scene_xml(object_idx, gripper_idx, scene_path)
-
-    #In summary, a Ray task in this code refers to a unit of work created using the sim_test.remote function call. These tasks are scheduled and executed in parallel using the Ray library. The code creates a list of Ray tasks, processes them in a loop, and stores the results in dictionaries. This approach allows for efficient parallel processing of simulations, leveraging multiple CPUs to speed up the computation.
-
-
-    while not (
-        os.path.exists(os.path.join(model_root, "object_%d.xml" % object_idx))
-        and os.path.getsize(os.path.join(model_root, "object_%d.xml" % object_idx)) > 0
-        and os.path.exists(os.path.join(model_root, "gripper_%d.xml" % gripper_idx))
-        and os.path.getsize(os.path.join(model_root, "gripper_%d.xml" % gripper_idx))
-        > 0
-    ):
-        # print("waiting for xml files to be generated")
-        # print("object" , os.path.exists(os.path.join(model_root, "object_%d.xml" % object_idx)))
-        # print("gripper" , os.path.exists(os.path.join(model_root, "gripper_%d.xml" % gripper_idx)))
-        # print("object size" , os.path.getsize(os.path.join(model_root, "object_%d.xml" % object_idx)))
-        # print("gripper size" , os.path.getsize(os.path.join(model_root, "gripper_%d.xml" % gripper_idx)))
-        time.sleep(0.1)
-
-    # print("prepare to load model")
-    model = mujoco.MjModel.from_xml_path(scene_path)
+    """
+    Steps the scene at `scene_path` for the object orientations `z_rots[rot_ids]`, each until its object pose is
+    steady over `steady_cycles` regrasp cycles (0 runs all cycles) unless it is rendered.
+    Returns the initial, first regrasp and final object poses of these orientations, (len(rot_ids), 7) each,
+    and per recorded orientation {video_idx: ...}
+        render          the path of its video, encoded into `video_dir` while stepping
+        render_last     its first and last segmentations, (2, 128, 128)
+        record          its qpos (400, nq) instead of rendered frames, to be replayed later
+    With `num_threads` > 1 the orientations are split over threads sharing the model, see sim/threads.py.
+    """
+    if num_threads > 1 and not gui:
+        return simulate_threads(
+            simulate,
+            scene_path,
+            z_rots,
+            rot_ids,
+            num_videos,
+            num_threads,
+            render=render,
+            render_last=render_last,
+            record=record,
+            video_dir=video_dir,
+            steady_cycles=steady_cycles,
+        )
+    model = load_model(scene_path)
     data = mujoco.MjData(model)
     reset_qpos = data.qpos.copy()
     reset_qvel = data.qvel.copy()
@@ -185,23 +250,28 @@ def sim_test(
     right_grip_jnt = model.joint(right_grip_idx)
 
     # print("prepare to simulate")
-    if render or render_last:
+    record = record and render
+    if (render and not record) or render_last:
         renderer = mujoco.Renderer(model, 128, 128)
         renderer.enable_segmentation_rendering()
-        camera = mujoco.MjvCamera()
-        camera.lookat[:] = [0.0, 0.0, 0.0]
-        camera.distance = 0.45
-        camera.azimuth = 180
-        camera.elevation = -90
-
-    z_rots = np.linspace(ori_range[0], ori_range[1], num_rot) * np.pi + np.pi
-    init_poses = np.zeros((len(z_rots), 7))
-    final_poses = np.zeros((len(z_rots), 7))
+        camera = make_camera(CAMERA)
+
+    init_poses = np.zeros((len(rot_ids), 7))
+    final_poses = np.zeros((len(rot_ids), 7))
     # imgs = np.zeros((len(z_rots) // 36, 200, 128, 128, 3))
-    segs = np.zeros((max(1, len(z_rots) // 36), 400, 128, 128), dtype=np.int16)
-    final_final_poses = np.zeros((len(z_rots), 7))
-    for k, z_rot in enumerate(z_rots):
+    segs = {}
+    final_final_poses = np.zeros((len(rot_ids), 7))
+    for i, k in enumerate(rot_ids):
+        z_rot = z_rots[k]
         # print("z_rot", k, z_rot)
+        # frames are encoded or kept in a bounded buffer as they are rendered, nothing is kept otherwise
+        stream = None
+        if record and k % 36 == 0 and k // 36 < num_videos:
+            segs[k // 36] = np.zeros((400, model.nq), dtype=np.float32)
+        elif render and k % 36 == 0 and k // 36 < num_videos:
+            stream = segmentation_stream(os.path.join(video_dir, "%d.mp4" % (k // 36)))
+        elif render_last and k % 36 == 0 and k // 36 < num_videos:
+            stream = FrameBuffer()
         data.qpos[:] = reset_qpos[:]
         data.qvel[:] = reset_qvel[:]
         data.qfrc_applied[:] = reset_force
@@ -213,15 +283,26 @@ def sim_test(
         data.qpos[obj_jnt.qposadr[0] + 3 : obj_jnt.qposadr[0] + 7] = euler.euler2quat(
             0, 0, z_rot
         )
-        init_poses[k, :] = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7]
+        init_poses[i, :] = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7]
         data.ctrl[0] = 0.2
         data.ctrl[1] = -0.2
+        # rendered orientations keep the full horizon of their videos
+        full_horizon = steady_cycles == 0 or gui or ((render or render_last) and k % 36 == 0 and k // 36 < num_videos)
+        cycle_pose, num_steady = None, 0
         for t in range(8000):
             # print(t)
             if handle is not None and t % 10 == 0:
                 handle.sync()
                 input(f"Press Enter to continue..., {t}")
             if t % 200 == 0 and t > 0:
+                # end of a regrasp cycle
+                pose = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7].copy()
+                if cycle_pose is not None:
+                    delta_pos, delta_theta = pose_change(cycle_pose, pose)
+                    num_steady = num_steady + 1 if delta_pos < STEADY_POS_TOL and delta_theta < STEADY_THETA_TOL else 0
+                cycle_pose = pose
+                if not full_horizon and num_steady >= steady_cycles:
+                    break
                 # reset the positions velocities forces of the gripper
                 data.qpos[left_grip_jnt.qposadr[0]] = reset_qpos[
                     left_grip_jnt.qposadr[0]
@@ -232,23 +313,51 @@ def sim_test(
                 data.qvel[:] = reset_qvel[:]
                 data.qfrc_applied[:] = reset_force[:]
             mujoco.mj_step(model, data)
-            if (render and k % 36 == 0 and t % 20 == 0) or (
-                render_last and k % 36 == 0 and (t == 1999 or t == 0)
+            if record and k // 36 in segs and t % 20 == 0:
+                segs[k // 36][t // 20, ...] = data.qpos
+            elif stream is not None and (
+                (render and t % 20 == 0) or (not render and (t == 1999 or t == 0))
             ):
                 renderer.update_scene(data, camera)
                 # img = renderer.render()
                 seg = renderer.render()[..., 0]
-                segs[k // 36, t // 20, ...] = seg
+                stream.append(seg.astype(np.int16))
                 # img = color_maps[seg]
                 # imgs[k // 36, t // 20, ...] = img
             if t == 200:
-                final_poses[k, :] = data.qpos[
+                final_poses[i, :] = data.qpos[
                     obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7
                 ]
-            final_final_poses[k, :] = data.qpos[
-                obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7
-            ]
+        final_final_poses[i, :] = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7]
+        if stream is not None:
+            segs[k // 36] = stream.close()
+    return init_poses, final_poses, final_final_poses, segs
 
+
+def summarize(
+    ctrlpts,
+    init_poses,
+    final_poses,
+    final_final_poses,
+    segs,
+    gripper_idx: int,
+    object_idx: int,
+    object_order_idx: int,
+    save_dir: str,
+    ori_range: list,
+    render: bool,
+    render_last: bool,
+    save_gripper_dir: str,
+    record: bool = False,
+    scene_path: str = None,
+    plot_mode: str = PLOT_MODE,
+):
+    """
+    Computes the metrics of the simulated poses of all orientations, saves them with the plots and videos.
+    With `record` the recorded trajectories of the videos are saved instead, see `render_trajectory`.
+    `plot_mode` picks how the plots are written, see `plot` in dynamics/utils.py.
+    """
+    segs = [segs[video_idx] for video_idx in sorted(segs.keys())]
     save_data = {
         "ctrlpts": ctrlpts,
         "obj_pos": init_poses[..., :3].reshape((-1, 3)),
@@ -281,9 +390,7 @@ def sim_test(
         os.path.join(save_dir, "%d_%d.npz" % (object_idx, gripper_idx)), save_data
     )
     # visualize and save profile
-    visualize_ctrlpts(
-        ctrlpts, os.path.join(save_dir, "%d_%d_ctrlpts.png" % (object_idx, gripper_idx))
-    )
+    plot("ctrlpts", ctrlpts, os.path.join(save_dir, "%d_%d_ctrlpts.png" % (object_idx, gripper_idx)), plot_mode)
 
     # Save control points as CSV
     ctrlpts_csv_path = os.path.join(save_dir, "%d_%d_ctrlpts.csv" % (object_idx, gripper_idx))
@@ -320,21 +427,9 @@ def sim_test(
             for delta_pos in save_data["delta_pos"]
         ]
     )
-    visualize_profile(
-        profile,
-        os.path.join(save_dir, "%d_%d_profile.png" % (object_idx, gripper_idx)),
-        ori_range=ori_range,
-    )
-    visualize_profile(
-        profile_x,
-        os.path.join(save_dir, "%d_%d_profile_x.png" % (object_idx, gripper_idx)),
-        ori_range=ori_range,
-    )
-    visualize_profile(
-        profile_y,
-        os.path.join(save_dir, "%d_%d_profile_y.png" % (object_idx, gripper_idx)),
-        ori_range=ori_range,
-    )
+    plot("profile", profile, os.path.join(save_dir, "%d_%d_profile.png" % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
+    plot("profile", profile_x, os.path.join(save_dir, "%d_%d_profile_x.png" % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
+    plot("profile", profile_y, os.path.join(save_dir, "%d_%d_profile_y.png" % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
     final_thetas = np.asarray(
         [
             quaternions.quat2axangle(quat)[-1]
@@ -349,10 +444,7 @@ def sim_test(
         ],
         dtype=np.float32,
     )
-    visualize_finals(
-        final_thetas,
-        os.path.join(save_dir, "%d_%d_final.png" % (object_idx, gripper_idx)),
-    )
+    plot("finals", final_thetas, os.path.join(save_dir, "%d_%d_final.png" % (object_idx, gripper_idx)), plot_mode)
     # columns = ['video', 'obj_theta', 'delta_pos', 'delta_theta', 'final_theta']
     # table = wandb.Table(columns=columns)
     metrics = {
@@ -365,32 +457,31 @@ def sim_test(
         "final_delta_theta": final_delta_thetas * 180 / np.pi,
         "final_pos": final_final_poses[:, :3] * 100,
     }
-    if render:
-        videos = []
-        for video_idx, video in enumerate(segs):
-            with imageio.get_writer(
-                os.path.join(
-                    save_dir, "%d_%d" % (object_idx, gripper_idx), "%d.mp4" % video_idx
-                ),
-                fps=20,
-            ) as writer:
-                init_contour = None
-                for frame_idx, frame in enumerate(video):
-                    img = color_maps[frame]
-                    if frame_idx == 0:
-                        img_cp = img.copy()
-                        img_cp[frame % 4 != 0, :] = 255
-                        init_contour = extract_contours(
-                            img_cp, num_points=100, rescale=False
-                        )
-                        assert init_contour.shape == (100, 2)
-                    cv2.drawContours(img, [init_contour], -1, (38, 80, 115), 1)
-                    writer.append_data(img.astype(np.uint8))
-            videos.append(
-                os.path.join(
-                    save_dir, "%d_%d" % (object_idx, gripper_idx), "%d.mp4" % video_idx
-                )
+    if render and record:
+        videos = [
+            save_trajectory(
+                trajectory_path(os.path.join(save_dir, "%d_%d" % (object_idx, gripper_idx)), video_idx),
+                scene_path,
+                qpos,
+                CAMERA,
             )
+            for video_idx, qpos in enumerate(segs)
+        ]
+        return (
+            os.path.join(save_dir, "%d_%d_ctrlpts.png" % (object_idx, gripper_idx)),
+            metrics,
+            os.path.join(save_dir, "%d_%d_profile.png" % (object_idx, gripper_idx)),
+            os.path.join(save_dir, "%d_%d_profile_x.png" % (object_idx, gripper_idx)),
+            os.path.join(save_dir, "%d_%d_profile_y.png" % (object_idx, gripper_idx)),
+            os.path.join(save_dir, "%d_%d_final.png" % (object_idx, gripper_idx)),
+            videos,
+            gripper_idx,
+            object_order_idx,
+            save_gripper_dir,
+        )
+    elif render:
+        # encoded while stepping
+        videos = segs
         return (
             os.path.join(save_dir, "%d_%d_ctrlpts.png" % (object_idx, gripper_idx)),
             metrics,
@@ -408,7 +499,7 @@ def sim_test(
         for seg_idx, seg in enumerate(segs):
             img_cp = color_maps[seg[0]].copy()
             img_cp[seg[0] % 4 != 0, :] = 255
-            init_contour = extract_contours(img_cp, num_points=100, rescale=False)
+            init_contour = cached_contour(img_cp, num_points=100, rescale=False)
             img = color_maps[seg[-1]]
             cv2.drawContours(img, [init_contour], -1, (38, 80, 115), 1)
             cv2.imwrite(
@@ -448,6 +539,117 @@ def sim_test(
         )
 
 
+def sim_test(
+    # Simulate the interaction between gripper and object
+    ctrlpts,
+    library_dir,
+    gripper_idx: int = 0,
+    object_idx: int = 0,
+    object_order_idx: int = 0,
+    model_root: str = "assets",
+    save_dir: str = "sim",
+    gui: bool = False,
+    render: bool = True,
+    num_rot: int = 360,
+    ori_range: list = [-1.0, 1.0],
+    render_last: bool = True,
+    record: bool = False,
+    steady_cycles: int = STEADY_CYCLES,
+    num_threads: int = 1,
+    plot_mode: str = PLOT_MODE,
+    mesh_format: str = MESH_FORMAT,
+):
+    """
+    Runs all stages of one (gripper, object) pair in the calling process, sim_test_batch spreads them over Ray tasks.
+    `num_threads` threads step the orientations, for long sweeps of a few pairs.
+    """
+    save_gripper_dir = prepare_finger(gripper_idx, ctrlpts, model_root, mesh_format=mesh_format)
+    prepare_icon_object(object_idx, library_dir, model_root, mesh_format=mesh_format)
+    scene_path = prepare_scene(gripper_idx, object_idx, model_root)
+    init_poses, final_poses, final_final_poses, segs = simulate(
+        scene_path,
+        orientations(num_rot, ori_range),
+        list(range(num_rot)),
+        num_videos(num_rot),
+        gui=gui,
+        render=render,
+        render_last=render_last,
+        record=record,
+        video_dir=os.path.join(save_dir, "%d_%d" % (object_idx, gripper_idx)),
+        steady_cycles=steady_cycles,
+        num_threads=num_threads,
+    )
+    return summarize(
+        ctrlpts,
+        init_poses,
+        final_poses,
+        final_final_poses,
+        segs,
+        gripper_idx,
+        object_idx,
+        object_order_idx,
+        save_dir,
+        ori_range,
+        render,
+        render_last,
+        save_gripper_dir,
+        record=record,
+        scene_path=scene_path,
+        plot_mode=plot_mode,
+    )
+
+
+def render_trajectory(path: str):
+    """Replays a trajectory recorded by `simulate` into the mp4 next to it, as rendered without recording."""
+    video_path = path[: -len(TRAJECTORY_SUFFIX)] + ".mp4"
+    if os.path.exists(video_path):
+        return video_path
+    stream = segmentation_stream(video_path)
+    for frame in replay(load_trajectory(path), segmentation=True):
+        stream.append(frame[..., 0])
+    stream.close()
+    return video_path
+
+
+def simulator_settings(steady_cycles: int, mesh_format: str = MESH_FORMAT):
+    # everything besides the design and the object that the simulated poses depend on
+    settings = {
+        "sim": "sim_test_mj",
+        "version": SIM_VERSION,
+        "mujoco": mujoco.__version__,
+        "steady": [steady_cycles, STEADY_POS_TOL, STEADY_THETA_TOL],
+    }
+    # binary meshes are float32, obj results keep their keys
+    if mesh_format != "obj":
+        settings["mesh"] = mesh_format
+    return settings
+
+
+def warmup(ctrlpts, library_dir, object_idx: int, model_root: str, num_warmup_rot: int = NUM_WARMUP_ROT, mesh_format: str = MESH_FORMAT):
+    """Measures the stages on the first pair of a batch, its meshes are reused by the batch."""
+    _, gripper_wall, gripper_cpu = measure(prepare_finger, 0, ctrlpts, model_root, mesh_format=mesh_format)
+    _, object_wall, object_cpu = measure(prepare_icon_object, object_idx, library_dir, model_root, mesh_format=mesh_format)
+    scene_path = prepare_scene(0, object_idx, model_root)
+    _, load_wall, _ = measure(mujoco.MjModel.from_xml_path, scene_path)
+    _, step_wall, step_cpu = measure(
+        simulate,
+        scene_path,
+        orientations(num_warmup_rot, [-1.0, 1.0]),
+        list(range(num_warmup_rot)),
+        0,
+        render=False,
+        render_last=False,
+    )
+    return {
+        "prepare_wall": gripper_wall + object_wall,
+        "prepare_cpu": gripper_cpu + object_cpu,
+        "load_wall": load_wall,
+        "step_wall": step_wall - load_wall,
+        "step_cpu": step_cpu,
+        "num_warmup_rot": num_warmup_rot,
+    }
+
+
 def sim_test_batch(
     pts_y,
     object_ids,
@@ -457,48 +659,222 @@ def sim_test_batch(
     ori_range=[-1.0, 1.0],
     render=True,
     render_last=False,
+    return_status=False,
+    backend="auto",
+    pool=None,
+    record=False,
+    steady_cycles=STEADY_CYCLES,
+    cache=None,
+    force_exact=False,
+    num_threads=None,
+    plot_mode=PLOT_MODE,
+    mesh_format=MESH_FORMAT,
+    pair_keys=None,
 ):
+    """
+    Simulates every gripper in `pts_y` on every object in `object_ids`, `backend` picks the executor
+    (serial, process, ray or auto by the size of the batch, see sim/executor.py). With a SimulationPool
+    (see sim/pool.py) the batch runs on its warm workers and reuses the objects it decomposed before.
+    With `record` and `render` the videos are returned as recorded trajectories, see `render_trajectory`.
+    Orientations that are not rendered stop regrasping once steady for `steady_cycles` cycles, 0 never stops.
+    With a ResultCache (see sim/result_cache.py) designs simulated before on the same object with the same
+    settings are looked up instead of simulated, unless their videos are rendered. Designs without an entry reuse
+    the entry of a near duplicate within the cache's reuse_radius, unless `force_exact`.
+    Every stepping task splits its orientations over `num_threads` threads, by default all cpus when the batch
+    runs serially and one thread otherwise. `plot_mode` picks how the plots are written, 'defer' leaves them to
+    be drawn with draw_deferred (dynamics/utils.py) for the designs that are shown. The finger and object meshes
+    are written as `mesh_format` (obj, or binary stl / msh, see assets/mesh_io.py).
+    With `pair_keys` only those pairs (object_order_idx * num_gripper + gripper_idx) are simulated and returned,
+    e.g. when every object has designs of its own.
+    Tasks that miss their deadline or fail are left out of the returned lists; with `return_status`
+    a dict (object_order_idx * num_gripper + gripper_idx) -> 'timeout' / 'failed' is returned as well.
+    """
     model_root = os.path.join(save_dir, "sim_model")
     num_gripper = pts_y.shape[0]
-    data = np.load(OBJECT_DIR, allow_pickle=True).item()
-    images = data["image"]
-    print(f"Type of images: {type(images)}")
-    print(f"Shape of images (if NumPy array): {images.shape if isinstance(images, np.ndarray) else 'Not an array'}")
-    print(f"Sample image: {images[0]}")
-
-    object_images = np.load(OBJECT_DIR, allow_pickle=True).item()["image"][object_ids]
-    ray.init(num_cpus=num_cpus, log_to_driver=False)
-    ray_tasks = []
-    for i, obj_idx in enumerate(object_ids):
-        for idx, p_y in enumerate(pts_y):
-            p_x = np.linspace(-0.12, 0.12, p_y.shape[0] // 2)
-            p_x = np.concatenate([p_x, p_x], axis=0)
-            p_x = np.expand_dims(p_x, axis=-1)
-            # scale p_y from [-1,1] to [-0.045,0.015]
-            p_y = p_y * 0.03 - 0.015
-            pts = np.concatenate([p_x, p_y], axis=-1)
-            print("ray task", idx, obj_idx, i)
-            ray_tasks.append(sim_test.remote(ctrlpts=pts, object_image=object_images[i].transpose((1, 2, 0)), gripper_idx=idx, object_idx=obj_idx, object_order_idx=i, model_root=model_root, save_dir=save_dir, gui=False, render=render, num_rot=num_rot, ori_range=ori_range, render_last=render_last))
-    imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = {}, {}, {}, {}, {}, {}, {}, {}
-    while len(ray_tasks) > 0:
-        ready, ray_tasks = ray.wait(ray_tasks, num_returns=1)
-        try:
-            if render or render_last:
-                img, metric, profile, profile_x, profile_y, final, video, gripper_idx, object_idx, save_gripper_dir = ray.get(ready[0])
-                videos[object_idx * num_gripper + gripper_idx] = video
-            else:
-                img, metric, profile, profile_x, profile_y, final, gripper_idx, object_idx, save_gripper_dir = ray.get(ready[0])
-            imgs[object_idx * num_gripper + gripper_idx] = img
-            metrics[object_idx * num_gripper + gripper_idx] = metric
-            profiles[object_idx * num_gripper + gripper_idx] = profile
-            profiles_x[object_idx * num_gripper + gripper_idx] = profile_x
-            profiles_y[object_idx * num_gripper + gripper_idx] = profile_y
-            finals[object_idx * num_gripper + gripper_idx] = final
-            save_gripper_dirs[object_idx * num_gripper + gripper_idx] = save_gripper_dir
-        except Exception as e:
-            print(e)
+    library_dir = ensure_object_library(OBJECT_DIR)
+    ctrlpts = []
+    for p_y in pts_y:
+        p_x = np.linspace(-0.12, 0.12, p_y.shape[0] // 2)
+        p_x = np.concatenate([p_x, p_x], axis=0)
+        p_x = np.expand_dims(p_x, axis=-1)
+        # scale p_y from [-1,1] to [-0.045,0.015]
+        p_y = p_y * 0.03 - 0.015
+        ctrlpts.append(np.concatenate([p_x, p_y], axis=-1))
+    pairs = {
+        i * num_gripper + idx: (i, obj_idx, idx)
+        for i, obj_idx in enumerate(object_ids)
+        for idx in range(num_gripper)
+        if pair_keys is None or i * num_gripper + idx in pair_keys
+    }
+    # designs simulated before on the same object with the same settings are looked up
+    cache_keys, cached, reused = {}, {}, set()
+    if cache is not None:
+        library = open_object_library(library_dir)
+        object_hashes = {obj_idx: array_hash(library.contour(obj_idx)) for obj_idx in set(object_ids)}
+        settings = simulator_settings(steady_cycles, mesh_format)
+        groups = {obj_idx: group_key(object_hashes[obj_idx], num_rot, ori_range, settings) for obj_idx in set(object_ids)}
+        num_reused = 0
+        for key, (i, obj_idx, idx) in pairs.items():
+            cache_keys[key] = design_key(ctrlpts[idx], object_hashes[obj_idx], num_rot, ori_range, settings)
+            entry = cache.get(cache_keys[key]) if not render else None
+            if entry is None and not render and not force_exact:
+                entry = cache.nearest(groups[obj_idx], ctrlpts[idx])
+                if entry is not None:
+                    reused.add(key)
+                num_reused += entry is not None
+            if entry is not None and (not render_last or entry["frames"] is not None):
+                cached[key] = entry
+        print("result cache: %d of %d pairs cached, %d from near duplicates" % (len(cached), len(pairs), num_reused))
+    simulated = {key: pair for key, pair in pairs.items() if key not in cached}
+    # near duplicates only stand in for the poses and metrics, their gripper meshes and thumbnails are their own; so are
+    # those of cached designs without meshes to show (entries older than the meshes kept in the cache)
+    own_gripper = {key for key, entry in cached.items() if key in reused or not os.path.exists(entry.get("save_gripper_dir") or "")}
+    if pool is not None:
+        executor = pool.executor(len(simulated), num_rot, backend)
+    else:
+        executor = make_executor(num_cpus, len(simulated), num_rot, backend)
+    if executor.parallel and len(simulated) > 0:
+        plan = autotune(
+            "sim_test_mj",
+            lambda: warmup(ctrlpts[0], library_dir, object_ids[0], model_root, mesh_format=mesh_format),
+            num_cpus,
+            len(simulated),
+            num_rot,
+        )
+    else:
+        plan = dict(DEFAULT_PLAN)
+
+    # finger and object meshes are decomposed once each, by multi-core tasks
+    prepare_tasks = {("gripper", pairs[key][2]): (prepare_finger, pairs[key][2], ctrlpts[pairs[key][2]], model_root) for key in list(simulated) + sorted(own_gripper)}
+    object_root = pool.object_root if pool is not None else model_root
+    prepare_tasks.update(
+        {
+            ("object", obj_idx): (prepare_icon_object, obj_idx, library_dir, object_root)
+            for i, obj_idx, idx in simulated.values()
+            if pool is None or obj_idx not in pool.objects
+        }
+    )
+    # assets prepared before, e.g. by the warmup, are not submitted: their no-op runtimes would shrink the deadlines
+    prepared = {key: os.path.join(model_root, "grippers", str(key[1])) for key in prepare_tasks if key[0] == "gripper" and os.path.exists(os.path.join(model_root, "gripper_%d.xml" % key[1]))}
+    prepared.update({key: None for key in prepare_tasks if key[0] == "object" and os.path.exists(os.path.join(object_root, "object_%d.xml" % key[1]))})
+    decomposed, prepare_status = gather_with_deadlines(
+        executor,
+        lambda key: executor.submit(*prepare_tasks[key], num_cpus=plan["prepare_cpus"], mesh_format=mesh_format),
+        [key for key in prepare_tasks.keys() if key not in prepared],
+        max_in_flight=max(1, num_cpus // plan["prepare_cpus"]),
+        expected_runtime=lambda key: EXPECTED_PREPARE_TIME[key[0]],
+        group=lambda key: key[0],
+        # prepares write the assets in place, a speculative copy would find them half written
+        speculate=False,
+    )
+    prepared.update(decomposed)
+    # a prepare that failed or missed its deadline leaves a partial dir behind, the next batch builds it again
+    for kind, asset_idx in prepare_status:
+        shutil.rmtree(os.path.join(model_root if kind == "gripper" else object_root, kind + "s", str(asset_idx)), ignore_errors=True)
+    if pool is not None:
+        for obj_idx in set(obj_idx for i, obj_idx, idx in simulated.values()):
+            if ("object", obj_idx) not in prepare_status:
+                pool.link_object(obj_idx, model_root)
+    status = {}
+    for key, (i, obj_idx, idx) in list(simulated.items()):
+        for asset in [("gripper", idx), ("object", obj_idx)]:
+            if asset in prepare_status:
+                status[key] = prepare_status[asset]
+                simulated.pop(key)
+                break
+    for key in list(own_gripper):
+        if ("gripper", pairs[key][2]) in prepare_status:
+            status[key] = prepare_status[("gripper", pairs[key][2])]
+            own_gripper.remove(key)
+            cached.pop(key)
+    scene_paths = {}
+    for key, (i, obj_idx, idx) in list(simulated.items()):
+        # the xmls are written by the prepares that just finished, pairs missing one fail instead of waiting for it
+        if not files_ready([os.path.join(model_root, "object_%d.xml" % obj_idx), os.path.join(model_root, "gripper_%d.xml" % idx)]):
+            status[key] = FAILED
+            simulated.pop(key)
             continue
-    ray.shutdown()
+        scene_paths[key] = prepare_scene(idx, obj_idx, model_root)
+
+    # every pair is split into chunks of orientations, stepped by tasks of `step_threads` threads
+    step_threads = num_threads if num_threads is not None else (1 if executor.parallel else num_cpus)
+    step_cpus = max(plan["step_cpus"], step_threads)
+    z_rots = orientations(num_rot, ori_range)
+    chunks = chunk_ranges(num_rot, plan["num_chunks"])
+    chunk_size = max(stop - start for start, stop in chunks)
+    stepped, step_status = gather_with_deadlines(
+        executor,
+        lambda key: executor.submit(
+            simulate, scene_paths[key[0]], z_rots, list(range(*chunks[key[1]])), num_videos(num_rot), False, render, render_last,
+            num_cpus=step_cpus, record=record, steady_cycles=steady_cycles, video_dir=os.path.join(save_dir, "%d_%d" % pairs[key[0]][1:]),
+            num_threads=step_threads,
+        ),
+        [(key, chunk_idx) for key in simulated for chunk_idx in range(len(chunks))],
+        max_in_flight=max(1, num_cpus // step_cpus),
+        expected_runtime=plan["time_per_rot"] * chunk_size if plan["time_per_rot"] is not None else EXPECTED_SETUP_TIME + EXPECTED_TIME_PER_ROT * chunk_size,
+        # rendering chunks encode their videos into video_dir, copies would write the same files
+        speculate=not render,
+    )
+    poses = {}
+    for key in simulated:
+        failed = [step_status[(key, chunk_idx)] for chunk_idx in range(len(chunks)) if (key, chunk_idx) in step_status]
+        if len(failed) > 0:
+            status[key] = failed[0]
+            continue
+        results = [stepped[(key, chunk_idx)] for chunk_idx in range(len(chunks))]
+        segs = {}
+        for result in results:
+            segs.update(result[3])
+        poses[key] = [np.concatenate([result[j] for result in results], axis=0) for j in range(3)] + [segs]
+        if cache is not None:
+            cache.put(
+                cache_keys[key],
+                {
+                    "init_poses": poses[key][0],
+                    "final_poses": poses[key][1],
+                    "final_final_poses": poses[key][2],
+                    # still frames of render_last, videos and recordings are not kept
+                    "frames": segs if render_last and not render else None,
+                },
+                group=groups[pairs[key][1]],
+                ctrlpts=ctrlpts[pairs[key][2]],
+                # kept by the cache, the model_root of this batch is archived with the validation
+                save_gripper_dir=prepared[("gripper", pairs[key][2])],
+            )
+    if cache is not None:
+        cache.flush()
+    for key, entry in cached.items():
+        poses[key] = [entry["init_poses"], entry["final_poses"], entry["final_final_poses"], entry["frames"] or {}]
+    gripper_dirs = {key: prepared[("gripper", pairs[key][2])] if key in simulated or key in own_gripper else cached[key]["save_gripper_dir"] for key in poses}
+
+    # metrics, plots and videos
+    results, summarize_status = gather_with_deadlines(
+        executor,
+        lambda key: executor.submit(
+            summarize, ctrlpts[pairs[key][2]], *poses[key], pairs[key][2], pairs[key][1], pairs[key][0],
+            save_dir, ori_range, render, render_last, gripper_dirs[key],
+            record=record, scene_path=scene_paths.get(key), plot_mode=plot_mode,
+        ),
+        list(poses.keys()),
+        max_in_flight=num_cpus,
+    )
+    status.update(summarize_status)
+    imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = {}, {}, {}, {}, {}, {}, {}, {}
+    for result in results.values():
+        if render or render_last:
+            img, metric, profile, profile_x, profile_y, final, video, gripper_idx, object_idx, save_gripper_dir = result
+            videos[object_idx * num_gripper + gripper_idx] = video
+        else:
+            img, metric, profile, profile_x, profile_y, final, gripper_idx, object_idx, save_gripper_dir = result
+        imgs[object_idx * num_gripper + gripper_idx] = img
+        metrics[object_idx * num_gripper + gripper_idx] = metric
+        profiles[object_idx * num_gripper + gripper_idx] = profile
+        profiles_x[object_idx * num_gripper + gripper_idx] = profile_x
+        profiles_y[object_idx * num_gripper + gripper_idx] = profile_y
+        finals[object_idx * num_gripper + gripper_idx] = final
+        save_gripper_dirs[object_idx * num_gripper + gripper_idx] = save_gripper_dir
+    if pool is None:
+        executor.shutdown()
 
     # #temporarily remove ray
     # i = 0
@@ -562,17 +938,9 @@ def sim_test_batch(
     )
     if render or render_last:
         videos = list(map(lambda x: x[1], sorted(videos.items(), key=lambda x: x[0])))
-        return (
-            imgs,
-            metrics,
-            profiles,
-            profiles_x,
-            profiles_y,
-            finals,
-            videos,
-            save_gripper_dirs,
-        )
     else:
+        videos = []
+    if return_status:
         return (
             imgs,
             metrics,
@@ -580,6 +948,17 @@ def sim_test_batch(
             profiles_x,
             profiles_y,
             finals,
-            [],
+            videos,
             save_gripper_dirs,
+            status,
         )
+    return (
+        imgs,
+        metrics,
+        profiles,
+        profiles_x,
+        profiles_y,
+        finals,
+        videos,
+        save_gripper_dirs,
+    )
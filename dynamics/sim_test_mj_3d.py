@@ -1,5 +1,6 @@
 import os
 import glob
+import shutil
 import sys
 from os.path import join as pjoin
 BASEPATH = os.path.dirname(__file__)
@@ -12,18 +13,40 @@ from transforms3d import euler, quaternions
 import numpy as np
 import subprocess
 from mujoco import viewer
-import ray
 import subprocess
-import time
-import imageio
 import cv2
 
-from dynamics.utils import continuous_signed_delta, visualize_profile, visualize_finals
+from dynamics.utils import continuous_signed_delta, pose_change, plot, PLOT_MODE
 from sim.sim_3d import prepare_object
 from assets.finger_3d import save_3d_gripper, generate_gripper_3d_xml, generate_scene_3d_xml
-from sim.render_mesh import render_mesh, render_object_mesh
+from assets.mesh_io import MESH_FORMAT, decomposition_input, finish_decomposition
+from sim.render_mesh import render_mesh, project_object_mesh
+from sim.scheduling import FAILED, files_ready, wait_for_files, gather_with_deadlines
+from sim.autotune import autotune, measure, chunk_ranges, DEFAULT_PLAN
+from sim.executor import make_executor
+from sim.pool import load_model
+from sim.threads import simulate_threads
+from sim.result_cache import design_key, group_key
+from sim.video import VideoStream, FrameBuffer
+from sim.replay import TRAJECTORY_SUFFIX, make_camera, trajectory_path, save_trajectory, load_trajectory, replay
 
 threshold = np.array([0.02, 0.001, 0.001])
+# seconds to wait for another task to finish writing a shared xml file
+ASSET_TIMEOUT = 600.0
+# prior on the runtime of one sim_test task, used for deadlines until enough tasks finished
+EXPECTED_SETUP_TIME = 120.0
+EXPECTED_TIME_PER_ROT = 4.0
+# priors on the prepare stage: V-HACD of the two fingers, the scanned objects come with their collision meshes
+EXPECTED_PREPARE_TIME = {'gripper': 120.0, 'object': 10.0}
+# orientations simulated by the autotuner warm-up
+NUM_WARMUP_ROT = 1
+# an orientation stops regrasping once the object moved less than these between STEADY_CYCLES consecutive cycles
+STEADY_CYCLES = 3
+STEADY_POS_TOL = 1e-4
+STEADY_THETA_TOL = 1e-3
+# part of the result cache keys, bump when a change of the simulation changes its poses
+SIM_VERSION = 1
+CAMERA = {'lookat': [0.0, 0.0, 0.0], 'distance': 0.8, 'azimuth': 135, 'elevation': -45}
 
 def compute_collision(mesh_path, num_retries: int = 2):
     """
@@ -49,7 +72,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
     """
     COMMAND = [
         "TestVHACD",
-        mesh_path,
+        decomposition_input(mesh_path),
         "-r",
         "100000",
         "-o",
@@ -71,44 +94,66 @@ def compute_collision(mesh_path, num_retries: int = 2):
             continue
     if output is None or output.returncode != 0:
         raise RuntimeError("V-HACD failed to run on %s" % mesh_path)
+    finish_decomposition(mesh_path)
 
-def prepare_gripper(gripper_idx: int, ctrlpts, model_root: str):
+def prepare_gripper(gripper_idx: int, ctrlpts, model_root: str, mesh_format: str = MESH_FORMAT):
     save_gripper_dir = os.path.join(model_root, 'grippers', str(gripper_idx))
-    if os.path.exists(save_gripper_dir):
+    # the xml is written last, a dir without it is left by a prepare that failed or was cancelled
+    if os.path.exists(os.path.join(model_root, 'gripper_%d.xml' % gripper_idx)):
         return save_gripper_dir
     else:
+        shutil.rmtree(save_gripper_dir, ignore_errors=True)
         save_3d_gripper(
             ctrlpts[:len(ctrlpts) // 2],
             ctrlpts[len(ctrlpts) // 2:],
             width=0.1,
             sample_size=25,
             save_gripper_dir=save_gripper_dir,
+            mesh_format=mesh_format,
         )
-        meshl_path = os.path.join(save_gripper_dir, "fingerl.obj")
+        meshl_path = os.path.join(save_gripper_dir, "fingerl.%s" % mesh_format)
         compute_collision(meshl_path)
-        meshr_path = os.path.join(save_gripper_dir, "fingerr.obj")
+        meshr_path = os.path.join(save_gripper_dir, "fingerr.%s" % mesh_format)
         compute_collision(meshr_path)
-        generate_gripper_3d_xml(len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.obj"))), len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.obj"))), gripper_idx, os.path.join(model_root, 'gripper_%d.xml' % gripper_idx))
+        generate_gripper_3d_xml(len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.%s" % mesh_format))), len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.%s" % mesh_format))), gripper_idx, os.path.join(model_root, 'gripper_%d.xml' % gripper_idx), mesh_format=mesh_format)
     return save_gripper_dir
 
-@ray.remote(num_cpus=2)
-def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, object_order_idx: int=0, model_root: str="assets", save_dir: str="sim", gui: bool = False, render: bool = True, num_rot: int = 360, ori_range: list = [-1.0, 1.0], render_last: bool = False):
-    save_gripper_dir = prepare_gripper(gripper_idx, ctrlpts, model_root)
-    while not (os.path.exists(os.path.join(model_root, 'gripper_%d.xml' % gripper_idx)) and os.path.getsize(os.path.join(model_root, 'gripper_%d.xml' % gripper_idx))>0):
-        time.sleep(0.1)
-    gripper_img = render_mesh(save_gripper_dir)
-    gripper_img_path = os.path.join(save_dir, '%d_%d_gripper.png' % (object_idx, gripper_idx))
-    cv2.imwrite(gripper_img_path, gripper_img)
+def contour_stream(video_path: str, contour):
+    """Returns a VideoStream drawing the initial object `contour` on every frame."""
+    def transform(frame):
+        cv2.drawContours(frame, [contour], -1, (38, 80, 115), 1)
+        return frame
+    return VideoStream(video_path, fps=20, transform=transform)
+
+def object_contours(model_root: str, object_idx: int, num_rot: int, ori_range: list):
+    # the contours of the object in the first frame of each video, the same for every gripper, projected from its mesh
+    return project_object_mesh(os.path.join(model_root, 'objects', str(object_idx)), np.linspace(ori_range[0], ori_range[1], num_rot//36) * np.pi + np.pi)
+
+def orientations(num_rot: int, ori_range: list):
+    return np.linspace(ori_range[0], ori_range[1], num_rot) * np.pi + np.pi
 
-    save_object_dir = prepare_object(object_name, object_idx, model_root)
-    while not (os.path.exists(os.path.join(model_root, 'object_%d.xml' % object_idx)) and os.path.getsize(os.path.join(model_root, 'object_%d.xml' % object_idx))>0):
-        time.sleep(0.1)
-    contours = render_object_mesh(save_object_dir, np.linspace(ori_range[0], ori_range[1], num_rot//36) * np.pi + np.pi)
+def num_videos(num_rot: int):
+    # every 36th orientation is recorded
+    return num_rot // 36
 
+def prepare_scene(gripper_idx: int, object_idx: int, model_root: str):
+    wait_for_files([os.path.join(model_root, 'gripper_%d.xml' % gripper_idx), os.path.join(model_root, 'object_%d.xml' % object_idx)], timeout=ASSET_TIMEOUT)
     scene_path = os.path.join(model_root, 'scene_%d_%d.xml' % (object_idx, gripper_idx))
     generate_scene_3d_xml(object_idx, gripper_idx, scene_path)
+    return scene_path
 
-    model = mujoco.MjModel.from_xml_path(scene_path)
+def simulate(scene_path: str, z_rots, rot_ids, num_videos: int, gui: bool = False, render: bool = True, render_last: bool = False, record: bool = False, video_dir: str = None, contours=None, steady_cycles: int = STEADY_CYCLES, num_threads: int = 1):
+    """
+    Steps the scene at `scene_path` for the object orientations `z_rots[rot_ids]`, each until its object pose is
+    steady over `steady_cycles` regrasp cycles (0 runs all cycles) unless it is rendered.
+    Returns the initial, first regrasp and final object poses of these orientations, (len(rot_ids), 7) each,
+    and per recorded orientation {video_idx: ...} the path of its video encoded into `video_dir` while stepping
+    with `contours[video_idx]` drawn (render), its last frame (render_last) or its qpos (800, nq) to be replayed
+    later (record). With `num_threads` > 1 the orientations are split over threads sharing the model, see sim/threads.py.
+    """
+    if num_threads > 1 and not gui:
+        return simulate_threads(simulate, scene_path, z_rots, rot_ids, num_videos, num_threads, render=render, render_last=render_last, record=record, video_dir=video_dir, contours=contours, steady_cycles=steady_cycles)
+    model = load_model(scene_path)
     data = mujoco.MjData(model)
     reset_qpos = data.qpos.copy()
     reset_qvel = data.qvel.copy()
@@ -123,22 +168,27 @@ def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, o
     right_grip_idx = [model.joint(jointid).name for jointid in range(model.njnt)].index("right_grip")
     right_grip_jnt = model.joint(right_grip_idx)
 
-    if render or render_last:
+    record = record and render
+    if (render and not record) or render_last:
         renderer = mujoco.Renderer(model, 128, 128)
         # renderer.enable_segmentation_rendering()
-        camera = mujoco.MjvCamera()
-        camera.lookat[:] = [0.0, 0.0, 0.0]
-        camera.distance = 0.8
-        camera.azimuth = 135
-        camera.elevation = -45
+        camera = make_camera(CAMERA)
 
-    z_rots = np.linspace(ori_range[0], ori_range[1], num_rot) * np.pi + np.pi
-    init_poses = np.zeros((len(z_rots), 7))
-    final_poses = np.zeros((len(z_rots), 7))
-    imgs = np.zeros((len(z_rots) // 36, 800, 128, 128, 3), dtype=np.int8)
+    init_poses = np.zeros((len(rot_ids), 7))
+    final_poses = np.zeros((len(rot_ids), 7))
+    imgs = {}
     # segs = np.zeros((len(z_rots) // 36, 100, 128, 128), dtype=np.int16)
-    final_final_poses = np.zeros((len(z_rots), 7))
-    for k, z_rot in enumerate(z_rots):
+    final_final_poses = np.zeros((len(rot_ids), 7))
+    for i, k in enumerate(rot_ids):
+        z_rot = z_rots[k]
+        # frames are encoded or kept in a bounded buffer as they are rendered, nothing is kept otherwise
+        stream = None
+        if record and k % 36 == 0 and k // 36 < num_videos:
+            imgs[k // 36] = np.zeros((800, model.nq), dtype=np.float32)
+        elif render and k % 36 == 0 and k // 36 < num_videos:
+            stream = contour_stream(os.path.join(video_dir, '%d.mp4' % (k // 36)), contours[k // 36])
+        elif render_last and k % 36 == 0 and k // 36 < num_videos:
+            stream = FrameBuffer()
         data.qpos[:] = reset_qpos[:].copy()
         data.qvel[:] = reset_qvel[:].copy()
         data.qfrc_applied[:] = reset_force
@@ -146,36 +196,62 @@ def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, o
         data.qpos[
             obj_jnt.qposadr[0] + 3 : obj_jnt.qposadr[0] + 7
         ] = euler.euler2quat(0, 0, z_rot)
-        init_poses[k, :] = data.qpos[
+        init_poses[i, :] = data.qpos[
             obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7
         ]
         data.ctrl[0] = 0.5
         data.ctrl[1] = -0.5
+        # rendered orientations keep the full horizon of their videos
+        full_horizon = steady_cycles == 0 or gui or ((render or render_last) and k % 36 == 0 and k // 36 < num_videos)
+        cycle_pose, num_steady = None, 0
         for t in range(32000):
             if handle is not None and t % 10 == 0:
                 handle.sync()
                 input(f"Press Enter to continue..., {t}")
             if t % 800 == 0 and t > 0:
+                # end of a regrasp cycle
+                pose = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7].copy()
+                if cycle_pose is not None:
+                    delta_pos, delta_theta = pose_change(cycle_pose, pose)
+                    num_steady = num_steady + 1 if delta_pos < STEADY_POS_TOL and delta_theta < STEADY_THETA_TOL else 0
+                cycle_pose = pose
+                if not full_horizon and num_steady >= steady_cycles:
+                    break
                 # reset the positions velocities forces of the gripper
                 data.qpos[left_grip_jnt.qposadr[0]] = reset_qpos[left_grip_jnt.qposadr[0]]
                 data.qpos[right_grip_jnt.qposadr[0]] = reset_qpos[right_grip_jnt.qposadr[0]]
                 data.qvel[:] = reset_qvel[:]
                 data.qfrc_applied[:] = reset_force[:]
             mujoco.mj_step(model, data)
-            if (render and k % 36 == 0 and t % 40 == 0) or (render_last and  k % 36 ==0 and t == 7999):
+            if record and k // 36 in imgs and t % 40 == 0:
+                imgs[k // 36][t // 40, ...] = data.qpos
+            elif stream is not None and ((render and t % 40 == 0) or (not render and t == 7999)):
                 renderer.update_scene(data, camera)
                 img = renderer.render()
                 # seg = renderer.render()[..., 0]
                 # segs[k // 36, t // 40, ...] = seg
                 # img = color_maps[seg]
-                imgs[k // 36, t // 40, ...] = img
+                stream.append(img)
             if t == 800:
-                final_poses[k, :] = data.qpos[
+                final_poses[i, :] = data.qpos[
                     obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7
                 ]
-            final_final_poses[k, :] = data.qpos[
-                    obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7
-            ]
+        final_final_poses[i, :] = data.qpos[obj_jnt.qposadr[0] : obj_jnt.qposadr[0] + 7]
+        if stream is not None:
+            imgs[k // 36] = stream.close()
+    return init_poses, final_poses, final_final_poses, imgs
+
+def summarize(init_poses, final_poses, final_final_poses, imgs, gripper_idx: int, object_idx: int, object_order_idx: int, model_root: str, save_dir: str, num_rot: int, ori_range: list, render: bool, render_last: bool, save_gripper_dir: str, record: bool = False, scene_path: str = None, contours=None, gripper_img=None, plot_mode: str = PLOT_MODE):
+    """
+    Computes the metrics of the simulated poses of all orientations, saves them with the renders, plots and videos.
+    With `record` the recorded trajectories of the videos are saved instead, see `render_trajectory_3d`.
+    `plot_mode` picks how the plots are written, see `plot` in dynamics/utils.py.
+    """
+    imgs = [imgs[video_idx] for video_idx in sorted(imgs.keys())]
+    gripper_img = gripper_img if gripper_img is not None else render_mesh(save_gripper_dir, cache_dir=os.path.join(model_root, 'thumbnails'))
+    gripper_img_path = os.path.join(save_dir, '%d_%d_gripper.png' % (object_idx, gripper_idx))
+    cv2.imwrite(gripper_img_path, gripper_img)
+    contours = contours if contours is not None else object_contours(model_root, object_idx, num_rot, ori_range)
 
     save_data = {
         "obj_pos": init_poses[..., :3].reshape((-1, 3)),
@@ -189,12 +265,12 @@ def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, o
     profile = np.asarray([1 if delta_theta > threshold[0] else -1 if delta_theta < -threshold[0] else 0 for delta_theta in save_data['delta_theta']])
     profile_x = np.asarray([1 if delta_pos[0] > threshold[1] else -1 if delta_pos[0] < -threshold[1] else 0 for delta_pos in save_data['delta_pos']])
     profile_y = np.asarray([1 if delta_pos[1] > threshold[2] else -1 if delta_pos[1] < -threshold[2] else 0 for delta_pos in save_data['delta_pos']])
-    visualize_profile(profile, os.path.join(save_dir, '%d_%d_profile.png' % (object_idx, gripper_idx)), ori_range=ori_range)
-    visualize_profile(profile_x, os.path.join(save_dir, '%d_%d_profile_x.png' % (object_idx, gripper_idx)), ori_range=ori_range)
-    visualize_profile(profile_y, os.path.join(save_dir, '%d_%d_profile_y.png' % (object_idx, gripper_idx)), ori_range=ori_range)
+    plot('profile', profile, os.path.join(save_dir, '%d_%d_profile.png' % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
+    plot('profile', profile_x, os.path.join(save_dir, '%d_%d_profile_x.png' % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
+    plot('profile', profile_y, os.path.join(save_dir, '%d_%d_profile_y.png' % (object_idx, gripper_idx)), plot_mode, ori_range=ori_range)
     final_thetas = np.asarray([quaternions.quat2axangle(quat)[-1] for quat in final_final_poses[:, 3:].reshape((-1, 4))], dtype=np.float32)
     final_delta_thetas = np.asarray([continuous_signed_delta(init_theta, final_theta) for final_theta, init_theta in zip(final_thetas, save_data['obj_theta'])], dtype=np.float32)
-    visualize_finals(final_thetas, os.path.join(save_dir, '%d_%d_final.png' % (object_idx, gripper_idx)))
+    plot('finals', final_thetas, os.path.join(save_dir, '%d_%d_final.png' % (object_idx, gripper_idx)), plot_mode)
     metrics = {
         'delta_theta': save_data['delta_theta']*180/np.pi,
         'delta_pos': save_data['delta_pos']*100,
@@ -206,14 +282,12 @@ def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, o
         'final_pos': final_final_poses[:, :3]*100,
     }
 
-    if render:
-        videos = []
-        for video_idx, video in enumerate(imgs):
-            with imageio.get_writer(os.path.join(save_dir, '%d_%d' % (object_idx, gripper_idx), '%d.mp4' % video_idx), fps=20) as writer:
-                for frame_idx, frame in enumerate(video):
-                    cv2.drawContours(frame, [contours[video_idx]], -1, (38, 80, 115), 1)
-                    writer.append_data(frame.astype(np.uint8))
-            videos.append(os.path.join(save_dir, '%d_%d' % (object_idx, gripper_idx), '%d.mp4' % video_idx))
+    if render and record:
+        videos = [save_trajectory(trajectory_path(os.path.join(save_dir, '%d_%d' % (object_idx, gripper_idx)), video_idx), scene_path, qpos, CAMERA, contour=contours[video_idx]) for video_idx, qpos in enumerate(imgs)]
+        return gripper_img_path, metrics, os.path.join(save_dir, '%d_%d_profile.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_x.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_y.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_final.png' % (object_idx, gripper_idx)), videos, gripper_idx, object_order_idx, save_gripper_dir
+    elif render:
+        # encoded while stepping
+        videos = imgs
         return gripper_img_path, metrics, os.path.join(save_dir, '%d_%d_profile.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_x.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_y.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_final.png' % (object_idx, gripper_idx)), videos, gripper_idx, object_order_idx, save_gripper_dir
     elif render_last:
         last_imgs = []
@@ -226,43 +300,165 @@ def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, o
     else:
         return gripper_img_path, metrics, os.path.join(save_dir, '%d_%d_profile.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_x.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_profile_y.png' % (object_idx, gripper_idx)), os.path.join(save_dir, '%d_%d_final.png' % (object_idx, gripper_idx)), gripper_idx, object_order_idx, save_gripper_dir
 
-def sim_test_batch_3d(ctrlpts_y, object_names, save_dir, num_cpus=32, num_rot=360, ori_range=[-1.0, 1.0], render=True, render_last=False):
+def sim_test(ctrlpts, object_name: str, gripper_idx: int=0, object_idx: int=0, object_order_idx: int=0, model_root: str="assets", save_dir: str="sim", gui: bool = False, render: bool = True, num_rot: int = 360, ori_range: list = [-1.0, 1.0], render_last: bool = False, record: bool = False, steady_cycles: int = STEADY_CYCLES, num_threads: int = 1, plot_mode: str = PLOT_MODE, mesh_format: str = MESH_FORMAT):
+    """Runs all stages of one (gripper, object) pair in the calling process with `num_threads` stepping threads, sim_test_batch_3d spreads them over Ray tasks."""
+    save_gripper_dir = prepare_gripper(gripper_idx, ctrlpts, model_root, mesh_format)
+    prepare_object(object_name, object_idx, model_root)
+    scene_path = prepare_scene(gripper_idx, object_idx, model_root)
+    contours = object_contours(model_root, object_idx, num_rot, ori_range)
+    init_poses, final_poses, final_final_poses, imgs = simulate(scene_path, orientations(num_rot, ori_range), list(range(num_rot)), num_videos(num_rot), gui=gui, render=render, render_last=render_last, record=record, video_dir=os.path.join(save_dir, '%d_%d' % (object_idx, gripper_idx)), contours=contours, steady_cycles=steady_cycles, num_threads=num_threads)
+    return summarize(init_poses, final_poses, final_final_poses, imgs, gripper_idx, object_idx, object_order_idx, model_root, save_dir, num_rot, ori_range, render, render_last, save_gripper_dir, record=record, scene_path=scene_path, contours=contours, plot_mode=plot_mode)
+
+def render_trajectory_3d(path: str):
+    """Replays a trajectory recorded by `simulate` into the mp4 next to it, as rendered without recording."""
+    video_path = path[:-len(TRAJECTORY_SUFFIX)] + '.mp4'
+    if os.path.exists(video_path):
+        return video_path
+    trajectory = load_trajectory(path)
+    stream = contour_stream(video_path, trajectory['contour'])
+    for frame in replay(trajectory):
+        stream.append(frame)
+    return stream.close()
+
+def simulator_settings(steady_cycles: int, mesh_format: str = MESH_FORMAT):
+    # everything besides the design and the object that the simulated poses depend on, binary meshes are float32
+    settings = {'sim': 'sim_test_mj_3d', 'version': SIM_VERSION, 'mujoco': mujoco.__version__, 'steady': [steady_cycles, STEADY_POS_TOL, STEADY_THETA_TOL]}
+    if mesh_format != 'obj':
+        settings['mesh'] = mesh_format
+    return settings
+
+def warmup(ctrlpts, object_name: str, model_root: str, num_warmup_rot: int = NUM_WARMUP_ROT, mesh_format: str = MESH_FORMAT):
+    """Measures the stages on the first pair of a batch, its meshes are reused by the batch."""
+    _, prepare_wall, prepare_cpu = measure(prepare_gripper, 0, ctrlpts, model_root, mesh_format)
+    prepare_object(object_name, 0, model_root)
+    scene_path = prepare_scene(0, 0, model_root)
+    _, load_wall, _ = measure(mujoco.MjModel.from_xml_path, scene_path)
+    _, step_wall, step_cpu = measure(simulate, scene_path, orientations(num_warmup_rot, [-1.0, 1.0]), list(range(num_warmup_rot)), 0, render=False, render_last=False)
+    return {'prepare_wall': prepare_wall, 'prepare_cpu': prepare_cpu, 'load_wall': load_wall, 'step_wall': step_wall - load_wall, 'step_cpu': step_cpu, 'num_warmup_rot': num_warmup_rot}
+
+def sim_test_batch_3d(ctrlpts_y, object_names, save_dir, num_cpus=32, num_rot=360, ori_range=[-1.0, 1.0], render=True, render_last=False, return_status=False, backend='auto', pool=None, record=False, steady_cycles=STEADY_CYCLES, cache=None, force_exact=False, num_threads=None, plot_mode=PLOT_MODE, mesh_format=MESH_FORMAT, pair_keys=None):
+    # tasks that miss their deadline or fail are left out, a SimulationPool keeps the workers warm and a ResultCache
+    # replaces simulating designs seen before, see sim_test_batch in sim_test_mj.py; the fingers are written as
+    # `mesh_format`, the scanned objects keep their obj files; with `pair_keys` only those pairs are simulated
     model_root = os.path.join(save_dir, 'sim_model')
     num_gripper = ctrlpts_y.shape[0]
-    ray.init(num_cpus=num_cpus, log_to_driver=False)
-    ray_tasks = []
-    for i, object_name in enumerate(object_names):
-        for idx, p_y in enumerate(ctrlpts_y):
-            p_y = p_y.reshape(-1)
-            p_y = p_y * 0.05 - 0.05     # scale p_y from [-1, 1] to [-0.1, 0]
-            ray_tasks.append(sim_test.remote(ctrlpts=p_y, object_name=object_name, gripper_idx=idx, object_idx=i, object_order_idx=i, model_root=model_root, save_dir=save_dir, gui=False, render=render, num_rot=num_rot, ori_range=ori_range, render_last=render_last))
-    gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = {}, {}, {}, {}, {}, {}, {}, {}
-    while len(ray_tasks) > 0:
-        ready, ray_tasks = ray.wait(ray_tasks, num_returns=1)
-        try:
-            if render or render_last:
-                gripper_img_path, metric, profile, profile_x, profile_y, final, video, gripper_idx, object_idx, save_gripper_dir = ray.get(ready[0])
-                gripper_imgs[object_idx * num_gripper + gripper_idx] = gripper_img_path
-                metrics[object_idx * num_gripper + gripper_idx] = metric
-                profiles[object_idx * num_gripper + gripper_idx] = profile
-                profiles_x[object_idx * num_gripper + gripper_idx] = profile_x
-                profiles_y[object_idx * num_gripper + gripper_idx] = profile_y
-                finals[object_idx * num_gripper + gripper_idx] = final
-                videos[object_idx * num_gripper + gripper_idx] = video
-                save_gripper_dirs[object_idx * num_gripper + gripper_idx] = save_gripper_dir
-            else:
-                gripper_img_path, metric, profile, profile_x, profile_y, final, gripper_idx, object_idx, save_gripper_dir = ray.get(ready[0])
-                gripper_imgs[object_idx * num_gripper + gripper_idx] = gripper_img_path
-                metrics[object_idx * num_gripper + gripper_idx] = metric
-                profiles[object_idx * num_gripper + gripper_idx] = profile
-                profiles_x[object_idx * num_gripper + gripper_idx] = profile_x
-                profiles_y[object_idx * num_gripper + gripper_idx] = profile_y
-                finals[object_idx * num_gripper + gripper_idx] = final
-                save_gripper_dirs[object_idx * num_gripper + gripper_idx] = save_gripper_dir
-        except Exception as e:
-            print(e)
+    ctrlpts = [p_y.reshape(-1) * 0.05 - 0.05 for p_y in ctrlpts_y]    # scale p_y from [-1, 1] to [-0.1, 0]
+    pairs = {i * num_gripper + idx: (i, idx) for i in range(len(object_names)) for idx in range(num_gripper) if pair_keys is None or i * num_gripper + idx in pair_keys}
+    cache_keys, cached, reused = {}, {}, set()
+    if cache is not None:
+        settings = simulator_settings(steady_cycles, mesh_format)
+        groups = [group_key(object_name, num_rot, ori_range, settings) for object_name in object_names]
+        num_reused = 0
+        for key, (i, idx) in pairs.items():
+            cache_keys[key] = design_key(ctrlpts[idx], object_names[i], num_rot, ori_range, settings)
+            entry = cache.get(cache_keys[key]) if not render else None
+            if entry is None and not render and not force_exact:
+                # a near duplicate within the cache's reuse_radius stands in for the design
+                entry = cache.nearest(groups[i], ctrlpts[idx])
+                if entry is not None:
+                    reused.add(key)
+                num_reused += entry is not None
+            if entry is not None and (not render_last or entry['frames'] is not None):
+                cached[key] = entry
+        print('result cache: %d of %d pairs cached, %d from near duplicates' % (len(cached), len(pairs), num_reused))
+    simulated = {key: pair for key, pair in pairs.items() if key not in cached}
+    # near duplicates only stand in for the poses and metrics, their gripper meshes and renders are their own; so are
+    # those of cached designs without meshes to show (entries older than the meshes kept in the cache)
+    own_gripper = {key for key, entry in cached.items() if key in reused or not os.path.exists(entry.get('save_gripper_dir') or '')}
+    executor = pool.executor(len(simulated), num_rot, backend) if pool is not None else make_executor(num_cpus, len(simulated), num_rot, backend)
+    plan = autotune('sim_test_mj_3d', lambda: warmup(ctrlpts[0], object_names[0], model_root, mesh_format=mesh_format), num_cpus, len(simulated), num_rot) if executor.parallel and len(simulated) > 0 else dict(DEFAULT_PLAN)
+
+    # finger meshes are decomposed once per gripper by multi-core tasks, objects come with their collision meshes
+    prepare_tasks = {('gripper', pairs[key][1]): (prepare_gripper, pairs[key][1], ctrlpts[pairs[key][1]], model_root, mesh_format) for key in list(simulated) + sorted(own_gripper)}
+    prepare_tasks.update({('object', i): (prepare_object, object_name, i, model_root) for i, object_name in enumerate(object_names)})
+    # assets prepared before, e.g. by the warmup, are not submitted: their no-op runtimes would shrink the deadlines
+    prepared = {key: os.path.join(model_root, 'grippers', str(key[1])) for key in prepare_tasks if key[0] == 'gripper' and os.path.exists(os.path.join(model_root, 'gripper_%d.xml' % key[1]))}
+    prepared.update({key: os.path.join(model_root, 'objects', str(key[1])) for key in prepare_tasks if key[0] == 'object' and os.path.exists(os.path.join(model_root, 'object_%d.xml' % key[1]))})
+    # prepares write the assets in place, a speculative copy would find them half written
+    decomposed, prepare_status = gather_with_deadlines(executor, lambda key: executor.submit(*prepare_tasks[key], num_cpus=plan['prepare_cpus'] if key[0] == 'gripper' else 1), [key for key in prepare_tasks.keys() if key not in prepared], max_in_flight=max(1, num_cpus // plan['prepare_cpus']), expected_runtime=lambda key: EXPECTED_PREPARE_TIME[key[0]], group=lambda key: key[0], speculate=False)
+    prepared.update(decomposed)
+    # a prepare that failed or missed its deadline leaves a partial dir behind, the next batch builds it again
+    for kind, asset_idx in prepare_status:
+        if kind == 'gripper':
+            shutil.rmtree(os.path.join(model_root, 'grippers', str(asset_idx)), ignore_errors=True)
+    status = {}
+    for key, (i, idx) in list(pairs.items()):
+        for asset in [('gripper', idx), ('object', i)]:
+            if asset in prepare_status:
+                status[key] = prepare_status[asset]
+                pairs.pop(key)
+                simulated.pop(key, None)
+                cached.pop(key, None)
+                own_gripper.discard(key)
+                break
+    scene_paths = {}
+    for key, (i, idx) in list(simulated.items()):
+        # the xmls are written by the prepares that just finished, pairs missing one fail instead of waiting for it
+        if not files_ready([os.path.join(model_root, 'gripper_%d.xml' % idx), os.path.join(model_root, 'object_%d.xml' % i)]):
+            status[key] = FAILED
+            pairs.pop(key)
+            simulated.pop(key)
+            continue
+        scene_paths[key] = prepare_scene(idx, i, model_root)
+    # object contours drawn on the videos, projected once per object
+    contours, contour_status = gather_with_deadlines(executor, lambda i: executor.submit(object_contours, model_root, i, num_rot, ori_range), sorted(set(i for i, _ in pairs.values())), max_in_flight=num_cpus, expected_runtime=EXPECTED_SETUP_TIME)
+    for key, (i, idx) in list(pairs.items()):
+        if i in contour_status:
+            status[key] = contour_status[i]
+            pairs.pop(key)
+            simulated.pop(key, None)
+            cached.pop(key, None)
+            own_gripper.discard(key)
+
+    # every pair is split into chunks of orientations, stepped by tasks of `step_threads` threads, all cpus when serial
+    step_threads = num_threads if num_threads is not None else (1 if executor.parallel else num_cpus)
+    step_cpus = max(plan['step_cpus'], step_threads)
+    z_rots = orientations(num_rot, ori_range)
+    chunks = chunk_ranges(num_rot, plan['num_chunks'])
+    chunk_size = max(stop - start for start, stop in chunks)
+    expected_runtime = plan['time_per_rot'] * chunk_size if plan['time_per_rot'] is not None else EXPECTED_SETUP_TIME + EXPECTED_TIME_PER_ROT * chunk_size
+    # rendering chunks encode their videos into video_dir, copies would write the same files
+    stepped, step_status = gather_with_deadlines(executor, lambda key: executor.submit(simulate, scene_paths[key[0]], z_rots, list(range(*chunks[key[1]])), num_videos(num_rot), False, render, render_last, num_cpus=step_cpus, record=record, steady_cycles=steady_cycles, video_dir=os.path.join(save_dir, '%d_%d' % pairs[key[0]]), contours=contours[pairs[key[0]][0]], num_threads=step_threads), [(key, chunk_idx) for key in simulated for chunk_idx in range(len(chunks))], max_in_flight=max(1, num_cpus // step_cpus), expected_runtime=expected_runtime, speculate=not render)
+    poses = {}
+    for key in simulated:
+        failed = [step_status[(key, chunk_idx)] for chunk_idx in range(len(chunks)) if (key, chunk_idx) in step_status]
+        if len(failed) > 0:
+            status[key] = failed[0]
             continue
-    ray.shutdown()
+        results = [stepped[(key, chunk_idx)] for chunk_idx in range(len(chunks))]
+        imgs = {}
+        for result in results:
+            imgs.update(result[3])
+        poses[key] = [np.concatenate([result[j] for result in results], axis=0) for j in range(3)] + [imgs]
+    for key, entry in cached.items():
+        poses[key] = [entry['init_poses'], entry['final_poses'], entry['final_final_poses'], entry['frames'] or {}]
+    gripper_dirs = {key: prepared[('gripper', pairs[key][1])] if key in simulated or key in own_gripper else cached[key]['save_gripper_dir'] for key in poses}
+
+    # renders, metrics, plots and videos
+    results, summarize_status = gather_with_deadlines(executor, lambda key: executor.submit(summarize, *poses[key], pairs[key][1], pairs[key][0], pairs[key][0], model_root, save_dir, num_rot, ori_range, render, render_last, gripper_dirs[key], record=record, scene_path=scene_paths.get(key), contours=contours[pairs[key][0]], gripper_img=cached[key]['gripper_img'] if key in cached and key not in own_gripper else None, plot_mode=plot_mode), list(poses.keys()), max_in_flight=num_cpus)
+    status.update(summarize_status)
+    if cache is not None:
+        for key in simulated:
+            if key in results:
+                # still frames of render_last and the gripper render are kept, videos and recordings are not
+                cache.put(cache_keys[key], {'init_poses': poses[key][0], 'final_poses': poses[key][1], 'final_final_poses': poses[key][2], 'frames': poses[key][3] if render_last and not render else None, 'gripper_img': cv2.imread(results[key][0])}, group=groups[pairs[key][0]], ctrlpts=ctrlpts[pairs[key][1]], save_gripper_dir=gripper_dirs[key])
+        cache.flush()
+    gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = {}, {}, {}, {}, {}, {}, {}, {}
+    for result in results.values():
+        if render or render_last:
+            gripper_img_path, metric, profile, profile_x, profile_y, final, video, gripper_idx, object_idx, save_gripper_dir = result
+            videos[object_idx * num_gripper + gripper_idx] = video
+        else:
+            gripper_img_path, metric, profile, profile_x, profile_y, final, gripper_idx, object_idx, save_gripper_dir = result
+        gripper_imgs[object_idx * num_gripper + gripper_idx] = gripper_img_path
+        metrics[object_idx * num_gripper + gripper_idx] = metric
+        profiles[object_idx * num_gripper + gripper_idx] = profile
+        profiles_x[object_idx * num_gripper + gripper_idx] = profile_x
+        profiles_y[object_idx * num_gripper + gripper_idx] = profile_y
+        finals[object_idx * num_gripper + gripper_idx] = final
+        save_gripper_dirs[object_idx * num_gripper + gripper_idx] = save_gripper_dir
+    if pool is None:
+        executor.shutdown()
     gripper_imgs = list(map(lambda x: x[1], sorted(gripper_imgs.items(), key=lambda x: x[0])))
     metrics = list(map(lambda x: x[1], sorted(metrics.items(), key=lambda x: x[0])))
     profiles = list(map(lambda x: x[1], sorted(profiles.items(), key=lambda x: x[0])))
@@ -272,6 +468,8 @@ def sim_test_batch_3d(ctrlpts_y, object_names, save_dir, num_cpus=32, num_rot=36
     save_gripper_dirs = list(map(lambda x: x[1], sorted(save_gripper_dirs.items(), key=lambda x: x[0])))
     if render or render_last:
         videos = list(map(lambda x: x[1], sorted(videos.items(), key=lambda x: x[0])))
-        return gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs
     else:
-        return gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, [], save_gripper_dirs
\ No newline at end of file
+        videos = []
+    if return_status:
+        return gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs, status
+    return gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs
\ No newline at end of file
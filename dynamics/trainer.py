@@ -50,7 +50,14 @@ class Trainer(object):
             self.model.load_state_dict(torch.load(self.ckpt_path))
         print('done')
 
-    def step(self, ctrl, score, input_ori=None, input_pos=None, object_vertices=None):
+    def compute_loss(self, pred, score, weights=None):
+        if weights is None:
+            return self.loss_fn(pred, score)
+        # per-row weights, e.g. from the fidelity tier of each sample
+        per_row = torch.mean((pred - score) ** 2, dim=-1)
+        return torch.sum(per_row * weights) / torch.clamp(torch.sum(weights), min=1e-8)
+
+    def step(self, ctrl, score, input_ori=None, input_pos=None, object_vertices=None, weights=None):
         self.model.train()
         if self.fingers_3d:
             input_ctrl_all = ctrl.repeat(self.num_timesteps_per_batch, 1, 1)  # already normalized to [-1,1]
@@ -61,6 +68,7 @@ class Trainer(object):
         input_ori_all = input_ori.repeat(self.num_timesteps_per_batch, 1)
         input_pos_all = input_pos.repeat(self.num_timesteps_per_batch, 1)
         score_all = score.repeat(self.num_timesteps_per_batch, 1)
+        weights_all = weights.repeat(self.num_timesteps_per_batch) if weights is not None else None
 
         # sample noise to add
         if self.fingers_3d:
@@ -84,7 +92,7 @@ class Trainer(object):
             for i in range(0, noisy_ctrl_all.shape[0], self.sub_batch_size):
                 pred = self.model(noisy_ctrl_all[i:i+self.sub_batch_size], input_ori_all[i:i+self.sub_batch_size], input_pos_all[i:i+self.sub_batch_size], timesteps[i:i+self.sub_batch_size], 
                 object_vertices=object_vertices_all[i:i+self.sub_batch_size])
-                loss = self.loss_fn(pred, score_all[i:i+self.sub_batch_size])
+                loss = self.compute_loss(pred, score_all[i:i+self.sub_batch_size], weights_all[i:i+self.sub_batch_size] if weights_all is not None else None)
                 all_loss += loss.item()
                 all_pred.append(pred.detach())
                 self.optimizer.zero_grad()
@@ -95,7 +103,7 @@ class Trainer(object):
             return all_loss, all_pred
         else:
             pred = self.model(noisy_ctrl_all, input_ori_all, input_pos_all, timesteps=timesteps, object_vertices=object_vertices_all)
-            loss = self.loss_fn(pred, score)
+            loss = self.compute_loss(pred, score, weights)
 
         self.optimizer.zero_grad()
         loss.backward()
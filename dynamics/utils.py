@@ -1,8 +1,17 @@
 import os
 import numpy as np
+import cv2
 from matplotlib import pyplot as plt
 import open3d as o3d
 
+# width in pixels of the raster plots, sized for wandb table thumbnails
+PLOT_SIZE = 256
+# how the simulation workers write their plots, see `plot`
+PLOT_MODES = ['raster', 'matplotlib', 'defer', 'none']
+PLOT_MODE = 'raster'
+# RGB colors of the raster plots
+PLOT_COLORS = {1: (214, 39, 40), -1: (31, 119, 180), 0: (220, 220, 220), 'axis': (128, 128, 128), 'points': (31, 119, 180)}
+
 def continuous_signed_delta(theta1, theta2):
     delta = theta2 - theta1
     if delta > np.pi:
@@ -11,6 +20,12 @@ def continuous_signed_delta(theta1, theta2):
         delta = delta + 2*np.pi
     return delta
 
+def pose_change(pose1, pose2):
+    # distance and rotation angle between two [x, y, z, qw, qx, qy, qz] poses
+    delta_pos = np.linalg.norm(pose2[:3] - pose1[:3])
+    delta_theta = 2 * np.arccos(min(1.0, abs(np.dot(pose1[3:], pose2[3:]))))
+    return delta_pos, delta_theta
+
 def sample_pts_from_mesh(mesh_file, num_points=1024):
     mesh = o3d.io.read_triangle_mesh(mesh_file)
     pcd = mesh.sample_points_uniformly(number_of_points=num_points)
@@ -77,4 +92,87 @@ def visualize_ctrlpts(ctrlpts, save_path):
     ax = f.add_subplot(212)
     ax.set(xlim=(-0.12, 0.12), ylim=(-0.045, 0.015))
     ax.scatter(ctrlpts[num_pt:, 0], ctrlpts[num_pt:, 1])
-    plt.savefig(save_path)
\ No newline at end of file
+    plt.savefig(save_path)
+    plt.close()
+
+def draw_points(canvas, rows, cols, color, radius=1):
+    # squares of 2 * radius + 1 pixels around every point, points outside the canvas are clipped
+    offsets = np.arange(-radius, radius + 1)
+    rows = np.clip(np.round(rows).astype(int)[:, None, None] + offsets[None, :, None], 0, canvas.shape[0] - 1)
+    cols = np.clip(np.round(cols).astype(int)[:, None, None] + offsets[None, None, :], 0, canvas.shape[1] - 1)
+    rows, cols = np.broadcast_arrays(rows, cols)
+    canvas[rows.reshape(-1), cols.reshape(-1)] = color
+
+def draw_frame(canvas, top, bottom, left, right, color=PLOT_COLORS['axis']):
+    canvas[[top, bottom], left:right + 1] = color
+    canvas[top:bottom + 1, [left, right]] = color
+
+def raster_profile(profile, ori_range=[-1.0, 1.0], size=PLOT_SIZE):
+    """The profile of `visualize_profile` as a (size, size, 3) RGB image: a ring colored by the sign per orientation."""
+    canvas = np.full((size, size, 3), 255, dtype=np.uint8)
+    signs = np.sign(np.asarray(profile)).astype(int)
+    theta0, theta1 = ori_range[0] * np.pi + np.pi, ori_range[1] * np.pi + np.pi
+    step = (theta1 - theta0) / max(1, len(signs) - 1)
+    rows, cols = np.mgrid[0:size, 0:size]
+    center = (size - 1) / 2
+    x, y = cols - center, center - rows
+    radius = np.hypot(x, y) / (size / 2)
+    offset = (np.arctan2(y, x) - theta0) % (2 * np.pi)
+    ids = np.round(offset / step).astype(int) if step > 0 else np.zeros_like(rows)
+    # just before the first orientation
+    ids[offset > 2 * np.pi - step / 2] = 0
+    ring = (radius > 0.55) & (radius < 0.9) & (ids < len(signs))
+    colors = np.asarray([PLOT_COLORS[-1], PLOT_COLORS[0], PLOT_COLORS[1]], dtype=np.uint8)
+    canvas[ring] = colors[signs[ids[ring]] + 1]
+    return canvas
+
+def raster_finals(finals, size=PLOT_SIZE):
+    """The final orientations of `visualize_finals` as a (0.6 * size, size, 3) RGB image, y from 0 to 2 pi."""
+    height, margin = size * 6 // 10, 4
+    canvas = np.full((height, size, 3), 255, dtype=np.uint8)
+    draw_frame(canvas, margin - 1, height - margin, margin - 1, size - margin)
+    finals = np.asarray(finals, dtype=np.float64)
+    cols = margin + np.arange(len(finals)) / max(1, len(finals) - 1) * (size - 1 - 2 * margin)
+    rows = margin + (1 - np.clip(finals / (2 * np.pi), 0, 1)) * (height - 1 - 2 * margin)
+    draw_points(canvas, rows, cols, PLOT_COLORS['points'])
+    return canvas
+
+def raster_ctrlpts(ctrlpts, size=PLOT_SIZE):
+    """The two fingers of `visualize_ctrlpts` as a (0.75 * size, size, 3) RGB image, one panel per finger."""
+    num_pt = ctrlpts.shape[0] // 2
+    panel, margin = size * 3 // 8, 4
+    canvas = np.full((2 * panel, size, 3), 255, dtype=np.uint8)
+    for i, pts in enumerate([ctrlpts[:num_pt], ctrlpts[num_pt:]]):
+        top = i * panel + margin
+        bottom = (i + 1) * panel - margin
+        draw_frame(canvas, top - 1, bottom, margin - 1, size - margin)
+        cols = margin + (pts[:, 0] + 0.12) / 0.24 * (size - 1 - 2 * margin)
+        rows = top + (0.015 - pts[:, 1]) / 0.06 * (bottom - 1 - top)
+        draw_points(canvas, rows, cols, PLOT_COLORS['points'], radius=2)
+    return canvas
+
+RASTER_PLOTS = {'profile': raster_profile, 'finals': raster_finals, 'ctrlpts': raster_ctrlpts}
+MATPLOTLIB_PLOTS = {'profile': visualize_profile, 'finals': visualize_finals, 'ctrlpts': visualize_ctrlpts}
+
+def deferred_path(save_path):
+    return os.path.splitext(save_path)[0] + '_plot.npz'
+
+def plot(kind, data, save_path, mode=PLOT_MODE, **kwargs):
+    """
+    Writes the `kind` plot ('profile', 'finals' or 'ctrlpts') of `data` to `save_path`: drawn into a small image
+    ('raster'), with matplotlib ('matplotlib'), kept next to it to be drawn by `draw_deferred` ('defer') or skipped ('none').
+    """
+    if mode == 'raster':
+        cv2.imwrite(save_path, RASTER_PLOTS[kind](data, **kwargs)[..., ::-1])
+    elif mode == 'matplotlib':
+        MATPLOTLIB_PLOTS[kind](data, save_path, **kwargs)
+    elif mode == 'defer':
+        np.savez(deferred_path(save_path), kind=kind, data=np.asarray(data), **{k: np.asarray(v) for k, v in kwargs.items()})
+
+def draw_deferred(save_path):
+    """Draws the raster plot deferred to `save_path`, returns whether the plot exists."""
+    if not os.path.exists(save_path) and os.path.exists(deferred_path(save_path)):
+        deferred = dict(np.load(deferred_path(save_path)))
+        kind, data = str(deferred.pop('kind')), deferred.pop('data')
+        cv2.imwrite(save_path, RASTER_PLOTS[kind](data, **{k: v.tolist() for k, v in deferred.items()})[..., ::-1])
+    return os.path.exists(save_path)
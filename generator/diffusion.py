@@ -19,9 +19,16 @@ from diffusers.training_utils import EMAModel
 from diffusers import UNet2DModel
 
 from generator.diffusion_utils import ConditionalUnet1D
-from dynamics.sim_test_mj import sim_test_batch
-from dynamics.sim_test_mj_3d import sim_test_batch_3d
-from dynamics.metrics import metric2objective, convergence_mode_three_class, slicer
+from dynamics.sim_test_mj import sim_test_batch, render_trajectory
+from dynamics.sim_test_mj_3d import sim_test_batch_3d, render_trajectory_3d
+from dynamics.metrics import metric2objective, best_design_ids, convergence_mode_three_class, slicer
+from dynamics.utils import draw_deferred
+from sim.asset_store import AssetStore
+from sim.campaign import EvaluationCampaign
+from sim.pool import SimulationPool
+from sim.result_cache import ResultCache
+from sim.results_db import ResultsDB
+from sim.replay import render_recorded
 
 NoiseScheduler = Union[DDPMScheduler, DDIMScheduler]
 NoiseSchedulerOutput = Union[DDPMSchedulerOutput, DDIMSchedulerOutput]
@@ -31,6 +38,7 @@ SCALE_2D = 0.001
 SCALE_2D_CONV = 10.0
 SCALE_3D = 0.5
 SCALE_3D_CONV = 0.8
+OPT_OBJS = ['convergence', 'shift_up', 'shift_down', 'shift_left', 'shift_right', 'rotate_clockwise', 'rotate_counterclockwise', 'rotate', 'clockwise_up', 'clockwise_left', 'counterclockwise_up', 'counterclockwise_left']
 
 class Diffusion(LightningModule):
     def __init__(
@@ -63,6 +71,13 @@ class Diffusion(LightningModule):
         pts_z_dim: int = 3,
         render_video: bool = False,
         seed: int = 0,
+        asset_budget_gb: Optional[float] = None,
+        sim_backend: str = 'auto',
+        result_cache_dir: Optional[str] = None,
+        reuse_radius: float = 0.0,
+        plot_mode: str = 'raster',
+        results_db: Optional[str] = None,
+        mesh_format: str = 'obj',
     ):
         super().__init__()
         if os.environ.get("TORCH_COMPILE", "0") == "0":
@@ -103,6 +118,23 @@ class Diffusion(LightningModule):
         self.noise_scheduler.set_timesteps(self.num_inference_steps)
         self.class_cond = class_cond
         self.seed = seed
+        # disk budget of the archived validation assets, None keeps the loose files
+        self.asset_budget_gb = asset_budget_gb
+        self.sim_backend = sim_backend
+        # simulation workers and decomposed objects shared by all validation batches, started on first use
+        self.sim_pool = None
+        # simulated poses of designs seen before, shared across runs, <save_dir>/result_cache by default
+        self.result_cache_dir = result_cache_dir
+        # designs this close (rms of the control points) to a cached one reuse its results, 0 simulates every design
+        self.reuse_radius = reuse_radius
+        # how the simulation workers write their plots, 'defer' draws them here for the logged designs only
+        self.plot_mode = plot_mode
+        self.sim_results = None
+        # sqlite file every validation adds its evaluated designs to, shared across runs, None keeps none
+        self.results_db = results_db
+        self.evaluations = None
+        # file format of the finger meshes written for the simulations, see assets/mesh_io.py
+        self.mesh_format = mesh_format
         if class_cond:
             self.classifier_model = classifier_model
             self.grid_size = grid_size
@@ -299,37 +331,53 @@ class Diffusion(LightningModule):
                     raise ValueError('object vertices not provided')
                 # unguided sample
                 ori_ranges = [[-1.0, 1.0]]
-                if True:
-                    print("getting videos")
-                    num_objects = len(self.object_ids)
-                    num_grippers = noise_sample.shape[0]
-                    if self.mode == "point_3d":
-                        gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, _ = sim_test_batch_3d(noise_sample.cpu().numpy(), self.object_ids, os.path.join(self.logger.save_dir, 'val_vis_noise'), render=self.render_video, num_cpus=self.num_cpus)
-                        imgs_all = gripper_imgs
-                    else:
-                        _, metrics, profiles, profiles_x, profiles_y, finals, videos, _ = sim_test_batch(noise_sample.cpu().numpy(), self.object_ids, os.path.join(self.logger.save_dir, 'val_vis_noise'), render=self.render_video, num_cpus=self.num_cpus)
-                        imgs_all = [imgs[idx] for _ in range(num_objects) for idx in range(len(imgs))]
-                    print("video done")
-                for opt_obj in ['convergence', 'shift_up', 'shift_down', 'shift_left', 'shift_right', 'rotate_clockwise', 'rotate_counterclockwise', 'rotate', 'clockwise_up', 'clockwise_left', 'counterclockwise_up', 'counterclockwise_left']:
-                    for ori_range in ori_ranges:
-                        if True:
-                            metrics_unguided = [{k: metric[k][int((ori_range[0]+1)*6):int((ori_range[1]+1)*6)] for k in metric.keys()} for metric in metrics]
-                            objectives_unguided = [metric2objective(metric, opt_obj) for metric in metrics_unguided]
-                            print('objectives_unguided', len(objectives_unguided))
-                            average_objectives = {k: np.mean([objective[k] for objective in objectives_unguided]) for k in objectives_unguided[0].keys()}
+                num_objects = len(self.object_ids)
+                num_grippers = noise_sample.shape[0]
+                campaign = self.evaluation_campaign(batch_idx)
+                unguided_units = campaign.request(noise_sample.cpu().numpy(), self.object_ids, render=self.render_video)
+                campaign.submit()
+                # the guided samples are denoised while the simulations of the samples before them run
+                guided_units = {}
+                for opt_obj in OPT_OBJS:
+                    for ori_idx, ori_range in enumerate(ori_ranges):
+                        if opt_obj != 'convergence':
+                            guided_units[(opt_obj, ori_idx, 'allobj')] = self.guided_sample_multi_object(batch_idx, batch_size, noise, self.logger.save_dir, opt_obj=opt_obj, ori_range=ori_range, campaign=campaign)
+                        guided_units[(opt_obj, ori_idx, 'guided')] = self.guided_sample(batch_idx, batch_size, noise, self.logger.save_dir, opt_obj=opt_obj, ori_range=ori_range, unguided_sample=noise_sample, campaign=campaign)
+                print("getting videos")
+                gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, _ = campaign.result(unguided_units)
+                if self.mode == "point_3d":
+                    imgs_all = gripper_imgs
+                else:
+                    imgs_all = [imgs[idx] for _ in range(num_objects) for idx in range(len(imgs))]
+                # pairs that failed or missed their deadline are None, rows keep the unit index of object x gripper
+                finished = [i for i, metric in enumerate(metrics) if metric is not None]
+                print("video done")
+                for opt_obj in OPT_OBJS:
+                    for ori_idx, ori_range in enumerate(ori_ranges):
+                        if len(finished) > 0:
+                            metrics_unguided = [None if metric is None else {k: metric[k][int((ori_range[0]+1)*6):int((ori_range[1]+1)*6)] for k in metric.keys()} for metric in metrics]
+                            objectives_unguided = [None if metric is None else metric2objective(metric, opt_obj) for metric in metrics_unguided]
+                            print('objectives_unguided', len(finished))
+                            objective_keys = objectives_unguided[finished[0]].keys()
+                            average_objectives = {k: np.mean([objectives_unguided[i][k] for i in finished]) for k in objective_keys}
                             all_best_ids = self.get_best_ids(objectives_unguided, num_grippers, num_objects, opt_obj=opt_obj)
-                            objectives_best = [{k: objectives_unguided[best_ids[k]][k] for k in objectives_unguided[0].keys()} for best_ids in all_best_ids]
-                            average_best_objectives = {k: np.mean([objectives_best[i][k] for i in range(len(objectives_best))]) for k in objectives_best[0].keys()}
-                            average_obj_objectives = [{k: np.mean([objectives_unguided[i*num_grippers+idx][k] for i in range(num_objects)]) for k in objectives_unguided[0].keys()} for idx in range(num_grippers)]
-                            best_average_obj_ids = self.get_average_best_ids(average_obj_objectives, opt_obj=opt_obj)
+                            objectives_best = [{k: objectives_unguided[best_ids[k]][k] for k in objective_keys} for best_ids in all_best_ids]
+                            average_best_objectives = {k: np.mean([objectives_best[i][k] for i in range(len(objectives_best))]) for k in objective_keys}
+                            # grippers are averaged over the objects only when they finished on all of them
+                            complete = [idx for idx in range(num_grippers) if all(objectives_unguided[i*num_grippers+idx] is not None for i in range(num_objects))]
+                            average_obj_objectives = {idx: {k: np.mean([objectives_unguided[i*num_grippers+idx][k] for i in range(num_objects)]) for k in objective_keys} for idx in complete}
+                            best_average_obj_ids = complete[self.get_average_best_ids([average_obj_objectives[idx] for idx in complete], opt_obj=opt_obj)] if len(complete) > 0 else None
+                            # only the designs picked as best are replayed into videos and get deferred plots drawn
+                            shown = set([finished[0]] + [best_ids[k] for best_ids in all_best_ids for k in best_ids.keys()])
                             if self.render_video:
+                                rendered = [self.render_videos(video) if i in shown else [] for i, video in enumerate(videos)]
                                 self.logger.log_table(
                                     key = "val/unguided_sample/%s_orirange=%.3f_%.3f" % (opt_obj, ori_range[0], ori_range[1]),
                                     columns = ["object_idx", "gripper_idx", "gripper", "objective", "profile", "profile_x", "profile_y", "final", "video"],
-                                    data = [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in videos[0]]]] 
-                                    + [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_best_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in videos[0]]]] 
-                                    + [[-1, best_average_obj_ids, wandb.Image(imgs[best_average_obj_ids]), average_obj_objectives[best_average_obj_ids], wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in videos[0]]]]
-                                    + [[i // num_grippers, i % num_grippers, wandb.Image(gripper), objective, wandb.Image(profile), wandb.Image(profile_x), wandb.Image(profile_y), wandb.Image(final), [wandb.Video(v) for v in video[int((ori_range[0]+1)*5):int((ori_range[1]+1)*5)]]] for i, (gripper, objective, profile, profile_x, profile_y, final, video) in enumerate(zip(imgs_all, objectives_unguided, profiles, profiles_x, profiles_y, finals, videos))],
+                                    data = [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in rendered[finished[0]]]]] 
+                                    + [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_best_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in rendered[finished[0]]]]] 
+                                    + ([[-1, best_average_obj_ids, wandb.Image(imgs[best_average_obj_ids]), average_obj_objectives[best_average_obj_ids], wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in rendered[finished[0]]]]] if best_average_obj_ids is not None else [])
+                                    + [[i // num_grippers, i % num_grippers, wandb.Image(gripper), objective, wandb.Image(self.plot_image(profile, i in shown)), wandb.Image(self.plot_image(profile_x, i in shown)), wandb.Image(self.plot_image(profile_y, i in shown)), wandb.Image(self.plot_image(final, i in shown)), [wandb.Video(v) for v in video[int((ori_range[0]+1)*5):int((ori_range[1]+1)*5)]]] for i, (gripper, objective, profile, profile_x, profile_y, final, video) in enumerate(zip(imgs_all, objectives_unguided, profiles, profiles_x, profiles_y, finals, rendered)) if objective is not None],
                                 )
                             else:
                                 self.logger.log_table(
@@ -337,12 +385,69 @@ class Diffusion(LightningModule):
                                     columns = ["object_idx", "gripper_idx", "gripper", "objective", "profile", "profile_x", "profile_y", "final"],
                                     data = [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3)))]] 
                                     + [[-1, -1, wandb.Image(255*np.ones((128, 128, 3))), average_best_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3)))]] 
-                                    + [[-1, best_average_obj_ids, wandb.Image(imgs[best_average_obj_ids]), average_obj_objectives[best_average_obj_ids], wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3)))]]
-                                    + [[i // num_grippers, i % num_grippers, wandb.Image(gripper), objective, wandb.Image(profile), wandb.Image(profile_x), wandb.Image(profile_y), wandb.Image(final)] for i, (gripper, objective, profile, profile_x, profile_y, final) in enumerate(zip(imgs_all, objectives_unguided, profiles, profiles_x, profiles_y, finals))],
+                                    + ([[-1, best_average_obj_ids, wandb.Image(imgs[best_average_obj_ids]), average_obj_objectives[best_average_obj_ids], wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3)))]] if best_average_obj_ids is not None else [])
+                                    + [[i // num_grippers, i % num_grippers, wandb.Image(gripper), objective, wandb.Image(self.plot_image(profile, i in shown)), wandb.Image(self.plot_image(profile_x, i in shown)), wandb.Image(self.plot_image(profile_y, i in shown)), wandb.Image(self.plot_image(final, i in shown))] for i, (gripper, objective, profile, profile_x, profile_y, final) in enumerate(zip(imgs_all, objectives_unguided, profiles, profiles_x, profiles_y, finals)) if objective is not None],
                                 )
                         if opt_obj != 'convergence':
-                            self.guided_sample_multi_object(batch_idx, batch_size, noise, self.logger.save_dir, opt_obj=opt_obj, ori_range=ori_range)
-                        self.guided_sample(batch_idx, batch_size, noise, self.logger.save_dir, opt_obj=opt_obj, ori_range=ori_range, unguided_sample=noise_sample)
+                            self.log_guided_sample_multi_object(campaign, guided_units[(opt_obj, ori_idx, 'allobj')], opt_obj=opt_obj, ori_range=ori_range)
+                        self.log_guided_sample(campaign, guided_units[(opt_obj, ori_idx, 'guided')], opt_obj=opt_obj, ori_range=ori_range)
+                campaign.shutdown()
+            self.archive_assets()
+
+    def simulation_pool(self):
+        if self.sim_pool is None:
+            self.sim_pool = SimulationPool(self.num_cpus, os.path.join(self.logger.save_dir, 'sim_objects'), backend=self.sim_backend)
+        return self.sim_pool
+
+    def result_cache(self):
+        if self.sim_results is None:
+            self.sim_results = ResultCache(self.result_cache_dir if self.result_cache_dir is not None else os.path.join(self.logger.save_dir, 'result_cache'), reuse_radius=self.reuse_radius)
+        return self.sim_results
+
+    def evaluation_campaign(self, batch_idx):
+        """The simulations of the samples of one validation batch, batched per object and settings."""
+        batch_fn = sim_test_batch_3d if self.mode == 'point_3d' else sim_test_batch
+        save_dir = os.path.join(self.logger.save_dir, 'vis_campaign', '%d_%d' % (self.current_epoch, batch_idx))
+        # pyplot is not thread safe, matplotlib plots are drawn by the batches in this process
+        return EvaluationCampaign(batch_fn, save_dir, background=(self.plot_mode != 'matplotlib'), results=self.evaluation_db(), run=os.path.basename(os.path.normpath(self.logger.save_dir)), epoch=self.current_epoch, num_cpus=self.num_cpus, backend=self.sim_backend, pool=self.simulation_pool(), record=True, cache=self.result_cache(), plot_mode=self.plot_mode, mesh_format=self.mesh_format)
+
+    def evaluation_db(self):
+        if self.evaluations is None and self.results_db is not None:
+            self.evaluations = ResultsDB(self.results_db)
+        return self.evaluations
+
+    def guided_settings(self, ori_range):
+        return dict(num_rot=int((ori_range[1]-ori_range[0])*6), ori_range=ori_range, render=self.render_video, render_last=(not self.render_video))
+
+    def render_videos(self, trajectories):
+        """Replays recorded trajectories into videos, a trajectory already replayed is not rendered again."""
+        render_fn = render_trajectory_3d if self.mode == 'point_3d' else render_trajectory
+        return render_recorded(trajectories, render_fn, self.simulation_pool().executor(len(trajectories), 1), max_in_flight=self.num_cpus)
+
+    def plot_image(self, path, shown=True):
+        """The image logged for a plot written by the simulation, drawn now if deferred and shown, blank if missing."""
+        if os.path.exists(path) or (shown and draw_deferred(path)):
+            return path
+        return 255*np.ones((128, 128, 3))
+
+    def teardown(self, stage):
+        if self.sim_pool is not None:
+            self.sim_pool.shutdown()
+            self.sim_pool = None
+        if self.evaluations is not None:
+            self.evaluations.close()
+            self.evaluations = None
+
+    def archive_assets(self):
+        """Packs the meshes, plots and videos of this validation into one archive of the asset store."""
+        if self.asset_budget_gb is None:
+            return
+        store = AssetStore(os.path.join(self.logger.save_dir, 'asset_store'), budget_bytes=int(self.asset_budget_gb * 2**30))
+        archive = 'epoch%04d' % self.current_epoch
+        dirs = [os.path.join(self.logger.save_dir, d) for d in ['val_vis', 'val_vis_noise', 'vis_guided', 'vis_campaign']]
+        if store.pack(archive, dirs, self.logger.save_dir) is not None and self.evaluation_db() is not None:
+            # the artifacts of the evaluations are only in the archive from now on
+            self.evaluations.archive_artifacts(dirs, archive, self.logger.save_dir)
 
     def clean_grad(self):
         for param in self.classifier_model.parameters():
@@ -350,10 +455,14 @@ class Diffusion(LightningModule):
                 param.grad.zero_()
 
     def get_best_ids(self, objectives_unguided, num_grippers, num_objects, opt_obj='rotate'):
+        """The best unit per metric of every object among the grippers that finished on it, None objectives are skipped."""
         all_best_ids = []
         for idx in range(num_objects):
-            best_ids = self.get_best_ids_all_metrics([objectives_unguided[i] for i in range(idx*num_grippers, (idx+1)*num_grippers)], opt_obj=opt_obj)
-            best_ids = {k: v+idx*num_grippers for k, v in best_ids.items()}
+            ids = [i for i in range(idx*num_grippers, (idx+1)*num_grippers) if objectives_unguided[i] is not None]
+            if len(ids) == 0:
+                continue
+            best_ids = self.get_best_ids_all_metrics([objectives_unguided[i] for i in ids], opt_obj=opt_obj)
+            best_ids = {k: ids[v] for k, v in best_ids.items()}
             all_best_ids.append(best_ids)
         return all_best_ids
 
@@ -395,43 +504,7 @@ class Diffusion(LightningModule):
         return best_ids
 
     def get_best_ids_all_metrics(self, objectives, opt_obj='rotate'):
-        if opt_obj == 'rotate' or opt_obj == 'rotate_in_place':
-            best_ids = {'num_zero_classes': np.argmin([objective['num_zero_classes'] for objective in objectives]), 'delta_theta_abs': np.argmax([objective['delta_theta_abs'] for objective in objectives]), 'final_delta_theta_abs': np.argmax([objective['final_delta_theta_abs'] for objective in objectives])}
-        elif opt_obj == 'rotate_clockwise':
-            best_ids = {'num_clockwise_classes': np.argmax([objective['num_clockwise_classes'] for objective in objectives]), 'delta_theta': np.argmin([objective['delta_theta'] for objective in objectives]),'final_delta_theta': np.argmin([objective['final_delta_theta'] for objective in objectives])}
-        elif opt_obj == 'rotate_counterclockwise':
-            best_ids = {'num_counterclockwise_classes': np.argmax([objective['num_counterclockwise_classes'] for objective in objectives]), 'delta_theta': np.argmax([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmax([objective['final_delta_theta'] for objective in objectives])}
-        elif opt_obj == 'shift_up':
-            best_ids = {'num_up_classes': np.argmax([objective['num_up_classes'] for objective in objectives]), 'delta_pos_x': np.argmin([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmin([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'shift_down':
-            best_ids = {'num_down_classes': np.argmax([objective['num_down_classes'] for objective in objectives]), 'delta_pos_x': np.argmax([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmax([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'shift_left':
-            best_ids = {'num_left_classes': np.argmax([objective['num_left_classes'] for objective in objectives]), 'delta_pos_y': np.argmin([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmin([objective['final_pos_y'] for objective in objectives])}
-        elif opt_obj == 'shift_right':
-            best_ids = {'num_right_classes': np.argmax([objective['num_right_classes'] for objective in objectives]), 'delta_pos_y': np.argmax([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmax([objective['final_pos_y'] for objective in objectives])}
-        elif opt_obj == 'convergence':
-            best_ids = {'max_convergence_range_3deg': np.argmax([objective['max_convergence_range_3deg'] for objective in objectives]),'max_convergence_range_5deg': np.argmax([objective['max_convergence_range_5deg'] for objective in objectives]), 'max_convergence_range_10deg': np.argmax([objective['max_convergence_range_10deg'] for objective in objectives])}
-        elif opt_obj == 'clockwise_up':
-            best_ids = {'num_clockwise_up_classes': np.argmax([objective['num_clockwise_up_classes'] for objective in objectives]), 'num_clockwise_classes': np.argmax([objective['num_clockwise_classes'] for objective in objectives]), 'delta_theta': np.argmin([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmin([objective['final_delta_theta'] for objective in objectives]), 'num_up_classes': np.argmax([objective['num_up_classes'] for objective in objectives]), 'delta_pos_x': np.argmin([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmin([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'clockwise_down':
-            best_ids = {'num_clockwise_down_classes': np.argmax([objective['num_clockwise_down_classes'] for objective in objectives]), 'num_clockwise_classes': np.argmax([objective['num_clockwise_classes'] for objective in objectives]), 'delta_theta': np.argmin([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmin([objective['final_delta_theta'] for objective in objectives]), 'num_down_classes': np.argmax([objective['num_down_classes'] for objective in objectives]), 'delta_pos_x': np.argmax([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmax([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'clockwise_left':
-            best_ids = {'num_clockwise_left_classes': np.argmax([objective['num_clockwise_left_classes'] for objective in objectives]), 'num_clockwise_classes': np.argmax([objective['num_clockwise_classes'] for objective in objectives]), 'delta_theta': np.argmin([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmin([objective['final_delta_theta'] for objective in objectives]), 'num_left_classes': np.argmax([objective['num_left_classes'] for objective in objectives]), 'delta_pos_y': np.argmin([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmin([objective['final_pos_y'] for objective in objectives])}
-        elif opt_obj == 'clockwise_right':
-            best_ids = {'num_clockwise_right_classes': np.argmax([objective['num_clockwise_right_classes'] for objective in objectives]), 'num_clockwise_classes': np.argmax([objective['num_clockwise_classes'] for objective in objectives]), 'delta_theta': np.argmin([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmin([objective['final_delta_theta'] for objective in objectives]), 'num_right_classes': np.argmax([objective['num_right_classes'] for objective in objectives]), 'delta_pos_y': np.argmax([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmax([objective['final_pos_y'] for objective in objectives])}
-        elif opt_obj == 'counterclockwise_up':
-            best_ids = {'num_counterclockwise_up_classes': np.argmax([objective['num_counterclockwise_up_classes'] for objective in objectives]), 'num_counterclockwise_classes': np.argmax([objective['num_counterclockwise_classes'] for objective in objectives]), 'delta_theta': np.argmax([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmax([objective['final_delta_theta'] for objective in objectives]), 'num_up_classes': np.argmax([objective['num_up_classes'] for objective in objectives]), 'delta_pos_x': np.argmin([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmin([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'counterclockwise_down':
-            best_ids = {'num_counterclockwise_down_classes': np.argmax([objective['num_counterclockwise_down_classes'] for objective in objectives]), 'num_counterclockwise_classes': np.argmax([objective['num_counterclockwise_classes'] for objective in objectives]), 'delta_theta': np.argmax([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmax([objective['final_delta_theta'] for objective in objectives]), 'num_down_classes': np.argmax([objective['num_down_classes'] for objective in objectives]), 'delta_pos_x': np.argmax([objective['delta_pos_x'] for objective in objectives]), 'final_pos_x': np.argmax([objective['final_pos_x'] for objective in objectives])}
-        elif opt_obj == 'counterclockwise_left':
-            best_ids = {'num_counterclockwise_left_classes': np.argmax([objective['num_counterclockwise_left_classes'] for objective in objectives]), 'num_counterclockwise_classes': np.argmax([objective['num_counterclockwise_classes'] for objective in objectives]), 'delta_theta': np.argmax([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmax([objective['final_delta_theta'] for objective in objectives]), 'num_left_classes': np.argmax([objective['num_left_classes'] for objective in objectives]), 'delta_pos_y': np.argmin([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmin([objective['final_pos_y'] for objective in objectives])}
-        elif opt_obj == 'counterclockwise_right':
-            best_ids = {'num_counterclockwise_right_classes': np.argmax([objective['num_counterclockwise_right_classes'] for objective in objectives]), 'num_counterclockwise_classes': np.argmax([objective['num_counterclockwise_classes'] for objective in objectives]), 'delta_theta': np.argmax([objective['delta_theta'] for objective in objectives]), 'final_delta_theta': np.argmax([objective['final_delta_theta'] for objective in objectives]), 'num_right_classes': np.argmax([objective['num_right_classes'] for objective in objectives]), 'delta_pos_y': np.argmax([objective['delta_pos_y'] for objective in objectives]), 'final_pos_y': np.argmax([objective['final_pos_y'] for objective in objectives])}
-        else:
-            raise ValueError('opt obj not supported')
-        if opt_obj != 'convergence':
-            best_ids['success_rate'] = np.argmax([objective['success_rate'] for objective in objectives])
-        return best_ids
+        return best_design_ids(objectives, opt_obj)
     
     def deltas_to_objective(self, deltas, opt_obj, centers=None):
         if opt_obj == 'rotate':
@@ -544,14 +617,15 @@ class Diffusion(LightningModule):
         max_length_centers = torch.stack(max_length_centers, dim=0)
         return max_length_centers
 
-    def guided_sample(self, batch_idx, batch_size, noise, save_dir, opt_obj='rotate', ori_range=[-1.0, 1.0], unguided_sample=None):
-        all_imgs = []
-        all_objectives = []
-        all_profiles = []
-        all_finals = []
-        all_videos = []
-        all_gripper_dirs = []
-        num_objects = len(self.object_ids)
+    def guided_sample(self, batch_idx, batch_size, noise, save_dir, opt_obj='rotate', ori_range=[-1.0, 1.0], unguided_sample=None, campaign=None):
+        """
+        Samples guided towards `opt_obj` for every object and requests their simulations from `campaign`, returns the
+        units of the requests for log_guided_sample. Without a campaign they are simulated and logged here.
+        """
+        own_campaign = campaign is None
+        if own_campaign:
+            campaign = self.evaluation_campaign(batch_idx)
+        all_units = []
         if self.mode == 'point':
             if opt_obj == 'convergence':
                 classifier_scale = SCALE_2D_CONV
@@ -571,8 +645,6 @@ class Diffusion(LightningModule):
             else:
                 convergence_centers = None
             object_idx = self.object_ids[idx]
-            result_save_dir = os.path.join(save_dir, 'vis_guided', '%s_orirange=%.3f_%.3f' % (opt_obj, ori_range[0], ori_range[1]))
-            os.makedirs(result_save_dir, exist_ok=True)
             sample = noise.clone().detach()    # noise, (B, num_points, input_dim) / (B, input_dim, H, W)
             for i, t in enumerate(self.noise_scheduler.timesteps):
                 timesteps = t * torch.ones((batch_size,), dtype=torch.int64, device=sample.device)
@@ -580,12 +652,28 @@ class Diffusion(LightningModule):
                 grad = self.cond_fn(sample, timesteps, opt_obj=opt_obj, object_vertices=obj_vertices, ori_range=ori_range, convergence_centers=convergence_centers)    # (B, num_points, input_dim)
                 noise_pred = noise_pred - (1 - self.noise_scheduler.alphas_cumprod[t]).sqrt() * grad * classifier_scale
                 sample = self.noise_scheduler.step(noise_pred, t, sample).prev_sample
-            if self.mode == "point_3d":
-                gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = sim_test_batch_3d(sample.cpu().numpy(), [object_idx], os.path.join(result_save_dir, str(object_idx)), render=self.render_video, num_cpus=self.num_cpus, num_rot=int((ori_range[1]-ori_range[0])*6), ori_range=ori_range, render_last=(not self.render_video))
-            else:
-                gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = sim_test_batch(sample.cpu().numpy(), [object_idx], os.path.join(result_save_dir, str(object_idx)), render=self.render_video, num_cpus=self.num_cpus, num_rot=int((ori_range[1]-ori_range[0])*6), ori_range=ori_range, render_last=(not self.render_video))
-            if len(metrics) == 0:
+            all_units.append(campaign.request(sample.cpu().numpy(), [object_idx], **self.guided_settings(ori_range)))
+        campaign.submit()
+        if not own_campaign:
+            return all_units
+        self.log_guided_sample(campaign, all_units, opt_obj=opt_obj, ori_range=ori_range)
+        campaign.shutdown()
+
+    def log_guided_sample(self, campaign, all_units, opt_obj='rotate', ori_range=[-1.0, 1.0]):
+        all_imgs = []
+        all_objectives = []
+        all_profiles = []
+        all_finals = []
+        all_videos = []
+        all_gripper_dirs = []
+        logged_objects = []
+        for object_order_idx, units in enumerate(all_units):
+            outputs = campaign.result(units)
+            # the designs that finished on this object, the best of them are logged
+            finished = [i for i, metric in enumerate(outputs[1]) if metric is not None]
+            if len(finished) == 0:
                 continue
+            gripper_imgs, metrics, profiles, profiles_x, profiles_y, finals, videos, save_gripper_dirs = [[output[i] for i in finished] for output in outputs]
             objectives = [metric2objective(metric, opt_obj) for metric in metrics]
             if opt_obj == 'rotate' or opt_obj == 'rotate_clockwise' or opt_obj == 'rotate_counterclockwise' or opt_obj == 'convergence' or opt_obj == 'clockwise_up' or opt_obj == 'clockwise_down' or opt_obj == 'clockwise_left' or opt_obj == 'clockwise_right' or opt_obj == 'counterclockwise_up' or opt_obj == 'counterclockwise_down' or opt_obj == 'counterclockwise_left' or opt_obj == 'counterclockwise_right':
                 obj_profiles = profiles
@@ -597,10 +685,12 @@ class Diffusion(LightningModule):
                 raise ValueError('opt obj not supported')
             best_ids_all_metrics = self.get_best_ids_all_metrics(objectives, opt_obj=opt_obj)
             best_objectives = {k: objectives[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
-            best_imgs = {k: gripper_imgs[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
-            best_profiles = {k: obj_profiles[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
-            best_finals = {k: finals[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
+            best_imgs = {k: self.plot_image(gripper_imgs[best_ids_all_metrics[k]]) for k in best_ids_all_metrics.keys()}
+            best_profiles = {k: self.plot_image(obj_profiles[best_ids_all_metrics[k]]) for k in best_ids_all_metrics.keys()}
+            best_finals = {k: self.plot_image(finals[best_ids_all_metrics[k]]) for k in best_ids_all_metrics.keys()}
             best_videos = {k: videos[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
+            if self.render_video:
+                best_videos = {k: self.render_videos(v) for k, v in best_videos.items()}
             best_gripper_dirs = {k: save_gripper_dirs[best_ids_all_metrics[k]] for k in best_ids_all_metrics.keys()}
             all_videos.append(best_videos)
             all_imgs.append(best_imgs)
@@ -608,32 +698,38 @@ class Diffusion(LightningModule):
             all_profiles.append(best_profiles)
             all_finals.append(best_finals)
             all_gripper_dirs.append(best_gripper_dirs)
+            logged_objects.append(object_order_idx)
+        if len(all_objectives) == 0:
+            print('guided sample %s: no design finished' % opt_obj)
+            return
         average_best_objectives = {k: np.mean([objective[k][k] for objective in all_objectives]) for k in all_objectives[0].keys()}
         if self.render_video:
             self.logger.log_table(
                 key = "val/guided_sample/%s_orirange=%.3f_%.3f" % (opt_obj, ori_range[0], ori_range[1]),
                 columns = ["object_idx", "gripper", "objective", "profile", "final", "video", "gripper_dir"],
                 data = [[-1, wandb.Image(255*np.ones((128, 128, 3))),  average_best_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Video(v) for v in all_videos[0][all_objectives[0].keys()[0]]], ""]] 
-                + [[i, wandb.Image(all_imgs[i][k]), all_objectives[i][k], wandb.Image(all_profiles[i][k]), wandb.Image(all_finals[i][k]), [wandb.Video(v) for v in all_videos[i][k]], all_gripper_dirs[i][k]] for i in range(num_objects) for k in all_objectives[i].keys()],
+                + [[logged_objects[i], wandb.Image(all_imgs[i][k]), all_objectives[i][k], wandb.Image(all_profiles[i][k]), wandb.Image(all_finals[i][k]), [wandb.Video(v) for v in all_videos[i][k]], all_gripper_dirs[i][k]] for i in range(len(all_objectives)) for k in all_objectives[i].keys()],
             )
         else:
             self.logger.log_table(
                 key = "val/guided_sample/%s_orirange=%.3f_%.3f" % (opt_obj, ori_range[0], ori_range[1]),
                 columns = ["object_idx", "gripper", "objective", "profile", "final", "last_img", "gripper_dir"],
                 data = [[-1, wandb.Image(255*np.ones((128, 128, 3))),  average_best_objectives, wandb.Image(255*np.ones((128, 128, 3))), wandb.Image(255*np.ones((128, 128, 3))), [wandb.Image(255*np.ones((128, 128, 3)))], ""]]
-                + [[i, wandb.Image(all_imgs[i][k]), all_objectives[i][k], wandb.Image(all_profiles[i][k]), wandb.Image(all_finals[i][k]), [wandb.Image(img) for img in all_videos[i][k]], all_gripper_dirs[i][k]] for i in range(num_objects) for k in all_objectives[i].keys()],
+                + [[logged_objects[i], wandb.Image(all_imgs[i][k]), all_objectives[i][k], wandb.Image(all_profiles[i][k]), wandb.Image(all_finals[i][k]), [wandb.Image(img) for img in all_videos[i][k]], all_gripper_dirs[i][k]] for i in range(len(all_objectives)) for k in all_objectives[i].keys()],
             ) 
 
-    def guided_sample_multi_object(self, batch_idx, batch_size, noise, save_dir, opt_obj='rotate', ori_range=[-1.0, 1.0]):
+    def guided_sample_multi_object(self, batch_idx, batch_size, noise, save_dir, opt_obj='rotate', ori_range=[-1.0, 1.0], campaign=None):
+        """
+        Samples guided towards `opt_obj` on all objects at once and requests every sample on every object from
+        `campaign`, returns the units of the requests for log_guided_sample_multi_object. Without a campaign they are
+        simulated and logged here.
+        """
+        own_campaign = campaign is None
+        if own_campaign:
+            campaign = self.evaluation_campaign(batch_idx)
         result_save_dir = os.path.join(save_dir, 'vis_guided', '%s_orirange=%.3f_%.3f' % (opt_obj, ori_range[0], ori_range[1]))
         os.makedirs(result_save_dir, exist_ok=True)
         sample = noise.clone().detach()
-        num_objects = len(self.object_ids)
-        all_imgs = []
-        all_samples = []
-        all_objectives = []
-        all_gripper_dirs = []
-        all_videos = []
         if self.mode == 'point':
             classifier_scale = SCALE_2D
         elif self.mode == 'point_3d':
@@ -681,13 +777,21 @@ class Diffusion(LightningModule):
         all_samples = sample.cpu().numpy()
         print('all_samples:', all_samples.shape)
             
-        for idx, s in enumerate(all_samples):
-            s = np.expand_dims(s, axis=0)
-            if self.mode == "point_3d":
-                gripper_imgs, metrics, _, _, _, _, videos, save_gripper_dirs = sim_test_batch_3d(s, self.object_ids, os.path.join(result_save_dir, 'allobj_%d' % idx), render=self.render_video, num_cpus=self.num_cpus, num_rot=int((ori_range[1]-ori_range[0])*6), ori_range=ori_range, render_last=(not self.render_video))
-            else:
-                gripper_imgs, metrics, _, _, _, _, videos, save_gripper_dirs = sim_test_batch(s, self.object_ids, os.path.join(result_save_dir, 'allobj_%d' % idx), render=self.render_video, num_cpus=self.num_cpus, num_rot=int((ori_range[1]-ori_range[0])*6), ori_range=ori_range, render_last=(not self.render_video))
-            if len(metrics) != num_objects:
+        all_units = [campaign.request(np.expand_dims(s, axis=0), self.object_ids, **self.guided_settings(ori_range)) for s in all_samples]
+        campaign.submit()
+        if not own_campaign:
+            return all_units
+        self.log_guided_sample_multi_object(campaign, all_units, opt_obj=opt_obj, ori_range=ori_range)
+        campaign.shutdown()
+
+    def log_guided_sample_multi_object(self, campaign, all_units, opt_obj='rotate', ori_range=[-1.0, 1.0]):
+        all_imgs = []
+        all_objectives = []
+        all_gripper_dirs = []
+        all_videos = []
+        for units in all_units:
+            gripper_imgs, metrics, _, _, _, _, videos, save_gripper_dirs = campaign.result(units)
+            if any(metric is None for metric in metrics):
                 continue
             objectives = [metric2objective(metric, opt_obj) for metric in metrics]
             average_objectives = {k: np.mean([objective[k] for objective in objectives]) for k in objectives[0].keys()}
@@ -695,12 +799,17 @@ class Diffusion(LightningModule):
             all_gripper_dirs.append(save_gripper_dirs[0])
             all_imgs.append(gripper_imgs[0])
             all_videos.append(sum(videos, []))
+        if len(all_objectives) == 0:
+            print('guided sample allobj_%s: no design finished on every object' % opt_obj)
+            return
         best_ids_all_metrics = self.get_best_ids_all_metrics(all_objectives, opt_obj=opt_obj)
         objective_keys = best_ids_all_metrics.keys()
         best_objectives = {k: all_objectives[best_ids_all_metrics[k]] for k in objective_keys}
-        best_imgs = {k: all_imgs[best_ids_all_metrics[k]] for k in objective_keys}
+        best_imgs = {k: self.plot_image(all_imgs[best_ids_all_metrics[k]]) for k in objective_keys}
         best_gripper_dirs = {k: all_gripper_dirs[best_ids_all_metrics[k]] for k in objective_keys}
         best_videos = {k: all_videos[best_ids_all_metrics[k]] for k in objective_keys}
+        if self.render_video:
+            best_videos = {k: self.render_videos(v) for k, v in best_videos.items()}
         if self.render_video:
             self.logger.log_table(
                 key = "val/guided_sample/allobj_%s_orirange=%.3f_%.3f" % (opt_obj, ori_range[0], ori_range[1]),
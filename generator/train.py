@@ -22,7 +22,7 @@ from generator.diffusion_utils import ConditionalUnet1D
 from generator.dataloader import GripperDataset
 from dynamics.parser import parse
 from assets.finger_3d import generate_3d_ctrlpts
-from assets.icon_process import extract_contours
+from sim.contour_store import ensure_contour_store, open_contour_store
 from assets.scan_object_process import read_object_names
 from dynamics.utils import sample_pts_from_mesh
 from dynamics.profile_forward_3d import ProfileForward3DModel
@@ -141,6 +141,8 @@ def train(args):
             print("simple test")
 
             object_image = np.load(args.object_dir, allow_pickle=True).item()['image']
+            # contours of the whole dataset, extracted once into its contour store
+            contour_store = open_contour_store(ensure_contour_store(args.object_dir))
 
             # Load the object from the corresponding directionary.
 
@@ -186,7 +188,7 @@ def train(args):
                 #print("Grayscale conversion successful!")
 
 
-                contour = extract_contours(single_image)
+                contour = contour_store.contour(single_image)
                 # triangle_contour_path = "./data/triangle_contour.npy"
                 # contour = np.load(triangle_contour_path)  # Load as a NumPy array
                 
@@ -231,7 +233,11 @@ def train(args):
                                 class_cond=args.classifier_guidance, classifier_model=classifier_model,
                                 grid_size=args.grid_size, num_pos=args.num_pos, object_vertices=object_vertices,
                                 object_ids=object_ids, num_cpus=args.num_cpus, pts_x_dim=pts_x_dim, pts_z_dim=pts_z_dim,
-                                sub_batch_size=args.sub_bs, render_video=args.render_video, seed=args.seed)
+                                sub_batch_size=args.sub_bs, render_video=args.render_video, seed=args.seed,
+                                asset_budget_gb=args.asset_budget_gb,
+                                sim_backend=args.sim_backend, result_cache_dir=args.result_cache_dir,
+                                reuse_radius=args.reuse_radius, plot_mode=args.plot_mode,
+                                results_db=args.results_db, mesh_format=args.mesh_format)
 
     os.makedirs(args.save_dir, exist_ok=True)
     project_name = 'classifier_guidance_fixed' if args.classifier_guidance else 'gripper_diffusion'
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+
+import numpy as np
+import ray
+
+SHARD_PREFIX = 'shard_'
+
+
+def is_shard(filename):
+    return os.path.basename(filename).startswith(SHARD_PREFIX)
+
+
+def classify(values, threshold):
+    # -1 / 0 / 1 classes of the dynamics model, shifted to histogram bins 0 / 1 / 2
+    return np.digitize(values, [-threshold, threshold], right=True)
+
+
+@ray.remote(num_cpus=0)
+class ResultAggregator(object):
+    """
+    Collects the results of a simulation campaign from the workers and writes them `shard_size` at a time
+    as one shard_<n>.npz, each result an entry named like the file it would have been saved as (without
+    .npz). Keeps running statistics, see `stats`, which are also written to stats.json after every shard.
+    """
+    def __init__(self, save_dir, thresholds, expected_per_object=None, shard_size=256):
+        self.save_dir = save_dir
+        self.thresholds = thresholds
+        self.shard_size = shard_size
+        self.buffer = {}
+        self.seen = set()
+        self.num_shards = len([f for f in os.listdir(save_dir) if is_shard(f)]) if os.path.exists(save_dir) else 0
+        self.start_time = time.time()
+        self.num_results = 0
+        self.histograms = {k: np.zeros(3, dtype=np.int64) for k in ['theta', 'x', 'y']}
+        self.fidelity = {}
+        self.per_object = {}
+        self.expected_per_object = expected_per_object
+
+    def add(self, name, object_idx, save_data):
+        if name in self.seen:
+            # a speculative copy of a task that already reported
+            return
+        self.seen.add(name)
+        self.buffer[name] = save_data
+        self.num_results += 1
+        self.histograms['theta'] += np.bincount(classify(save_data['delta_theta'], self.thresholds[0]), minlength=3)
+        self.histograms['x'] += np.bincount(classify(save_data['delta_pos'][:, 0], self.thresholds[1]), minlength=3)
+        self.histograms['y'] += np.bincount(classify(save_data['delta_pos'][:, 1], self.thresholds[2]), minlength=3)
+        fidelity = str(save_data.get('fidelity', 'high'))
+        self.fidelity[fidelity] = self.fidelity.get(fidelity, 0) + 1
+        self.per_object[int(object_idx)] = self.per_object.get(int(object_idx), 0) + 1
+        if len(self.buffer) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        os.makedirs(self.save_dir, exist_ok=True)
+        path = os.path.join(self.save_dir, '%s%05d.npz' % (SHARD_PREFIX, self.num_shards))
+        # written under a temporary name, readers never see a partial shard
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **{name: np.array(save_data, dtype=object) for name, save_data in self.buffer.items()})
+        os.replace(tmp_path, path)
+        self.num_shards += 1
+        self.buffer = {}
+        with open(os.path.join(self.save_dir, 'stats.json'), 'w') as f:
+            json.dump(self.stats(), f)
+
+    def stats(self):
+        """
+        Returns
+            num_results, num_shards, results_per_second
+            histograms      {theta, x, y: counts of the classes [-1, 0, 1]}
+            fidelity        {tier: number of results}
+            per_object      {object_idx: [finished, expected]}
+        """
+        return {
+            'num_results': self.num_results,
+            'num_shards': self.num_shards,
+            'results_per_second': self.num_results / max(time.time() - self.start_time, 1e-6),
+            'histograms': {k: v.tolist() for k, v in self.histograms.items()},
+            'fidelity': dict(self.fidelity),
+            'per_object': {k: [v, self.expected_per_object] for k, v in sorted(self.per_object.items())},
+        }
+
+    def close(self):
+        self.flush()
+        return self.stats()
+
+
+def save_result(save_dir, filename, object_idx, save_data, aggregator=None):
+    """Saves one result as its own file, or sends it to `aggregator` when the campaign streams its results."""
+    if aggregator is not None:
+        # wait for the actor so a task only finishes once its result is accounted for
+        ray.get(aggregator.add.remote(os.path.splitext(filename)[0], object_idx, save_data))
+        return
+    os.makedirs(save_dir, exist_ok=True)
+    np.savez_compressed(os.path.join(save_dir, filename), save_data)
@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+from os.path import join as pjoin
+
+
+class AssetStore(object):
+    """
+    Packs the assets of a simulation batch (sim_model meshes and xmls, plots, videos) into one tar archive
+    under `root` and removes the loose files. Archives are evicted least recently used first once they take
+    more than `budget_bytes` on disk, `budget_bytes=None` keeps everything.
+    index.json maps every archive name to its size and last access time.
+    """
+    def __init__(self, root, budget_bytes=None):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.index_path = pjoin(root, 'index.json')
+        os.makedirs(root, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+    def archive_path(self, name):
+        return pjoin(self.root, '%s.tar' % name)
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def total_bytes(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def pack(self, name, dirs, base_dir):
+        """Archives the directories `dirs` (paths relative to `base_dir` in the archive) as `name` and deletes them."""
+        dirs = [d for d in dirs if os.path.exists(d)]
+        if len(dirs) == 0:
+            return None
+        path = self.archive_path(name)
+        tmp_path = path + '.tmp'
+        # png, mp4 and npz are compressed already
+        with tarfile.open(tmp_path, 'w') as tar:
+            for d in dirs:
+                tar.add(d, arcname=os.path.relpath(d, base_dir))
+        os.replace(tmp_path, path)
+        for d in dirs:
+            shutil.rmtree(d)
+        self.index[name] = {'size': os.path.getsize(path), 'atime': time.time()}
+        self.evict(keep=name)
+        self.save_index()
+        return path
+
+    def touch(self, name):
+        self.index[name]['atime'] = time.time()
+        self.save_index()
+
+    def read(self, name, member):
+        """Returns the bytes of file `member` of archive `name`."""
+        with tarfile.open(self.archive_path(name), 'r') as tar:
+            data = tar.extractfile(member).read()
+        self.touch(name)
+        return data
+
+    def extract(self, name, dest):
+        """Unpacks archive `name` below `dest`."""
+        with tarfile.open(self.archive_path(name), 'r') as tar:
+            tar.extractall(dest)
+        self.touch(name)
+        return dest
+
+    def evict(self, keep=None):
+        """Deletes least recently used archives until the store fits its budget, never the archive `keep`."""
+        if self.budget_bytes is None:
+            return []
+        evicted = []
+        for name in sorted(self.index.keys(), key=lambda name: self.index[name]['atime']):
+            if self.total_bytes() <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            if os.path.exists(self.archive_path(name)):
+                os.remove(self.archive_path(name))
+            self.index.pop(name)
+            evicted.append(name)
+        if len(evicted) > 0:
+            print('asset store: evicted %d archives, %.1f MB left' % (len(evicted), self.total_bytes() / 2**20))
+        return evicted
+
+
+if __name__ == '__main__':
+    # python sim/asset_store.py <root> lists the archives of a store, most recently used first
+    store = AssetStore(sys.argv[1])
+    for name in sorted(store.index.keys(), key=lambda name: -store.index[name]['atime']):
+        entry = store.index[name]
+        print('%s\t%.1f MB\t%s' % (name, entry['size'] / 2**20, time.ctime(entry['atime'])))
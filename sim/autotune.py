@@ -0,0 +1,81 @@
+import math
+import time
+import resource
+
+# stages of a simulation batch: `prepare` builds the finger/object meshes and runs the multi-threaded V-HACD,
+# `step` steps MuJoCo over a chunk of object orientations
+DEFAULT_PLAN = {'prepare_cpus': 2, 'step_cpus': 1, 'num_chunks': 1, 'time_per_rot': None}
+# a chunk should run at least this many times longer than loading its model
+MIN_CHUNK_FACTOR = 10.0
+
+_measurements = {}
+
+
+def cpu_time():
+    """CPU seconds of this process and of its finished subprocesses, V-HACD runs as a subprocess."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(fn, *args, **kwargs):
+    """Runs `fn` and returns its result, the wall time and the cpu time it used."""
+    start_wall, start_cpu = time.time(), cpu_time()
+    result = fn(*args, **kwargs)
+    return result, time.time() - start_wall, cpu_time() - start_cpu
+
+
+def cores_used(wall, cpu, total_cpus):
+    # average number of busy cores, rounded up so bursty stages are not starved
+    if wall is None or wall < 1.0:
+        return None
+    return int(min(total_cpus, max(1, math.ceil(cpu / wall - 0.25))))
+
+
+def plan_resources(measurements, total_cpus, num_pairs, num_rot):
+    """
+    Picks per-stage resource requests from warm-up `measurements` (see `autotune`):
+        prepare_cpus    cpus requested by each prepare task
+        step_cpus       cpus requested by each stepping task
+        num_chunks      number of orientation chunks every (gripper, object) pair is split into, enough to keep
+                        all cpus busy but each chunk long enough to amortize loading its model
+        time_per_rot    measured seconds to simulate one orientation, None if unknown
+    """
+    plan = dict(DEFAULT_PLAN)
+    prepare_cpus = cores_used(measurements.get('prepare_wall'), measurements.get('prepare_cpu'), total_cpus)
+    if prepare_cpus is not None:
+        plan['prepare_cpus'] = prepare_cpus
+    step_cpus = cores_used(measurements.get('step_wall'), measurements.get('step_cpu'), total_cpus)
+    if step_cpus is not None:
+        plan['step_cpus'] = step_cpus
+    plan['prepare_cpus'] = min(plan['prepare_cpus'], total_cpus)
+    plan['step_cpus'] = min(plan['step_cpus'], total_cpus)
+    if measurements.get('step_wall') is None:
+        return plan
+    time_per_rot = measurements['step_wall'] / measurements['num_warmup_rot']
+    plan['time_per_rot'] = time_per_rot
+    wanted = math.ceil(total_cpus // plan['step_cpus'] / max(1, num_pairs))
+    affordable = math.floor(time_per_rot * num_rot / max(MIN_CHUNK_FACTOR * measurements.get('load_wall', 0.0), 1e-3))
+    plan['num_chunks'] = int(max(1, min(wanted, affordable, num_rot)))
+    return plan
+
+
+def autotune(key, warmup, total_cpus, num_pairs, num_rot):
+    """
+    Returns the resource plan for a batch of `num_pairs` (gripper, object) pairs with `num_rot` orientations each.
+    `warmup()` runs the stages once on a small input and returns the measurements (prepare_wall, prepare_cpu,
+    load_wall, step_wall, step_cpu, num_warmup_rot); it is only called the first time a `key` is tuned in
+    this process.
+    """
+    if key not in _measurements:
+        _measurements[key] = warmup()
+        print('autotune %s:' % key, _measurements[key])
+    plan = plan_resources(_measurements[key], total_cpus, num_pairs, num_rot)
+    print('autotune %s: %d pairs x %d orientations on %d cpus ->' % (key, num_pairs, num_rot, total_cpus), plan)
+    return plan
+
+
+def chunk_ranges(num_rot, num_chunks):
+    """Splits range(num_rot) into `num_chunks` contiguous (start, stop) ranges of near equal size."""
+    bounds = [num_rot * i // num_chunks for i in range(num_chunks + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+# outputs of sim_test_batch / sim_test_batch_3d, in order
+OUTPUTS = ['imgs', 'metrics', 'profiles', 'profiles_x', 'profiles_y', 'finals', 'videos', 'save_gripper_dirs']
+# outputs kept by the results database as artifact paths
+ARTIFACTS = ['imgs', 'profiles', 'profiles_x', 'profiles_y', 'finals', 'save_gripper_dirs']
+
+
+class EvaluationCampaign(object):
+    """
+    The simulations of one validation pass. Objectives `request` designs x objects as soon as they are sampled and
+    get a ticket back at once. `submit` drops the (design, object) pairs requested before and runs one `batch_fn`
+    (sim_test_batch or sim_test_batch_3d) per settings in a background thread, over all the pairs requested with
+    them (`pair_keys`), so the next objectives are denoised while the simulations run. A batch of every object at
+    once has enough tasks to keep all cpus of the pool busy, one per object would leave most of them idle.
+    `result(units)` waits for the batches of a request and returns the outputs of `batch_fn(designs, object_ids,
+    ...)` with one slot per unit, None for the pairs that failed or missed their deadline.
+
+    Batches run one at a time by default: they share the simulation pool, and tasks queued behind another batch
+    would look like stragglers to its deadlines (see sim/scheduling.py). Without `background` the batches run in
+    the calling thread on submit, e.g. when they draw matplotlib plots in this process.
+    With `results` (a ResultsDB) every finished pair is added to it once, as an evaluation of `run` and `epoch`.
+    """
+    def __init__(self, batch_fn, save_dir, max_batches=1, background=True, results=None, run=None, epoch=None, **batch_kwargs):
+        self.batch_fn = batch_fn
+        self.save_dir = save_dir
+        self.batch_kwargs = batch_kwargs
+        self.threads = ThreadPoolExecutor(max_workers=max_batches) if background else None
+        self.pending = {}   # group -> {design key: design}
+        self.units = {}     # (group, design key) -> (batch index, pair key in the batch)
+        self.batches = []   # futures of the batch outputs
+        self.settings = {}  # group -> (object_idx, settings)
+        self.designs = {}   # design key -> design
+        self.results = results
+        self.run = run
+        self.epoch = epoch
+        self.recorded = set()
+        self.num_requested = 0
+
+    def group(self, object_idx, settings):
+        key = hashlib.sha1(json.dumps([object_idx, settings], sort_keys=True).encode()).hexdigest()[:12]
+        self.settings[key] = (object_idx, settings)
+        return key
+
+    def request(self, designs, object_ids, **settings):
+        """Requests `designs` (num_designs, ...) on every object of `object_ids` with the batch `settings`."""
+        units = []
+        for object_idx in object_ids:
+            group = self.group(object_idx, settings)
+            for design in designs:
+                design_key = hashlib.sha1(np.ascontiguousarray(design).tobytes()).hexdigest()
+                if (group, design_key) not in self.units:
+                    self.pending.setdefault(group, {})[design_key] = design
+                    self.designs[design_key] = design
+                units.append((group, design_key))
+                self.num_requested += 1
+        return units
+
+    def submit(self):
+        """Starts the batches of the pairs requested since the last submit, one per settings."""
+        batches = {}    # settings key -> groups
+        for group in self.pending.keys():
+            batches.setdefault(json.dumps(self.settings[group][1], sort_keys=True), []).append(group)
+        for settings_key, groups in batches.items():
+            object_ids = list(dict.fromkeys(self.settings[group][0] for group in groups))
+            designs = {design_key: design for group in groups for design_key, design in self.pending[group].items()}
+            positions = {design_key: position for position, design_key in enumerate(designs.keys())}
+            # keys of the batch outputs, object_order_idx * num_gripper + gripper_idx
+            pair_keys = set()
+            for group in groups:
+                object_order_idx = object_ids.index(self.settings[group][0])
+                for design_key in self.pending[group].keys():
+                    pair_key = object_order_idx * len(designs) + positions[design_key]
+                    self.units[(group, design_key)] = (len(self.batches), pair_key)
+                    pair_keys.add(pair_key)
+            settings = self.settings[groups[0]][1]
+            save_dir = os.path.join(self.save_dir, '%s_%d' % (hashlib.sha1(settings_key.encode()).hexdigest()[:12], len(self.batches)))
+            designs = np.stack(list(designs.values()), axis=0)
+            if self.threads is not None:
+                self.batches.append(self.threads.submit(self.run_batch, designs, object_ids, save_dir, settings, pair_keys))
+            else:
+                self.batches.append(Future())
+                self.batches[-1].set_result(self.run_batch(designs, object_ids, save_dir, settings, pair_keys))
+        self.pending = {}
+
+    def run_batch(self, designs, object_ids, save_dir, settings, pair_keys):
+        outputs = self.batch_fn(designs, object_ids, save_dir, return_status=True, pair_keys=pair_keys, **self.batch_kwargs, **settings)
+        outputs, status = outputs[:len(OUTPUTS)], outputs[len(OUTPUTS)]
+        # failed pairs are left out of the output lists, the rest keep the order of their keys
+        finished = [pair_key for pair_key in sorted(pair_keys) if pair_key not in status]
+        return {pair_key: [output[i] if len(output) > 0 else None for output in outputs] for i, pair_key in enumerate(finished)}
+
+    def result(self, units):
+        """
+        Waits for the pairs of a request and returns the batch outputs in the order of `units`, a pair that did not
+        finish is None in every output.
+        """
+        if len(self.pending) > 0:
+            self.submit()
+        outputs = [[None] * len(units) for _ in OUTPUTS]
+        for i, unit in enumerate(units):
+            batch, pair_key = self.units[unit]
+            finished = self.batches[batch].result()
+            if pair_key not in finished:
+                continue
+            for output, value in zip(outputs, finished[pair_key]):
+                output[i] = value
+            if self.results is not None and unit not in self.recorded:
+                self.record(unit, finished[pair_key])
+        if self.results is not None:
+            self.results.commit()
+        return tuple(outputs)
+
+    def record(self, unit, values):
+        group, design_key = unit
+        object_idx, settings = self.settings[group]
+        values = dict(zip(OUTPUTS, values))
+        artifacts = {name: values[name] for name in ARTIFACTS if isinstance(values[name], str)}
+        self.results.add(self.run, self.epoch, self.designs[design_key], object_idx, settings, values['metrics'], artifacts)
+        self.recorded.add(unit)
+
+    def shutdown(self):
+        num_simulated = len(self.units)
+        print('evaluation campaign: %d pairs requested, %d simulated in %d batches' % (self.num_requested, num_simulated, len(self.batches)))
+        if self.threads is not None:
+            self.threads.shutdown()
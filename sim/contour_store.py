@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import hashlib
+import functools
+from collections import OrderedDict
+from os.path import join as pjoin
+BASEPATH = os.path.dirname(__file__)
+sys.path.insert(0, BASEPATH)
+sys.path.insert(0, pjoin(BASEPATH, '..'))
+
+import numpy as np
+
+from assets.icon_process import extract_contours
+from sim.autotune import chunk_ranges
+
+# contour resolutions every store keeps, other resolutions are extracted on lookup
+CONTOUR_RESOLUTIONS = [100]
+# images extracted per task of the process pool, smaller batches run in the calling process
+CONTOUR_CHUNK = 256
+# contours of rendered frames kept by `cached_contour` in every process
+FRAME_CACHE_SIZE = 4096
+
+
+def image_hash(image):
+    """Key of an (H, W, C) image as extract_contours reads it."""
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(image.tobytes())
+    digest.update(json.dumps([image.shape, image.dtype.str]).encode())
+    return digest.hexdigest()
+
+
+def rescale_contour(contour):
+    # the rescaling of extract_contours, from the 128 x 128 pixels to [-0.05, 0.05]
+    return contour / 128 * 0.1 - 0.05
+
+
+def extract_chunk(images, num_points, channels_first=False):
+    """Pixel contours (N, num_points, 2) of `images`, (N, H, W, C) or (N, C, H, W) with `channels_first`."""
+    contours = np.zeros((len(images), num_points, 2), dtype=np.int32)
+    for idx, image in enumerate(images):
+        image = np.ascontiguousarray(image.transpose((1, 2, 0))) if channels_first else image
+        contours[idx] = extract_contours(image, num_points=num_points, rescale=False)
+    return contours
+
+
+def extract_contours_batch(images, num_points=100, channels_first=False, num_workers=None):
+    """
+    The pixel contours (N, num_points, 2) of a whole image array, extract_contours(..., rescale=False) of every
+    image. Chunks of CONTOUR_CHUNK images are spread over a pool of `num_workers` processes (all CPUs by default).
+    """
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    num_chunks = min(num_workers, -(-len(images) // CONTOUR_CHUNK))
+    if num_chunks <= 1:
+        return extract_chunk(images, num_points, channels_first)
+    # imported here, only stores built from large image arrays start a pool
+    from sim.executor import ProcessExecutor
+    executor = ProcessExecutor(num_chunks)
+    try:
+        futures = [executor.submit(extract_chunk, np.asarray(images[start:stop]), num_points, channels_first)
+                   for start, stop in chunk_ranges(len(images), -(-len(images) // CONTOUR_CHUNK))]
+        return np.concatenate([future.result() for future in futures], axis=0)
+    finally:
+        executor.shutdown()
+
+
+def default_store_dir(object_dir):
+    return os.path.splitext(object_dir)[0] + '_contours'
+
+
+def source_signature(object_dir):
+    stat = os.stat(object_dir)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_contour_store(images, store_dir, channels_first=True, num_workers=None, source=None):
+    """
+    Extracts the contours of `images` (N, C, H, W) at CONTOUR_RESOLUTIONS into `store_dir`, as flat .npy files that
+    a ContourStore memory-maps:
+        keys.npy                (N,) image hashes, of the (H, W, C) images
+        contours_<points>.npy   (N, points, 2) pixel contours, extract_contours(..., rescale=False)
+        rescaled_<points>.npy   (N, points, 2) the contours rescaled to [-0.05, 0.05], extract_contours(...)
+    Images already in the store are not extracted again, the store keeps their contours.
+    """
+    keys = np.asarray([image_hash(image.transpose((1, 2, 0)) if channels_first else image) for image in images])
+    old = ContourStore(store_dir) if os.path.exists(pjoin(store_dir, 'meta.json')) else None
+    os.makedirs(store_dir, exist_ok=True)
+    for num_points in CONTOUR_RESOLUTIONS:
+        known = np.asarray([old is not None and num_points in old.resolutions and key in old.rows for key in keys], dtype=bool)
+        contours = np.zeros((len(images), num_points, 2), dtype=np.int32)
+        if known.any():
+            contours[known] = old.contours[num_points][[old.rows[key] for key in keys[known]]]
+        if (~known).any():
+            contours[~known] = extract_contours_batch(images[~known], num_points, channels_first, num_workers)
+        for name, array in [('contours_%d' % num_points, contours), ('rescaled_%d' % num_points, rescale_contour(contours))]:
+            tmp_path = pjoin(store_dir, '%s.%d.tmp.npy' % (name, os.getpid()))
+            np.save(tmp_path, array)
+            os.replace(tmp_path, pjoin(store_dir, '%s.npy' % name))
+    np.save(pjoin(store_dir, 'keys.npy'), keys)
+    # written last, marks the store as complete
+    with open(pjoin(store_dir, 'meta.json'), 'w') as f:
+        json.dump({'source': source, 'num_images': len(images), 'resolutions': CONTOUR_RESOLUTIONS}, f)
+    return store_dir
+
+
+def ensure_contour_store(object_dir, store_dir=None, num_workers=None):
+    """The contour store of the pickled icon dataset at `object_dir`, built again when the dataset changed."""
+    store_dir = store_dir if store_dir is not None else default_store_dir(object_dir)
+    meta_path = pjoin(store_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f).get('source') == source_signature(object_dir):
+                return store_dir
+    images = np.load(object_dir, allow_pickle=True).item()['image']
+    build_contour_store(images, store_dir, num_workers=num_workers, source=source_signature(object_dir))
+    open_contour_store.cache_clear()
+    return store_dir
+
+
+class ContourStore(object):
+    """The contours of a store built by build_contour_store, memory-mapped read-only and looked up by image."""
+    def __init__(self, store_dir):
+        with open(pjoin(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.resolutions = self.meta['resolutions']
+        self.keys = np.load(pjoin(store_dir, 'keys.npy'))
+        self.rows = {key: row for row, key in enumerate(self.keys)}
+        self.contours = {num_points: np.load(pjoin(store_dir, 'contours_%d.npy' % num_points), mmap_mode='r') for num_points in self.resolutions}
+        self.rescaled = {num_points: np.load(pjoin(store_dir, 'rescaled_%d.npy' % num_points), mmap_mode='r') for num_points in self.resolutions}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contour(self, image, num_points=100, rescale=True):
+        """extract_contours(image, num_points, rescale) of an (H, W, C) image, read from the store if it has it."""
+        row = self.rows.get(image_hash(image)) if num_points in self.resolutions else None
+        if row is None:
+            return cached_contour(image, num_points, rescale)
+        return np.array((self.rescaled if rescale else self.contours)[num_points][row])
+
+    def lookup(self, images, num_points=100, rescale=True, channels_first=True):
+        """The contours (N, num_points, 2) of `images`, (N, C, H, W) by default like the icon dataset."""
+        return np.stack([self.contour(image.transpose((1, 2, 0)) if channels_first else image, num_points, rescale) for image in images], axis=0)
+
+
+@functools.lru_cache(maxsize=None)
+def open_contour_store(store_dir):
+    """Opens a store once per process, so every worker maps the files a single time."""
+    return ContourStore(store_dir)
+
+
+_frame_contours = OrderedDict()
+
+
+def cached_contour(image, num_points=100, rescale=True):
+    """
+    extract_contours for images that are not in a store, e.g. rendered frames: the last FRAME_CACHE_SIZE contours
+    are kept in this process by image hash, so repeated frames (the same object pose for every design) are
+    extracted once.
+    """
+    key = (image_hash(image), num_points)
+    if key not in _frame_contours:
+        if len(_frame_contours) >= FRAME_CACHE_SIZE:
+            _frame_contours.popitem(last=False)
+        _frame_contours[key] = extract_contours(image, num_points=num_points, rescale=False)
+    else:
+        _frame_contours.move_to_end(key)
+    contour = _frame_contours[key]
+    return rescale_contour(contour) if rescale else contour.copy()
+
+
+if __name__ == '__main__':
+    # python sim/contour_store.py <object_dir> [store_dir] builds the contour store of an icon dataset
+    object_dir = sys.argv[1]
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    print(ensure_contour_store(object_dir, store_dir))
@@ -0,0 +1,143 @@
+import concurrent.futures
+import multiprocessing
+
+import ray
+
+from sim.scheduling import call
+
+# jobs up to this many (gripper, object) pairs x orientations run in the calling process, up to
+# PROCESS_MAX_WORK in a local process pool and larger ones on Ray
+SERIAL_MAX_WORK = 24
+PROCESS_MAX_WORK = 4096
+
+
+class SerialExecutor(object):
+    """Runs every task in the calling process when it is submitted, nothing to start up."""
+    parallel = False
+
+    def submit(self, fn, *args, num_cpus=1, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def wait(self, handles, timeout=None):
+        return [handle for handle in handles if handle.done()]
+
+    def get(self, handle):
+        return handle.result()
+
+    def cancel(self, handle):
+        handle.cancel()
+
+    def shutdown(self):
+        pass
+
+
+def start_worker():
+    # spawned workers do not inherit the CUDA and thread state of a training process
+    return concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+
+def terminate_worker(worker):
+    """Kills the process of a single-process pool, e.g. running a task that missed its deadline, without waiting for it."""
+    # ProcessPoolExecutor has no public way to stop a running task
+    for process in list((worker._processes or {}).values()):
+        process.terminate()
+    worker.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessExecutor(SerialExecutor):
+    """
+    Runs tasks on `num_cpus` local worker processes, each task goes to the worker with the fewest tasks queued.
+    `num_cpus` of a task is not enforced, callers bound the tasks in flight instead. Cancelling a running task
+    kills its worker and starts a new one in its place, tasks queued behind it on that worker fail.
+    """
+    parallel = True
+
+    def __init__(self, num_cpus):
+        self.workers = [start_worker() for _ in range(num_cpus)]
+        self.assigned = {}  # handle -> worker index, until the task is done
+
+    def load(self, worker):
+        return sum(1 for handle, i in self.assigned.items() if i == worker and not handle.done())
+
+    def submit(self, fn, *args, num_cpus=1, **kwargs):
+        self.assigned = {handle: i for handle, i in self.assigned.items() if not handle.done()}
+        worker = min(range(len(self.workers)), key=self.load)
+        handle = self.workers[worker].submit(fn, *args, **kwargs)
+        self.assigned[handle] = worker
+        return handle
+
+    def wait(self, handles, timeout=None):
+        done, _ = concurrent.futures.wait(handles, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+        return list(done)
+
+    def cancel(self, handle):
+        if handle.cancel() or handle.done() or handle not in self.assigned:
+            return
+        # running: the worker is stuck with it, replace the worker so the slot is free for the next tasks
+        worker = self.assigned.pop(handle)
+        terminate_worker(self.workers[worker])
+        self.workers[worker] = start_worker()
+
+    def shutdown(self):
+        # nothing waits for the tasks still running, e.g. past their deadline
+        for worker in self.workers:
+            terminate_worker(worker)
+        self.workers = []
+        self.assigned = {}
+
+
+class RayExecutor(object):
+    """Runs tasks on Ray, starts a local Ray instance unless the process is connected to one already."""
+    parallel = True
+
+    def __init__(self, num_cpus):
+        self.owns_ray = not ray.is_initialized()
+        if self.owns_ray:
+            ray.init(num_cpus=num_cpus, log_to_driver=False)
+
+    def submit(self, fn, *args, num_cpus=1, **kwargs):
+        return call.options(num_cpus=num_cpus).remote(fn, *args, **kwargs)
+
+    def wait(self, handles, timeout=None):
+        ready, _ = ray.wait(list(handles), num_returns=1, timeout=timeout)
+        return ready
+
+    def get(self, handle):
+        return ray.get(handle)
+
+    def cancel(self, handle):
+        ray.cancel(handle, force=True)
+
+    def shutdown(self):
+        if self.owns_ray:
+            ray.shutdown()
+
+
+BACKENDS = {
+    'serial': lambda num_cpus: SerialExecutor(),
+    'process': ProcessExecutor,
+    'ray': RayExecutor,
+}
+
+
+def select_backend(num_pairs, num_rot, backend='auto'):
+    if backend != 'auto':
+        return backend
+    work = num_pairs * num_rot
+    if work <= SERIAL_MAX_WORK:
+        return 'serial'
+    elif work <= PROCESS_MAX_WORK:
+        return 'process'
+    return 'ray'
+
+
+def make_executor(num_cpus, num_pairs=1, num_rot=1, backend='auto'):
+    """Returns an executor of `backend`, with 'auto' picked by the size of the job."""
+    backend = select_backend(num_pairs, num_rot, backend)
+    print('executor: %s for %d pairs x %d orientations' % (backend, num_pairs, num_rot))
+    return BACKENDS[backend](num_cpus)
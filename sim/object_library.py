@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import functools
+from os.path import join as pjoin
+BASEPATH = os.path.dirname(__file__)
+sys.path.insert(0, BASEPATH)
+sys.path.insert(0, pjoin(BASEPATH, '..'))
+
+import numpy as np
+import trimesh
+
+from assets.icon_process import generate_icon_mesh
+from sim.contour_store import ensure_contour_store, open_contour_store
+
+ICON_HEIGHT = 0.02
+NUM_CONTOUR_POINTS = 100
+
+
+def default_library_dir(object_dir):
+    return os.path.splitext(object_dir)[0] + '_library'
+
+
+def source_signature(object_dir):
+    # the demo pipeline rewrites the object file in place, a changed file invalidates its library
+    stat = os.stat(object_dir)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_object_library(object_dir, library_dir, height=ICON_HEIGHT, num_points=NUM_CONTOUR_POINTS):
+    """
+    Converts the pickled icon dataset at `object_dir` into a directory of flat .npy files that workers can
+    memory-map read-only:
+        images.npy      (N, C, H, W) icon images, as stored in the dataset
+        contours.npy    (N, num_points, 2) object contours, rescaled to [-0.05, 0.05]
+        vertices.npy, vertex_offsets.npy    concatenated vertices of the extruded icon meshes and the start of
+                                            each object's vertices, (N+1,)
+        faces.npy, face_offsets.npy         same for the mesh faces
+    """
+    images = np.load(object_dir, allow_pickle=True).item()['image']
+    os.makedirs(library_dir, exist_ok=True)
+    image_mmap = np.lib.format.open_memmap(pjoin(library_dir, 'images.npy'), mode='w+', dtype=images.dtype, shape=images.shape)
+    image_mmap[:] = images
+    image_mmap.flush()
+    # extracted in a process pool into the contour store of the dataset, or read from it
+    object_contours = open_contour_store(ensure_contour_store(object_dir)).lookup(images, num_points)
+    contours = np.lib.format.open_memmap(pjoin(library_dir, 'contours.npy'), mode='w+', dtype=np.float64, shape=(len(images), num_points, 2))
+    vertices, faces = [], []
+    vertex_offsets, face_offsets = [0], [0]
+    for idx, image in enumerate(images):
+        mesh, contour = generate_icon_mesh(image.transpose((1, 2, 0)), height, num_points, contour=object_contours[idx])
+        contours[idx] = contour
+        vertices.append(np.asarray(mesh.vertices, dtype=np.float64))
+        vertex_offsets.append(vertex_offsets[-1] + len(mesh.vertices))
+        faces.append(np.asarray(mesh.faces, dtype=np.int32))
+        face_offsets.append(face_offsets[-1] + len(mesh.faces))
+    contours.flush()
+    np.save(pjoin(library_dir, 'vertices.npy'), np.concatenate(vertices, axis=0))
+    np.save(pjoin(library_dir, 'vertex_offsets.npy'), np.asarray(vertex_offsets, dtype=np.int64))
+    np.save(pjoin(library_dir, 'faces.npy'), np.concatenate(faces, axis=0))
+    np.save(pjoin(library_dir, 'face_offsets.npy'), np.asarray(face_offsets, dtype=np.int64))
+    # written last, marks the library as complete
+    with open(pjoin(library_dir, 'meta.json'), 'w') as f:
+        json.dump({'object_dir': object_dir, 'source': source_signature(object_dir), 'num_objects': len(images), 'height': height, 'num_points': num_points}, f)
+    return library_dir
+
+
+def ensure_object_library(object_dir, library_dir=None):
+    library_dir = library_dir if library_dir is not None else default_library_dir(object_dir)
+    meta_path = pjoin(library_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f).get('source') == source_signature(object_dir):
+                return library_dir
+        os.remove(meta_path)
+    build_object_library(object_dir, library_dir)
+    _open_object_library.cache_clear()
+    return library_dir
+
+
+class ObjectLibrary(object):
+    def __init__(self, library_dir):
+        with open(pjoin(library_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.images = np.load(pjoin(library_dir, 'images.npy'), mmap_mode='r')
+        self.contours = np.load(pjoin(library_dir, 'contours.npy'), mmap_mode='r')
+        self.vertices = np.load(pjoin(library_dir, 'vertices.npy'), mmap_mode='r')
+        self.vertex_offsets = np.load(pjoin(library_dir, 'vertex_offsets.npy'), mmap_mode='r')
+        self.faces = np.load(pjoin(library_dir, 'faces.npy'), mmap_mode='r')
+        self.face_offsets = np.load(pjoin(library_dir, 'face_offsets.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['num_objects']
+
+    def image(self, idx):
+        # (H, W, C), the layout extract_contours expects
+        return np.ascontiguousarray(self.images[idx].transpose((1, 2, 0)))
+
+    def contour(self, idx):
+        return np.array(self.contours[idx])
+
+    def mesh(self, idx):
+        vertices = np.array(self.vertices[self.vertex_offsets[idx]:self.vertex_offsets[idx + 1]])
+        faces = np.array(self.faces[self.face_offsets[idx]:self.face_offsets[idx + 1]])
+        # already processed when the library was built
+        return trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+
+
+@functools.lru_cache(maxsize=4)
+def _open_object_library(library_dir, meta_mtime):
+    return ObjectLibrary(library_dir)
+
+
+def open_object_library(library_dir):
+    """
+    Opens a library once per process, so every Ray worker maps the files a single time. The maps are keyed by the
+    meta.json of the library, a library rebuilt since it was opened is opened again.
+    """
+    return _open_object_library(library_dir, os.stat(pjoin(library_dir, 'meta.json')).st_mtime_ns)
+
+
+if __name__ == '__main__':
+    object_dir = sys.argv[1]
+    library_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    print(ensure_object_library(object_dir, library_dir))
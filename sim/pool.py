@@ -0,0 +1,135 @@
+import os
+import shutil
+
+import mujoco
+import ray
+
+from sim.executor import SerialExecutor, ProcessExecutor, RayExecutor, select_backend
+
+# scene models kept by every worker, the chunks of one pair reuse its model instead of compiling it again
+MODEL_CACHE_SIZE = 8
+
+_models = {}
+
+
+def load_model(scene_path):
+    """Returns the compiled MjModel of `scene_path`, cached in this process until the scene is written again."""
+    key = (scene_path, os.stat(scene_path).st_mtime_ns)
+    if key not in _models:
+        if len(_models) >= MODEL_CACHE_SIZE:
+            _models.pop(next(iter(_models)))
+        _models[key] = mujoco.MjModel.from_xml_path(scene_path)
+    return _models[key]
+
+
+@ray.remote(num_cpus=1)
+class SimulationWorker(object):
+    """Ray actor running the stages of simulation batches, its process and loaded models live as long as the pool."""
+    def run(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+
+class ActorPoolExecutor(RayExecutor):
+    """
+    Runs tasks on `num_cpus` long-lived SimulationWorker actors, each task goes to the worker with the fewest
+    tasks queued. `num_cpus` of a task is not enforced. Cancelling the task a worker is running kills the
+    worker and starts a new one in its place, tasks queued behind it on that worker fail.
+    """
+    def __init__(self, num_cpus):
+        super().__init__(num_cpus)
+        self.workers = [SimulationWorker.remote() for _ in range(num_cpus)]
+        self.queues = [[] for _ in range(num_cpus)]    # handles of every worker, in the order it runs them
+        self.assigned = {}  # handle -> worker index
+
+    def submit(self, fn, *args, num_cpus=1, **kwargs):
+        worker = min(range(len(self.workers)), key=lambda i: len(self.queues[i]))
+        handle = self.workers[worker].run.remote(fn, *args, **kwargs)
+        self.queues[worker].append(handle)
+        self.assigned[handle] = worker
+        return handle
+
+    def release(self, handle):
+        if handle in self.assigned:
+            queue = self.queues[self.assigned.pop(handle)]
+            if handle in queue:
+                queue.remove(handle)
+
+    def wait(self, handles, timeout=None):
+        ready = super().wait(handles, timeout=timeout)
+        for handle in ready:
+            self.release(handle)
+        return ready
+
+    def cancel(self, handle):
+        worker = self.assigned.get(handle)
+        if worker is not None:
+            # tasks finished but not waited for yet are not in front of it
+            finished, _ = ray.wait(self.queues[worker], num_returns=len(self.queues[worker]), timeout=0)
+            self.queues[worker] = [queued for queued in self.queues[worker] if queued not in finished or queued == handle]
+        running = worker is not None and self.queues[worker][0] == handle
+        self.release(handle)
+        if running:
+            # actor tasks cannot be stopped, the worker would hold its slot for the rest of the session
+            ray.kill(self.workers[worker])
+            for queued in self.queues[worker]:
+                self.assigned.pop(queued)
+            self.queues[worker] = []
+            self.workers[worker] = SimulationWorker.remote()
+            return
+        try:
+            ray.cancel(handle)
+        except Exception as e:
+            print(e)
+
+    def shutdown(self):
+        for worker in self.workers:
+            ray.kill(worker)
+        self.workers = []
+        self.queues = []
+        super().shutdown()
+
+
+WARM_BACKENDS = {
+    'serial': lambda num_cpus: SerialExecutor(),
+    'process': ProcessExecutor,
+    'ray': ActorPoolExecutor,
+}
+
+
+class SimulationPool(object):
+    """
+    Simulation workers and decomposed objects kept for a whole training or inference session. sim_test_batch and
+    sim_test_batch_3d given the pool submit to its workers instead of starting and shutting down an executor,
+    and link the icon objects decomposed once below `object_root` into their model_root.
+    """
+    def __init__(self, num_cpus, object_root, backend='auto'):
+        self.num_cpus = num_cpus
+        self.object_root = object_root
+        self.backend = backend
+        self.executors = {}
+        self.objects = set()
+
+    def executor(self, num_pairs, num_rot, backend=None):
+        """Returns the warm executor for a batch of `num_pairs` x `num_rot`, started on first use."""
+        backend = select_backend(num_pairs, num_rot, backend if backend is not None else self.backend)
+        if backend not in self.executors:
+            print('simulation pool: starting %s workers' % backend)
+            self.executors[backend] = WARM_BACKENDS[backend](self.num_cpus)
+        return self.executors[backend]
+
+    def link_object(self, object_idx, model_root):
+        """Makes the object decomposed below `object_root` available in `model_root`."""
+        self.objects.add(object_idx)
+        save_object_dir = os.path.join(model_root, 'objects', str(object_idx))
+        os.makedirs(os.path.dirname(save_object_dir), exist_ok=True)
+        if not os.path.lexists(save_object_dir):
+            os.symlink(os.path.abspath(os.path.join(self.object_root, 'objects', str(object_idx))), save_object_dir)
+        object_xml = os.path.join(model_root, 'object_%d.xml' % object_idx)
+        if not os.path.exists(object_xml):
+            # mesh paths in the xml are relative to model_root
+            shutil.copyfile(os.path.join(self.object_root, 'object_%d.xml' % object_idx), object_xml)
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown()
+        self.executors = {}
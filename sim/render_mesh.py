@@ -1,18 +1,21 @@
 import os
-import glob
 import sys
 from os.path import join as pjoin
 BASEPATH = os.path.dirname(__file__)
 sys.path.insert(0, BASEPATH)
 sys.path.insert(0, pjoin(BASEPATH, '..'))
 
+import hashlib
+
+import cv2
 import numpy as np
 import mujoco
-import subprocess
-import subprocess
+import trimesh
 from transforms3d import euler
 
-from assets.icon_process import extract_contours
+from assets.mesh_io import find_mesh
+from sim.replay import make_camera
+from sim.contour_store import cached_contour
 
 color_map = np.asarray([
     [0, 0, 0],
@@ -20,33 +23,121 @@ color_map = np.asarray([
 ], dtype=np.uint8)
 color_maps = np.concatenate([color_map for _ in range(32)], axis=0)
 
-def render_mesh(gripper_root: str):
-    subprocess.call(['cp', 'assets/gripper_render.xml', os.path.join(gripper_root, 'gripper_render.xml')])
-    model = mujoco.MjModel.from_xml_path(os.path.join(gripper_root, 'gripper_render.xml'))
-    data = mujoco.MjData(model)
-    renderer = mujoco.Renderer(model, 256, 256)
-    camera = mujoco.MjvCamera()
-    camera.lookat[:] = [0.0, 0.0, 0.0]
-    camera.distance = 0.9
-    camera.azimuth = 180
-    camera.elevation = -30
+# template scenes, compiled with the meshes of each design passed in memory
+GRIPPER_TEMPLATE = pjoin(BASEPATH, '..', 'assets', 'gripper_render.xml')
+OBJECT_TEMPLATE = pjoin(BASEPATH, '..', 'assets', 'object_render.xml')
+GRIPPER_CAMERA = {'lookat': [0.0, 0.0, 0.0], 'distance': 0.9, 'azimuth': 180, 'elevation': -30}
+OBJECT_CAMERA = {'lookat': [0.0, 0.0, 0.0], 'distance': 0.8, 'azimuth': 135, 'elevation': -45}
+
+_templates = {}
+_renderers = {}
+
+
+class OffscreenRenderer(object):
+    """
+    Headless renderer whose GL context lives as long as the process, so the warm simulation workers create it once.
+    Each new model only gets its render context (meshes and textures) uploaded into the existing GL context.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.gl_context = mujoco.GLContext(width, height)
+        self.gl_context.make_current()
+        self.model = None
+        self.context = None
+        self.scene = None
+        self.option = mujoco.MjvOption()
+        self.perturb = mujoco.MjvPerturb()
+        self.viewport = mujoco.MjrRect(0, 0, width, height)
+
+    def load(self, model):
+        self.gl_context.make_current()
+        if model is self.model:
+            return
+        if self.context is not None:
+            self.context.free()
+        self.context = mujoco.MjrContext(model, mujoco.mjtFontScale.mjFONTSCALE_150.value)
+        mujoco.mjr_setBuffer(mujoco.mjtFramebuffer.mjFB_OFFSCREEN.value, self.context)
+        self.scene = mujoco.MjvScene(model, maxgeom=1000)
+        self.model = model
+
+    def render(self, model, data, camera, segmentation=False):
+        """Returns the RGB image (height, width, 3) or with `segmentation` the (objid, objtype) per pixel, -1 for none."""
+        self.load(model)
+        self.scene.flags[mujoco.mjtRndFlag.mjRND_SEGMENT.value] = segmentation
+        self.scene.flags[mujoco.mjtRndFlag.mjRND_IDCOLOR.value] = segmentation
+        mujoco.mjv_updateScene(model, data, self.option, self.perturb, camera, mujoco.mjtCatBit.mjCAT_ALL.value, self.scene)
+        mujoco.mjr_render(self.viewport, self.scene, self.context)
+        pixels = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        mujoco.mjr_readPixels(pixels, None, self.viewport, self.context)
+        pixels = np.flipud(pixels)
+        if not segmentation:
+            return pixels
+        # as mujoco.Renderer: pixel colors encode segid + 1, 0 is the background
+        segids = pixels.astype(np.uint32)
+        segids = segids[..., 0] + segids[..., 1] * 2**8 + segids[..., 2] * 2**16
+        segids[segids >= self.scene.ngeom + 1] = 0
+        output = np.full((self.scene.ngeom + 1, 2), fill_value=-1, dtype=np.int32)
+        for geom in self.scene.geoms[:self.scene.ngeom]:
+            if geom.segid != -1:
+                output[geom.segid + 1] = [geom.objid, geom.objtype]
+        return output[segids]
+
+
+def offscreen_renderer(width, height):
+    """Returns the renderer of this process for images of `width` x `height`, created on first use."""
+    if (width, height) not in _renderers:
+        _renderers[(width, height)] = OffscreenRenderer(width, height)
+    return _renderers[(width, height)]
 
+
+def load_template(template_path, mesh_root, mesh_files):
+    """
+    Compiles the template scene with the `mesh_files` read from `mesh_root`, nothing is copied or written.
+    The obj files of the template are swapped for the files of the same name in another format (stl, msh).
+    """
+    if template_path not in _templates:
+        with open(template_path) as f:
+            _templates[template_path] = f.read()
+    xml = _templates[template_path]
+    assets = {}
+    for mesh_file in mesh_files:
+        with open(os.path.join(mesh_root, mesh_file), 'rb') as f:
+            assets[mesh_file] = f.read()
+        xml = xml.replace('"%s.obj"' % os.path.splitext(mesh_file)[0], '"%s"' % mesh_file)
+    return mujoco.MjModel.from_xml_string(xml, assets)
+
+
+def render_mesh(gripper_root: str, cache_dir: str = None):
+    """
+    Renders the fingers saved in `gripper_root` into a (256, 256, 3) RGB thumbnail. With `cache_dir` thumbnails are
+    kept there by the hash of the finger meshes, so a design rendered before is not rendered again.
+    """
+    mesh_files = [os.path.basename(find_mesh(os.path.join(gripper_root, finger))) for finger in ['fingerl', 'fingerr']]
+    if cache_dir is not None:
+        digest = hashlib.sha1()
+        for mesh_file in mesh_files:
+            with open(os.path.join(gripper_root, mesh_file), 'rb') as f:
+                digest.update(f.read())
+        thumbnail_path = os.path.join(cache_dir, '%s.npy' % digest.hexdigest())
+        if os.path.exists(thumbnail_path):
+            return np.load(thumbnail_path)
+    model = load_template(GRIPPER_TEMPLATE, gripper_root, mesh_files)
+    data = mujoco.MjData(model)
     mujoco.mj_step(model, data)
-    renderer.update_scene(data, camera)
-    img = renderer.render()
+    img = offscreen_renderer(256, 256).render(model, data, make_camera(GRIPPER_CAMERA))
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '%s.%d.tmp.npy' % (thumbnail_path[:-len('.npy')], os.getpid())
+        np.save(tmp_path, img)
+        os.replace(tmp_path, thumbnail_path)
     return img
 
 def render_object_mesh(object_root, z_rots):
-    subprocess.call(['cp', 'assets/object_render.xml', os.path.join(object_root, 'object_render.xml')])
-    model = mujoco.MjModel.from_xml_path(os.path.join(object_root, 'object_render.xml'))
+    model = load_template(OBJECT_TEMPLATE, object_root, ['model.obj'])
     data = mujoco.MjData(model)
-    renderer = mujoco.Renderer(model, 128, 128)
-    renderer.enable_segmentation_rendering()
-    camera = mujoco.MjvCamera()
-    camera.lookat[:] = [0.0, 0.0, 0.0]
-    camera.distance = 0.8
-    camera.azimuth = 135
-    camera.elevation = -45
+    renderer = offscreen_renderer(128, 128)
+    camera = make_camera(OBJECT_CAMERA)
     obj_root_idx = [model.joint(jointid).name for jointid in range(model.njnt)].index("object_root")
     obj_jnt = model.joint(obj_root_idx)
     assert obj_jnt.type == 0  # freejoint
@@ -57,9 +148,49 @@ def render_object_mesh(object_root, z_rots):
             obj_jnt.qposadr[0] + 3 : obj_jnt.qposadr[0] + 7
         ] = euler.euler2quat(0, 0, z_rot)
         mujoco.mj_step(model, data)
-        renderer.update_scene(data, camera)
-        img = renderer.render()[..., 0]
+        img = renderer.render(model, data, camera, segmentation=True)[..., 0]
         img = color_maps[img]
-        contour = extract_contours(img, num_points=100, rescale=False)
+        contour = cached_contour(img, num_points=100, rescale=False)
         contours.append(contour)
-    return contours
\ No newline at end of file
+    return contours
+
+
+def project_points(points, camera=OBJECT_CAMERA, size=128, fovy=45.0):
+    """
+    Projects world `points` (..., 3) into the pixels (..., 2) of a size x size image taken by the free MuJoCo
+    camera {lookat, distance, azimuth, elevation} with the default vertical field of view `fovy` in degrees.
+    """
+    azimuth, elevation = np.deg2rad(camera['azimuth']), np.deg2rad(camera['elevation'])
+    forward = np.array([np.cos(elevation) * np.cos(azimuth), np.cos(elevation) * np.sin(azimuth), np.sin(elevation)])
+    up = np.array([-np.sin(elevation) * np.cos(azimuth), -np.sin(elevation) * np.sin(azimuth), np.cos(elevation)])
+    right = np.cross(forward, up)
+    relative = points - (np.asarray(camera['lookat']) - camera['distance'] * forward)
+    depth = relative @ forward
+    focal = size / 2 / np.tan(np.deg2rad(fovy) / 2)
+    # pixel i covers [i, i + 1) of the image plane
+    cols = size / 2 + focal * (relative @ right) / depth - 0.5
+    rows = size / 2 - focal * (relative @ up) / depth - 0.5
+    return np.stack([cols, rows], axis=-1)
+
+
+def project_object_mesh(object_root, z_rots, num_points=100):
+    """
+    The contours of `render_object_mesh` without rendering: the vertices of the object mesh are rotated by all
+    `z_rots` and projected with the render camera at once, the projected faces of each rotation are filled into a
+    silhouette mask that the contour is extracted from.
+    """
+    mesh = trimesh.load(os.path.join(object_root, 'model.obj'), force='mesh', process=False)
+    cos, sin = np.cos(z_rots), np.sin(z_rots)
+    zeros, ones = np.zeros_like(z_rots), np.ones_like(z_rots)
+    rotations = np.stack([cos, -sin, zeros, sin, cos, zeros, zeros, zeros, ones], axis=-1).reshape(-1, 3, 3)
+    vertices = np.einsum('rij,vj->rvi', rotations, np.array(mesh.vertices))
+    pixels = project_points(vertices)
+    triangles = np.ascontiguousarray(np.round(pixels[:, np.array(mesh.faces)]), dtype=np.int32)    # (num_rot, num_faces, 3, 2)
+    contours = []
+    for rot_triangles in triangles:
+        img = np.full((128, 128, 3), 255, dtype=np.uint8)
+        # one polygon at a time, fillPoly would cancel the overlaps of several polygons out
+        for triangle in rot_triangles:
+            cv2.fillConvexPoly(img, triangle, (0, 0, 0))
+        contours.append(cached_contour(img, num_points=num_points, rescale=False))
+    return contours
@@ -0,0 +1,68 @@
+import os
+
+import mujoco
+import numpy as np
+
+from sim.pool import load_model
+from sim.scheduling import gather_with_deadlines
+
+TRAJECTORY_SUFFIX = '_traj.npz'
+
+
+def make_camera(params):
+    """Returns an MjvCamera from {lookat, distance, azimuth, elevation}."""
+    camera = mujoco.MjvCamera()
+    camera.lookat[:] = params['lookat']
+    camera.distance = params['distance']
+    camera.azimuth = params['azimuth']
+    camera.elevation = params['elevation']
+    return camera
+
+
+def trajectory_path(video_dir, video_idx):
+    return os.path.join(video_dir, '%d%s' % (video_idx, TRAJECTORY_SUFFIX))
+
+
+def is_trajectory(path):
+    return path.endswith(TRAJECTORY_SUFFIX)
+
+
+def save_trajectory(path, scene_path, qpos, camera, **extra):
+    """Saves the recorded `qpos` (num_frames, nq) of one orientation with what is needed to replay it."""
+    np.savez_compressed(path, scene_path=os.path.abspath(scene_path), qpos=qpos, camera=np.array(camera, dtype=object), **extra)
+    return path
+
+
+def load_trajectory(path):
+    trajectory = dict(np.load(path, allow_pickle=True))
+    trajectory['scene_path'] = str(trajectory['scene_path'])
+    trajectory['camera'] = trajectory['camera'].item()
+    return trajectory
+
+
+def replay(trajectory, height=128, width=128, segmentation=False):
+    """Yields the frames of a loaded trajectory rendered from its camera, segmentation ids when `segmentation`."""
+    model = load_model(trajectory['scene_path'])
+    data = mujoco.MjData(model)
+    renderer = mujoco.Renderer(model, height, width)
+    # the GL context is freed when the replay ends or its generator is closed, pool workers replay many videos
+    try:
+        if segmentation:
+            renderer.enable_segmentation_rendering()
+        camera = make_camera(trajectory['camera'])
+        for qpos in trajectory['qpos']:
+            data.qpos[:] = qpos
+            mujoco.mj_forward(model, data)
+            renderer.update_scene(data, camera)
+            yield renderer.render()
+    finally:
+        renderer.close()
+
+
+def render_recorded(trajectory_paths, render_fn, executor, max_in_flight=1):
+    """
+    Replays recorded trajectories into videos with `render_fn(trajectory_path) -> video_path` on `executor`.
+    Returns the video paths in the order of `trajectory_paths`, leaving out the ones that failed to render.
+    """
+    videos, _ = gather_with_deadlines(executor, lambda path: executor.submit(render_fn, path), list(dict.fromkeys(trajectory_paths)), max_in_flight=max_in_flight)
+    return [videos[path] for path in trajectory_paths if path in videos]
@@ -0,0 +1,167 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+# control points are rounded to this many decimals before hashing, closer designs share their results
+CTRLPTS_DECIMALS = 5
+
+
+def array_hash(array):
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+def design_key(ctrlpts, object_key, num_rot, ori_range, settings):
+    """Returns the cache key of simulating `ctrlpts` on the object `object_key` with the simulator `settings`."""
+    # + 0.0 turns -0.0 into 0.0, both round to the same design
+    quantized = np.round(np.asarray(ctrlpts, dtype=np.float64), CTRLPTS_DECIMALS) + 0.0
+    digest = hashlib.sha1(quantized.tobytes())
+    digest.update(json.dumps([object_key, int(num_rot), [float(x) for x in ori_range], settings], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def group_key(object_key, num_rot, ori_range, settings):
+    """Returns the key of the designs simulated on the object `object_key` with the same settings."""
+    return hashlib.sha1(json.dumps([object_key, int(num_rot), [float(x) for x in ori_range], settings], sort_keys=True).encode()).hexdigest()
+
+
+def design_vector(ctrlpts):
+    # distances between the vectors are root mean square distances of the control points
+    ctrlpts = np.asarray(ctrlpts, dtype=np.float64).reshape(-1)
+    return ctrlpts / np.sqrt(len(ctrlpts))
+
+
+class DesignIndex(object):
+    """Nearest-neighbour index over the design vectors of one group of a ResultCache, saved as an npz at `path`."""
+    def __init__(self, path):
+        self.path = path
+        self.vectors, self.keys = [], []
+        if os.path.exists(path):
+            data = np.load(path)
+            self.vectors, self.keys = list(data['vectors']), list(data['keys'])
+        self.neighbors = None
+        self.dirty = False
+
+    def add(self, ctrlpts, key):
+        self.vectors.append(design_vector(ctrlpts))
+        self.keys.append(key)
+        self.neighbors = None
+        self.dirty = True
+
+    def nearest(self, ctrlpts):
+        """Returns the key of the nearest indexed design and its distance, (None, inf) if the index is empty."""
+        if len(self.keys) == 0:
+            return None, np.inf
+        if self.neighbors is None:
+            self.neighbors = NearestNeighbors(n_neighbors=1).fit(np.stack(self.vectors, axis=0))
+        distances, ids = self.neighbors.kneighbors(design_vector(ctrlpts)[None])
+        return self.keys[ids[0, 0]], distances[0, 0]
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, vectors=np.stack(self.vectors, axis=0), keys=np.asarray(self.keys))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class ResultCache(object):
+    """
+    Simulated poses of (design, object, settings) keys, one pickle per key below `root`. Entries are written
+    under a temporary name and never modified, so runs and processes can share a cache directory.
+    With `reuse_radius` > 0 a design without an entry of its own reuses the entry of the nearest design simulated
+    in the same group (object and settings) if their control points are within `reuse_radius` (root mean square
+    distance), see `nearest`.
+    """
+    def __init__(self, root, reuse_radius=0.0):
+        self.root = root
+        self.reuse_radius = reuse_radius
+        self.hits = 0
+        self.misses = 0
+        self.reused = 0
+        self.indexes = {}
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], '%s.pkl' % key)
+
+    def get(self, key):
+        if not os.path.exists(self.path(key)):
+            self.misses += 1
+            return None
+        with open(self.path(key), 'rb') as f:
+            entry = pickle.load(f)
+        self.hits += 1
+        return entry
+
+    def index(self, group):
+        if group not in self.indexes:
+            self.indexes[group] = DesignIndex(os.path.join(self.root, 'index', '%s.npz' % group))
+        return self.indexes[group]
+
+    def nearest(self, group, ctrlpts):
+        """Returns the entry of the nearest design of `group` within `reuse_radius` of `ctrlpts`, None otherwise."""
+        if self.reuse_radius <= 0:
+            return None
+        key, distance = self.index(group).nearest(ctrlpts)
+        if key is None or distance > self.reuse_radius or not os.path.exists(self.path(key)):
+            return None
+        with open(self.path(key), 'rb') as f:
+            entry = pickle.load(f)
+        self.reused += 1
+        return entry
+
+    def gripper_dir(self, key):
+        return os.path.join(self.root, key[:2], '%s_gripper' % key)
+
+    def keep_gripper(self, key, save_gripper_dir):
+        """
+        Copies the gripper meshes of `key` next to its entry and returns the copy: the simulation dirs are archived
+        and removed after a validation (see AssetStore), the cache outlives them.
+        """
+        path = self.gripper_dir(key)
+        if not os.path.exists(path):
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            shutil.copytree(save_gripper_dir, tmp_path)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another process kept the same design first
+                shutil.rmtree(tmp_path)
+        return path
+
+    def put(self, key, entry, group=None, ctrlpts=None, save_gripper_dir=None):
+        """
+        Stores `entry`, with `group` and `ctrlpts` the design is also indexed for `nearest`. With `save_gripper_dir`
+        the gripper meshes are kept in the cache and the entry's save_gripper_dir points to them.
+        """
+        if group is not None:
+            self.index(group).add(ctrlpts, key)
+        if save_gripper_dir is not None:
+            entry = dict(entry, save_gripper_dir=self.keep_gripper(key, save_gripper_dir))
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        for index in self.indexes.values():
+            index.save()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reused': self.reused,
+            'hit_rate': self.hits / max(1, self.hits + self.misses),
+            'reuse_rate': self.reused / max(1, self.misses),
+        }
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import pickle
+import sqlite3
+from os.path import join as pjoin
+BASEPATH = os.path.dirname(__file__)
+sys.path.insert(0, BASEPATH)
+sys.path.insert(0, pjoin(BASEPATH, '..'))
+
+import numpy as np
+
+from dynamics.metrics import BEST_METRICS, metric2objective
+from sim.result_cache import array_hash
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS designs (design TEXT PRIMARY KEY, ctrlpts BLOB, shape TEXT)',
+    'CREATE TABLE IF NOT EXISTS evaluations (id INTEGER PRIMARY KEY, run TEXT, epoch INTEGER, design TEXT, object TEXT, settings TEXT, metric BLOB, artifacts TEXT, time REAL)',
+    'CREATE TABLE IF NOT EXISTS scores (evaluation INTEGER, run TEXT, object TEXT, objective TEXT, metric TEXT, value REAL)',
+    'CREATE INDEX IF NOT EXISTS evaluations_design ON evaluations (design)',
+    'CREATE INDEX IF NOT EXISTS scores_objective ON scores (objective, metric, object, value)',
+    'CREATE INDEX IF NOT EXISTS scores_run ON scores (run, objective, metric)',
+]
+
+
+class ResultsDB(object):
+    """
+    Every evaluated (design, object) pair of the validations, in one SQLite file at `path` shared across runs.
+    An evaluation keeps the control points, the per-orientation metric of the simulation and the paths of its
+    plots and gripper files, or once they are packed into an AssetStore their {archive, member}; its objective values (metric2objective) for every objective of BEST_METRICS are
+    indexed by objective, metric, object and run, for `top_k` and `compare_runs`.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def add(self, run, epoch, ctrlpts, object_idx, settings, metric, artifacts=None):
+        """Adds the evaluation of `ctrlpts` on `object_idx`, call `commit` after a batch of evaluations."""
+        ctrlpts = np.asarray(ctrlpts, dtype=np.float64)
+        design = array_hash(ctrlpts)
+        self.connection.execute('INSERT OR IGNORE INTO designs VALUES (?, ?, ?)', (design, ctrlpts.tobytes(), json.dumps(ctrlpts.shape)))
+        cursor = self.connection.execute(
+            'INSERT INTO evaluations (run, epoch, design, object, settings, metric, artifacts, time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (run, epoch, design, str(object_idx), json.dumps(settings, sort_keys=True), pickle.dumps(metric, protocol=pickle.HIGHEST_PROTOCOL), json.dumps(artifacts or {}), time.time()))
+        scores = []
+        for objective in BEST_METRICS.keys():
+            values = metric2objective(metric, objective)
+            scores += [(cursor.lastrowid, run, str(object_idx), objective, k, float(values[k])) for k, _ in BEST_METRICS[objective]]
+        self.connection.executemany('INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)', scores)
+        return cursor.lastrowid
+
+    def commit(self):
+        self.connection.commit()
+
+    def top_k(self, objective, metric=None, k=5, object_idx=None, run=None):
+        """
+        Returns the `k` best evaluations of `objective` by `metric` (its first metric by default), optionally of one
+        object and one run, best first, as dicts with the control points, value, settings and artifact paths.
+        """
+        metric, direction = self.metric_direction(objective, metric)
+        where, args = self.filters(objective, metric, object_idx, run)
+        rows = self.connection.execute(
+            'SELECT s.evaluation, s.run, e.epoch, s.object, s.value, e.settings, e.artifacts, d.ctrlpts, d.shape '
+            'FROM scores s JOIN evaluations e ON e.id = s.evaluation JOIN designs d ON d.design = e.design '
+            'WHERE %s ORDER BY s.value %s LIMIT ?' % (where, 'DESC' if direction == 'max' else 'ASC'), args + [k]).fetchall()
+        return [{
+            'evaluation': evaluation, 'run': run, 'epoch': epoch, 'object': object_name, 'value': value,
+            'settings': json.loads(settings), 'artifacts': json.loads(artifacts),
+            'ctrlpts': np.frombuffer(ctrlpts, dtype=np.float64).reshape(json.loads(shape)),
+        } for evaluation, run, epoch, object_name, value, settings, artifacts, ctrlpts, shape in rows]
+
+    def compare_runs(self, objective, metric=None, object_idx=None):
+        """Returns {run: {best, mean, count}} of `objective` by `metric` over the evaluations of every run."""
+        metric, direction = self.metric_direction(objective, metric)
+        where, args = self.filters(objective, metric, object_idx, None)
+        rows = self.connection.execute(
+            'SELECT run, %s(value), AVG(value), COUNT(*) FROM scores s WHERE %s GROUP BY run' % (direction.upper(), where), args).fetchall()
+        return {run: {'best': best, 'mean': mean, 'count': count} for run, best, mean, count in rows}
+
+    def archive_artifacts(self, dirs, archive, base_dir):
+        """
+        Re-points the artifacts below `dirs` to their member of the AssetStore archive `archive`, for `pack(archive,
+        dirs, base_dir)` which removes the files. Returns the number of evaluations updated.
+        """
+        dirs = [os.path.join(os.path.abspath(d), '') for d in dirs]
+        updated = []
+        for evaluation, artifacts in self.connection.execute('SELECT id, artifacts FROM evaluations').fetchall():
+            artifacts = json.loads(artifacts)
+            archived = {name: {'archive': archive, 'member': os.path.relpath(path, base_dir)}
+                        for name, path in artifacts.items() if isinstance(path, str) and any(os.path.abspath(path).startswith(d) for d in dirs)}
+            if len(archived) > 0:
+                updated.append((json.dumps(dict(artifacts, **archived)), evaluation))
+        self.connection.executemany('UPDATE evaluations SET artifacts = ? WHERE id = ?', updated)
+        self.connection.commit()
+        return len(updated)
+
+    def metric(self, evaluation):
+        """The per-orientation metric of an evaluation, as returned by the simulation."""
+        row = self.connection.execute('SELECT metric FROM evaluations WHERE id = ?', (evaluation,)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def metric_direction(self, objective, metric):
+        if objective not in BEST_METRICS:
+            raise ValueError('opt obj not supported')
+        directions = dict(BEST_METRICS[objective])
+        metric = metric if metric is not None else BEST_METRICS[objective][0][0]
+        if metric not in directions:
+            raise ValueError('metric %s is not ranked for %s' % (metric, objective))
+        return metric, directions[metric]
+
+    def filters(self, objective, metric, object_idx, run):
+        where, args = ['s.objective = ?', 's.metric = ?'], [objective, metric]
+        if object_idx is not None:
+            where.append('s.object = ?')
+            args.append(str(object_idx))
+        if run is not None:
+            where.append('s.run = ?')
+            args.append(run)
+        return ' AND '.join(where), args
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    # python sim/results_db.py <path> <objective> [metric] prints the best designs and the runs compared
+    db = ResultsDB(sys.argv[1])
+    objective = sys.argv[2]
+    metric = sys.argv[3] if len(sys.argv) > 3 else None
+    for row in db.top_k(objective, metric, k=10):
+        gripper = row['artifacts'].get('save_gripper_dirs', '')
+        # archived artifacts are read with AssetStore(<run>/asset_store).read or extract
+        gripper = '%s:%s' % (gripper['archive'], gripper['member']) if isinstance(gripper, dict) else gripper
+        print('%s\tepoch %s\tobject %s\t%.4f\t%s' % (row['run'], row['epoch'], row['object'], row['value'], gripper))
+    for run, stats in db.compare_runs(objective, metric).items():
+        print('%s\tbest %.4f\tmean %.4f\t%d evaluations' % (run, stats['best'], stats['mean'], stats['count']))
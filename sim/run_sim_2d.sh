@@ -1,9 +1,11 @@
 model_root='./models/2d'     # directory containing 2d models
 save_dir='./sim/results/2d'     # directory to save simulation results
 num_cpus=256     # number of cpus to use for parallel simulation
+high_fidelity_ratio=1.0     # fraction of pairs simulated at full fidelity, the rest use the cheap tier
+shard_size=0     # results per shard written by one aggregator, 0 writes one file per pair
 
 for object_idx in {0..1000}; do     # number of objects
     for ((i=0; i<1000; i+=512)) do      # number of manipulators
-        python sim/sim_2d.py $model_root $i $object_idx 512 1 $save_dir $num_cpus
+        python sim/sim_2d.py $model_root $i $object_idx 512 1 $save_dir $num_cpus $high_fidelity_ratio $shard_size
     done
 done
\ No newline at end of file
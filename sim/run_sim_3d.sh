@@ -1,9 +1,11 @@
 model_root='<directory for saving object and manipulator models>'
 save_dir='<directory for saving simulation results>'
 num_cpus=256
+high_fidelity_ratio=1.0     # fraction of pairs simulated at full fidelity, the rest use the cheap tier
+shard_size=0     # results per shard written by one aggregator, 0 writes one file per pair
 
 for object_idx in {0..300}; do
     for ((i=0; i<2000; i+=512)) do
-        python sim/sim_3d.py $model_root $i $object_idx 512 1 $save_dir $num_cpus
+        python sim/sim_3d.py $model_root $i $object_idx 512 1 $save_dir $num_cpus $high_fidelity_ratio $shard_size
     done
 done
\ No newline at end of file
@@ -0,0 +1,111 @@
+import os
+import time
+import statistics
+
+import ray
+
+TIMEOUT = 'timeout'
+FAILED = 'failed'
+
+
+def files_ready(paths):
+    """Whether all `paths` exist and are non-empty."""
+    return all(os.path.exists(path) and os.path.getsize(path) > 0 for path in paths)
+
+
+def wait_for_files(paths, timeout: float = 600.0, poll_interval: float = 0.1):
+    """Waits until all `paths` exist and are non-empty, raises TimeoutError after `timeout` seconds."""
+    start_time = time.time()
+    while not files_ready(paths):
+        if time.time() - start_time > timeout:
+            raise TimeoutError('Timeout waiting for %s' % ', '.join(paths))
+        time.sleep(poll_interval)
+
+
+def gather_with_deadlines(executor, launch, keys, max_in_flight: int, expected_runtime: float = None, deadline_factor: float = 4.0, speculation_factor: float = 1.5, max_duplicates: int = 1, min_samples: int = 2, min_deadline: float = 60.0, poll_interval: float = 1.0, group=None, speculate: bool = True):
+    """
+    Runs `launch(key)` (which submits a task to `executor` and returns its handle, see sim/executor.py)
+    for every key and collects the results.
+
+    At most `max_in_flight` tasks are submitted at once, so a task's age approximates its runtime.
+    Once the queue is drained, tasks running longer than `speculation_factor` times the median runtime
+    get up to `max_duplicates` speculative copies; the first copy to finish wins and the others are cancelled.
+    A key whose copies all exceed `deadline_factor` times the expected runtime (the median of finished
+    tasks, or `expected_runtime` before `min_samples` tasks finished) is cancelled and reported as timed out.
+    Deadlines are never shorter than `min_deadline` seconds, which covers starting and importing in the workers.
+    `expected_runtime` can also be a function of the key, for tasks of different sizes (e.g. fidelity tiers):
+    the medians are then taken over the runtimes relative to it and scaled back to the size of every key.
+    With `group` (a function of the key) every group of keys has its own median, e.g. for tasks of different
+    kinds, and keeps its prior until `min_samples` of its tasks finished.
+    Tasks with side effects (preparing assets, writing videos) must not run twice at once: without `speculate`
+    they get no copies and are only cancelled at their deadline.
+
+    Returns:
+        results: dict key -> task result, for keys that finished
+        status: dict key -> TIMEOUT or FAILED, for keys that did not
+    """
+    queue = list(keys)
+    pending = {}    # handle -> (key, start time)
+    copies = {}     # key -> list of handles still running
+    results, status = {}, {}
+    runtimes = {}   # group -> runtimes relative to the expected runtime of their key
+    group = group if group is not None else (lambda key: None)
+    # a constant prior scales all keys alike, the medians are plain runtime medians
+    prior = expected_runtime if callable(expected_runtime) else (lambda key: expected_runtime)
+    scale = prior if callable(expected_runtime) else (lambda key: 1.0)
+
+    def submit(key):
+        ref = launch(key)
+        pending[ref] = (key, time.time())
+        copies.setdefault(key, []).append(ref)
+
+    def cancel(key):
+        for ref in copies.pop(key, []):
+            pending.pop(ref, None)
+            executor.cancel(ref)
+
+    while len(queue) > 0 or len(pending) > 0:
+        while len(queue) > 0 and len(pending) < max_in_flight:
+            submit(queue.pop(0))
+        ready = executor.wait(list(pending.keys()), timeout=poll_interval)
+        for ref in ready:
+            if ref not in pending:
+                # a copy of a key that finished earlier in this round
+                continue
+            key, start_time = pending.pop(ref)
+            copies[key].remove(ref)
+            try:
+                result = executor.get(ref)
+            except Exception as e:
+                print(e)
+                if len(copies[key]) == 0:
+                    copies.pop(key)
+                    status[key] = FAILED
+                continue
+            runtimes.setdefault(group(key), []).append((time.time() - start_time) / scale(key))
+            results[key] = result
+            cancel(key)
+        medians = {name: statistics.median(values) for name, values in runtimes.items() if len(values) >= min_samples}
+        now = time.time()
+        for key in list(copies.keys()):
+            median = medians.get(group(key))
+            expected = median * scale(key) if median is not None else prior(key)
+            if expected is None:
+                continue
+            deadline = max(min_deadline, deadline_factor * expected)
+            speculation_time = deadline * speculation_factor / deadline_factor
+            oldest = min(pending[ref][1] for ref in copies[key])
+            if now - oldest > deadline:
+                print('task %s exceeded its deadline of %.1fs, giving up' % (str(key), deadline))
+                cancel(key)
+                status[key] = TIMEOUT
+            elif speculate and len(queue) == 0 and len(pending) < max_in_flight and len(copies[key]) <= max_duplicates and now - oldest > speculation_time:
+                print('task %s is straggling, launching a speculative copy' % str(key))
+                submit(key)
+    return results, status
+
+
+@ray.remote
+def call(fn, *args, **kwargs):
+    """Runs `fn(*args, **kwargs)` as a Ray task, resources are picked per call with `call.options(num_cpus=...)`."""
+    return fn(*args, **kwargs)
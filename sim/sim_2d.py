@@ -6,6 +6,7 @@ BASEPATH = os.path.dirname(__file__)
 sys.path.insert(0, BASEPATH)
 sys.path.insert(0, pjoin(BASEPATH, ".."))
 import glob
+import shutil
 from typing import Optional
 
 import mujoco
@@ -15,7 +16,6 @@ import subprocess
 from mujoco import viewer
 import ray
 import subprocess
-import time
 
 from assets.finger_sampler import (
     generate_gripper,
@@ -24,15 +24,56 @@ from assets.finger_sampler import (
     generate_scene_xml,
 )
 from assets.object_sampler import generate_object_xml
-from assets.icon_process import save_icon_mesh, extract_contours
+from assets.mesh_io import MESH_FORMAT, save_mesh, decomposition_input, finish_decomposition
+from sim.object_library import ensure_object_library, open_object_library
+from sim.scheduling import wait_for_files, gather_with_deadlines
+from sim.executor import make_executor
+from sim.autotune import autotune, measure
+from sim.aggregator import ResultAggregator, save_result
 from dynamics.utils import continuous_signed_delta
 
 OBJECT_DIR = (
     "/home/rzhao/GripperDesign/SoftFingerDemo2/SoftFingerDemo2/refined_mask.npy"
 )
 
+# Simulation settings of each fidelity tier. `high` is the original dataset
+# generation setup, `low` uses a coarse orientation grid (a subset of the `high`
+# grid), a shorter horizon and fewer collision hulls per finger.
+FIDELITY_TIERS = {
+    "high": {"num_rot": 360, "num_steps": 200, "max_hulls": 16},
+    "low": {"num_rot": 36, "num_steps": 100, "max_hulls": 4},
+}
+# prior on the runtime of one (gripper, object) task, used for deadlines until enough tasks finished
+EXPECTED_SETUP_TIME = 60.0
+EXPECTED_TIME_PER_ROT = 0.5
+# thresholds of the rotation, x and y classes, as in the dynamics dataset
+CLASS_THRESHOLDS = [0.03, 0.002, 0.003]
 
-def compute_collision(mesh_path, num_retries: int = 2):
+
+def select_fidelity(gripper_idx: int, object_idx: int, high_fidelity_ratio: float = 1.0):
+    """Deterministically assigns a fidelity tier to a (gripper, object) pair."""
+    rs = np.random.RandomState([gripper_idx, object_idx])
+    return "high" if rs.uniform() < high_fidelity_ratio else "low"
+
+
+def pair_runtime(fidelity: str = "high"):
+    """Prior runtime of one (gripper, object) task at `fidelity`, deadlines of the tiers scale with it."""
+    tier = FIDELITY_TIERS[fidelity]
+    return EXPECTED_SETUP_TIME + EXPECTED_TIME_PER_ROT * tier["num_rot"] * tier["num_steps"] / FIDELITY_TIERS["high"]["num_steps"]
+
+
+def fidelity_model_root(model_root: str, fidelity: str = "high"):
+    """Assets of lower tiers are decomposed with fewer hulls, so they are kept apart."""
+    return model_root if fidelity == "high" else os.path.join(model_root, fidelity)
+
+
+def result_filename(object_idx: int, gripper_idx: int, fidelity: str = "high"):
+    if fidelity == "high":
+        return "%d_%d.npz" % (object_idx, gripper_idx)
+    return "%d_%d_%s.npz" % (object_idx, gripper_idx, fidelity)
+
+
+def compute_collision(mesh_path, num_retries: int = 2, max_hulls: int = 16):
     """
     Computes the convex decomposition of a mesh using v-hacd.
     Convention: the input mesh is assumed to be in the same folder as the output mesh,
@@ -56,7 +97,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
     """
     COMMAND = [
         "./TestVHACD",
-        mesh_path,
+        decomposition_input(mesh_path),
         "-r",
         "100000",
         "-o",
@@ -64,7 +105,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
         "-g",
         "false",
         "-h",
-        "16",
+        str(max_hulls),
         "-v",
         "32",
     ]
@@ -78,9 +119,10 @@ def compute_collision(mesh_path, num_retries: int = 2):
             continue
     if output is None or output.returncode != 0:
         raise RuntimeError("V-HACD failed to run on %s" % mesh_path)
+    finish_decomposition(mesh_path)
 
 
-def prepare_gripper(gripper_idx: int, model_root: str):
+def prepare_gripper(gripper_idx: int, model_root: str, max_hulls: int = 16, mesh_format: str = MESH_FORMAT):
     rs = np.random.RandomState(gripper_idx)
     x = np.linspace(-0.12, 0.12, 7)
     yl = rs.uniform(-0.045, 0.015, size=(7))
@@ -89,9 +131,10 @@ def prepare_gripper(gripper_idx: int, model_root: str):
     # Debuging what are the two folders 0 and 1 in sim_model-gripper
 
     print("save gripper dir:", save_gripper_dir)
-    print("Gripper_idx: ".gripper_idx)
+    print("Gripper_idx: ", gripper_idx)
 
-    if not os.path.exists(save_gripper_dir):
+    if not os.path.exists(os.path.join(model_root, "gripper_%d.xml" % gripper_idx)):
+        shutil.rmtree(save_gripper_dir, ignore_errors=True)
         ctrlpts, allpts = save_gripper(
             x,
             yl,
@@ -100,16 +143,18 @@ def prepare_gripper(gripper_idx: int, model_root: str):
             height=0.02,
             num_points=200,
             save_gripper_dir=save_gripper_dir,
+            mesh_format=mesh_format,
         )
-        meshl_path = os.path.join(save_gripper_dir, "fingerl.obj")
-        compute_collision(meshl_path)
-        meshr_path = os.path.join(save_gripper_dir, "fingerr.obj")
-        compute_collision(meshr_path)
+        meshl_path = os.path.join(save_gripper_dir, "fingerl.%s" % mesh_format)
+        compute_collision(meshl_path, max_hulls=max_hulls)
+        meshr_path = os.path.join(save_gripper_dir, "fingerr.%s" % mesh_format)
+        compute_collision(meshr_path, max_hulls=max_hulls)
         generate_xml(
-            len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.obj"))),
-            len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.obj"))),
+            len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.%s" % mesh_format))),
+            len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.%s" % mesh_format))),
             gripper_idx,
             os.path.join(model_root, "gripper_%d.xml" % gripper_idx),
+            mesh_format=mesh_format,
         )
     else:
         ctrlpts, allpts = generate_gripper(
@@ -121,50 +166,51 @@ def prepare_gripper(gripper_idx: int, model_root: str):
     return ctrlpts, allpts
 
 
-def prepare_icon_object(object_idx, image, model_root):
+def prepare_icon_object(object_idx, library_dir, model_root, max_hulls: int = 16, mesh_format: str = MESH_FORMAT):
+    library = open_object_library(library_dir)
     save_object_dir = os.path.join(model_root, "objects", str(object_idx))
-    if not os.path.exists(save_object_dir):
-        contour, mesh_path = save_icon_mesh(image, 0.02, 100, save_object_dir)
-        compute_collision(mesh_path)
+    # the xml is written last, a dir without it is left by a prepare that failed or was cancelled
+    if not os.path.exists(os.path.join(model_root, "object_%d.xml" % object_idx)):
+        shutil.rmtree(save_object_dir, ignore_errors=True)
+        os.makedirs(save_object_dir, exist_ok=True)
+        mesh_path = os.path.join(save_object_dir, "object.%s" % mesh_format)
+        save_mesh(library.mesh(object_idx), mesh_path)
+        compute_collision(mesh_path, max_hulls=max_hulls)
         generate_object_xml(
-            len(glob.glob(os.path.join(save_object_dir, "object0*.obj"))),
+            len(glob.glob(os.path.join(save_object_dir, "object0*.%s" % mesh_format))),
             object_idx,
             os.path.join(model_root, "object_%d.xml" % object_idx),
+            mesh_format=mesh_format,
         )
-    else:
-        contour = extract_contours(image)
-    return contour
+    return library.contour(object_idx)
 
 
-@ray.remote(num_cpus=2)
 def main(
     model_root,
-    object_image,
+    library_dir,
     gripper_idx: int = 0,
     object_idx: int = 0,
     save_dir: str = "sim",
     gui: bool = False,
+    fidelity: str = "high",
+    aggregator=None,
 ):  # Modified the gripper_idx form 0 to 2
-    ctrlpts, allpts = prepare_gripper(gripper_idx, model_root)
-    object_vertices = prepare_icon_object(object_idx, object_image, model_root)
+    tier = FIDELITY_TIERS[fidelity]
+    model_root = fidelity_model_root(model_root, fidelity)
+    ctrlpts, allpts = prepare_gripper(gripper_idx, model_root, max_hulls=tier["max_hulls"])
+    object_vertices = prepare_icon_object(
+        object_idx, library_dir, model_root, max_hulls=tier["max_hulls"]
+    )
     scene_path = os.path.join(model_root, "scene_%d_%d.xml" % (object_idx, gripper_idx))
     generate_scene_xml(object_idx, gripper_idx, scene_path)
 
-    timeout = 1
-    start_time = time.time()
-    while not (
-        os.path.exists(os.path.join(model_root, "object_%d.xml" % object_idx))
-        and os.path.getsize(os.path.join(model_root, "object_%d.xml" % object_idx)) > 0
-        and os.path.exists(os.path.join(model_root, "gripper_%d.xml" % gripper_idx))
-        and os.path.getsize(os.path.join(model_root, "gripper_%d.xml" % gripper_idx))
-        > 0
-    ):
-        if time.time() - start_time > timeout:
-            raise RuntimeError(
-                "Timeout waiting for object_%d.xml and gripper_%d.xml"
-                % (object_idx, gripper_idx)
-            )
-        time.sleep(0.1)
+    wait_for_files(
+        [
+            os.path.join(model_root, "object_%d.xml" % object_idx),
+            os.path.join(model_root, "gripper_%d.xml" % gripper_idx),
+        ],
+        timeout=1,
+    )
     model = mujoco.MjModel.from_xml_path(scene_path)
     data = mujoco.MjData(model)
     reset_qpos = data.qpos.copy()
@@ -178,7 +224,7 @@ def main(
     obj_jnt = model.joint(obj_root_idx)
     assert obj_jnt.type == 0  # freejoint
 
-    z_rots = np.arange(0.0, 2 * np.pi, 2 * np.pi / 360)
+    z_rots = np.arange(0.0, 2 * np.pi, 2 * np.pi / tier["num_rot"])
     x_locs = -0.03 + 0.06 * np.arange(5) / 4
     y_locs = -0.03 + 0.06 * np.arange(5) / 4
     init_poses = np.zeros((len(z_rots), len(x_locs), len(y_locs), 7))
@@ -202,8 +248,8 @@ def main(
                 ]
                 data.ctrl[0] = 0.2
                 data.ctrl[1] = -0.2
-                # step for 1 second
-                for t in range(200):
+                # step for 1 second (high fidelity)
+                for t in range(tier["num_steps"]):
                     if handle is not None and t % 10 == 0:
                         handle.sync()
                         input(f"Press Enter to continue..., {t}")
@@ -237,11 +283,10 @@ def main(
             dtype=np.float32,
         ),
         "delta_pos": (final_poses[..., :3] - init_poses[..., :3]).reshape((-1, 3)),
+        "fidelity": fidelity,
+        "num_rot": tier["num_rot"],
     }
-    os.makedirs(save_dir, exist_ok=True)
-    np.savez_compressed(
-        os.path.join(save_dir, "%d_%d.npz" % (object_idx, gripper_idx)), save_data
-    )
+    save_result(save_dir, result_filename(object_idx, gripper_idx, fidelity), object_idx, save_data, aggregator)
 
 
 if __name__ == "__main__":
@@ -252,39 +297,79 @@ if __name__ == "__main__":
     num_object_parallel = int(sys.argv[5])
     save_dir = sys.argv[6]
     num_cpus = int(sys.argv[7])
-    data = np.load(OBJECT_DIR, allow_pickle=True).item()
-    images = data["image"]
-    print(f"Type of images: {type(images)}")
-    print(
-        f"Shape of images (if NumPy array): {images.shape if isinstance(images, np.ndarray) else 'Not an array'}"
-    )
-    print(f"Sample image: {images[0]}")
-
-    object_image = (
-        np.load(OBJECT_DIR, allow_pickle=True)
-        .item()["image"][object_idx]
-        .transpose((1, 2, 0))
-    )  # here I modified the transpose and deleted the objectidxto fit the image shape
+    # fraction of pairs simulated at full fidelity, the rest use the `low` tier
+    high_fidelity_ratio = float(sys.argv[8]) if len(sys.argv) > 8 else 1.0
+    # results per shard written by the aggregator, 0 saves one file per pair
+    shard_size = int(sys.argv[9]) if len(sys.argv) > 9 else 0
+    # serial, process, ray or auto, the aggregator needs ray
+    backend = sys.argv[10] if len(sys.argv) > 10 else "auto"
+    backend = "ray" if shard_size > 0 else backend
+    # built once from the OBJECT_DIR pickle, workers memory-map it and only get object ids
+    library_dir = ensure_object_library(OBJECT_DIR)
 
-    # object_image = np.load(OBJECT_DIR, allow_pickle=True).item()['image'][object_idx].transpose((1, 2, 0))
+    pairs = [
+        (g_idx, o_idx)
+        for g_idx in range(gripper_idx, gripper_idx + num_gripper_parallel)
+        for o_idx in range(object_idx, object_idx + num_object_parallel)
+    ]
+    fidelities = {pair: select_fidelity(pair[0], pair[1], high_fidelity_ratio) for pair in pairs}
+    # finger and object meshes are decomposed up front by multi-core tasks, `main` then only simulates
+    prepare_tasks = {}
+    for (g_idx, o_idx), fidelity in fidelities.items():
+        root = fidelity_model_root(model_root, fidelity)
+        max_hulls = FIDELITY_TIERS[fidelity]["max_hulls"]
+        prepare_tasks[("gripper", g_idx, fidelity)] = (prepare_gripper, g_idx, root, max_hulls)
+        prepare_tasks[("object", o_idx, fidelity)] = (prepare_icon_object, o_idx, library_dir, root, max_hulls)
+    warmup_key = next(iter(prepare_tasks.keys()))
+    plan = autotune(
+        "sim_2d",
+        lambda: dict(zip(["prepare_wall", "prepare_cpu"], measure(*prepare_tasks.pop(warmup_key))[1:])),
+        num_cpus,
+        len(pairs),
+        FIDELITY_TIERS["high"]["num_rot"],
+    )
 
-    ray.init(num_cpus=num_cpus, log_to_driver=False)
-    ray_tasks = [
-        main.remote(
+    executor = make_executor(num_cpus, len(pairs), FIDELITY_TIERS["high"]["num_rot"], backend)
+    aggregator = None
+    if shard_size > 0:
+        aggregator = ResultAggregator.remote(save_dir, CLASS_THRESHOLDS, expected_per_object=num_gripper_parallel, shard_size=shard_size)
+    # prepares write the assets in place, a speculative copy would find them half written
+    _, prepare_status = gather_with_deadlines(
+        executor,
+        lambda key: executor.submit(*prepare_tasks[key], num_cpus=plan["prepare_cpus"]),
+        list(prepare_tasks.keys()),
+        max_in_flight=max(1, num_cpus // plan["prepare_cpus"]),
+        expected_runtime=EXPECTED_SETUP_TIME,
+        speculate=False,
+    )
+    # pairs missing an asset are not simulated, every copy of `main` would prepare it again
+    status = {}
+    for (g_idx, o_idx), fidelity in fidelities.items():
+        for asset in [("gripper", g_idx, fidelity), ("object", o_idx, fidelity)]:
+            if asset in prepare_status:
+                status[(g_idx, o_idx)] = prepare_status[asset]
+    _, pair_status = gather_with_deadlines(
+        executor,
+        lambda pair: executor.submit(
+            main,
+            num_cpus=plan["step_cpus"],
             model_root=model_root,
-            object_image=object_image,
-            gripper_idx=g_idx,
-            object_idx=o_idx,
+            library_dir=library_dir,
+            gripper_idx=pair[0],
+            object_idx=pair[1],
             save_dir=save_dir,
             gui=False,
-        )
-        for g_idx in range(gripper_idx, gripper_idx + num_gripper_parallel)
-        for o_idx in range(object_idx, object_idx + num_object_parallel)
-    ]
-    while len(ray_tasks) > 0:
-        ready, ray_tasks = ray.wait(ray_tasks, num_returns=1)
-        try:
-            ray.get(ready[0], timeout=1)
-        except Exception as e:
-            print(e)
-            continue
+            fidelity=fidelities[pair],
+            aggregator=aggregator,
+        ),
+        [pair for pair in pairs if pair not in status],
+        max_in_flight=max(1, num_cpus // plan["step_cpus"]),
+        # low tier pairs finish far sooner, the deadline of every pair scales with its tier
+        expected_runtime=lambda pair: pair_runtime(fidelities[pair]),
+    )
+    status.update(pair_status)
+    for (g_idx, o_idx), state in sorted(status.items()):
+        print("gripper %d object %d: %s" % (g_idx, o_idx, state))
+    if aggregator is not None:
+        print(ray.get(aggregator.close.remote()))
+    executor.shutdown()
@@ -19,10 +19,35 @@ import subprocess
 from assets.finger_3d import generate_3d_gripper, save_3d_gripper, generate_gripper_3d_xml, generate_scene_3d_xml
 from dynamics.utils import continuous_signed_delta
 from assets.scan_object_process import read_object_names, generate_object_3d_xml
+from assets.mesh_io import MESH_FORMAT, decomposition_input, finish_decomposition
+from sim.sim_2d import select_fidelity, fidelity_model_root, result_filename
+from sim.scheduling import gather_with_deadlines
+from sim.executor import make_executor
+from sim.autotune import autotune, measure
+from sim.aggregator import ResultAggregator, save_result
 
 OBJECT_DIR = '<directory to 3D object model>/mujoco_scanned_objects/models'
 
-def compute_collision(mesh_path, num_retries: int = 2):
+# Simulation settings of each fidelity tier, see sim/sim_2d.py. Scanned objects
+# ship with their own collision hulls, so `max_hulls` only applies to the fingers.
+FIDELITY_TIERS = {
+    'high': {'num_rot': 360, 'num_steps': 800, 'max_hulls': 32},
+    'low': {'num_rot': 36, 'num_steps': 400, 'max_hulls': 8},
+}
+# prior on the runtime of one (gripper, object) task, used for deadlines until enough tasks finished
+EXPECTED_SETUP_TIME = 120.0
+EXPECTED_TIME_PER_ROT = 2.0
+# thresholds of the rotation, x and y classes, as in the dynamics dataset
+CLASS_THRESHOLDS = [0.02, 0.001, 0.001]
+
+
+def pair_runtime(fidelity: str = 'high'):
+    """Prior runtime of one (gripper, object) task at `fidelity`, deadlines of the tiers scale with it."""
+    tier = FIDELITY_TIERS[fidelity]
+    return EXPECTED_SETUP_TIME + EXPECTED_TIME_PER_ROT * tier['num_rot'] * tier['num_steps'] / FIDELITY_TIERS['high']['num_steps']
+
+
+def compute_collision(mesh_path, num_retries: int = 2, max_hulls: int = 32):
     """
     Computes the convex decomposition of a mesh using v-hacd.
     Convention: the input mesh is assumed to be in the same folder as the output mesh,
@@ -46,7 +71,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
     """
     COMMAND = [
         "TestVHACD",
-        mesh_path,
+        decomposition_input(mesh_path),
         "-r",
         "100000",
         "-o",
@@ -54,7 +79,7 @@ def compute_collision(mesh_path, num_retries: int = 2):
         "-g",
         "false",
         "-h",
-        "32",
+        str(max_hulls),
         "-v",
         "32",
     ]
@@ -68,25 +93,28 @@ def compute_collision(mesh_path, num_retries: int = 2):
             continue
     if output is None or output.returncode != 0:
         raise RuntimeError("V-HACD failed to run on %s" % mesh_path)
+    finish_decomposition(mesh_path)
 
-def prepare_gripper(gripper_idx: int, model_root: str):
+def prepare_gripper(gripper_idx: int, model_root: str, max_hulls: int = 32, mesh_format: str = MESH_FORMAT):
     rs = np.random.RandomState(gripper_idx)
     yl = rs.uniform(-0.1, 0, size=(21))
     yr = rs.uniform(-0.1, 0, size=(21))
     save_gripper_dir = os.path.join(model_root, 'grippers', str(gripper_idx))
-    if not os.path.exists(save_gripper_dir):
+    if not os.path.exists(os.path.join(model_root, 'gripper_%d.xml' % gripper_idx)):
+        shutil.rmtree(save_gripper_dir, ignore_errors=True)
         ctrlpts, allpts = save_3d_gripper(
             yl,
             yr,
             width=0.1,
             sample_size=25,
             save_gripper_dir=save_gripper_dir,
+            mesh_format=mesh_format,
         )
-        meshl_path = os.path.join(save_gripper_dir, "fingerl.obj")
-        compute_collision(meshl_path)
-        meshr_path = os.path.join(save_gripper_dir, "fingerr.obj")
-        compute_collision(meshr_path)
-        generate_gripper_3d_xml(len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.obj"))), len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.obj"))), gripper_idx, os.path.join(model_root, 'gripper_%d.xml' % gripper_idx))
+        meshl_path = os.path.join(save_gripper_dir, "fingerl.%s" % mesh_format)
+        compute_collision(meshl_path, max_hulls=max_hulls)
+        meshr_path = os.path.join(save_gripper_dir, "fingerr.%s" % mesh_format)
+        compute_collision(meshr_path, max_hulls=max_hulls)
+        generate_gripper_3d_xml(len(glob.glob(os.path.join(save_gripper_dir, "fingerl0*.%s" % mesh_format))), len(glob.glob(os.path.join(save_gripper_dir, "fingerr0*.%s" % mesh_format))), gripper_idx, os.path.join(model_root, 'gripper_%d.xml' % gripper_idx), mesh_format=mesh_format)
 
     else:
         ctrlpts, allpts = generate_3d_gripper(
@@ -100,14 +128,19 @@ def prepare_object(object_name: str, object_idx: int, model_root: str):
     object_model_dir = os.path.join(OBJECT_DIR, object_name)
     object_model_new = os.path.join(model_root, 'object_%d.xml' % object_idx)
     if not os.path.exists(object_model_new):
-        shutil.copytree(object_model_dir, os.path.join(model_root, 'objects', str(object_idx)), dirs_exist_ok = True)
+        # the scanned meshes are only read, link them instead of copying them into every model_root
+        save_object_dir = os.path.join(model_root, 'objects', str(object_idx))
+        os.makedirs(os.path.dirname(save_object_dir), exist_ok=True)
+        if not os.path.lexists(save_object_dir):
+            os.symlink(os.path.abspath(object_model_dir), save_object_dir)
         generate_object_3d_xml(len(glob.glob(os.path.join(model_root, 'objects', str(object_idx), "model_collision_*.obj"))), object_idx, object_model_new)
     return os.path.join(model_root, 'objects', str(object_idx))
 
 # @profile
-@ray.remote(num_cpus=2)
-def main(model_root, gripper_idx: int=0, object_name: str='BUNNY_RACER', object_idx: int=0, save_dir: str="sim", gui: bool = False):
-    ctrlpts, allpts = prepare_gripper(gripper_idx, model_root)
+def main(model_root, gripper_idx: int=0, object_name: str='BUNNY_RACER', object_idx: int=0, save_dir: str="sim", gui: bool = False, fidelity: str = 'high', aggregator=None):
+    tier = FIDELITY_TIERS[fidelity]
+    model_root = fidelity_model_root(model_root, fidelity)
+    ctrlpts, allpts = prepare_gripper(gripper_idx, model_root, max_hulls=tier['max_hulls'])
     prepare_object(object_name, object_idx, model_root)
     scene_path = os.path.join(model_root, 'scene_%d_%d.xml' % (object_idx, gripper_idx))
     generate_scene_3d_xml(object_idx, gripper_idx, scene_path)
@@ -124,7 +157,7 @@ def main(model_root, gripper_idx: int=0, object_name: str='BUNNY_RACER', object_
     obj_jnt = model.joint(obj_root_idx)
     assert obj_jnt.type == 0  # freejoint
 
-    z_rots = np.arange(0.0, 2 * np.pi, 2 * np.pi / 360)
+    z_rots = np.arange(0.0, 2 * np.pi, 2 * np.pi / tier['num_rot'])
     x_locs = -0.03+0.06*np.arange(5)/4
     y_locs = -0.03+0.06*np.arange(5)/4
     init_poses = np.zeros((len(z_rots), len(x_locs), len(y_locs), 7))
@@ -148,7 +181,7 @@ def main(model_root, gripper_idx: int=0, object_name: str='BUNNY_RACER', object_
                 ]
                 data.ctrl[0] = 0.5
                 data.ctrl[1] = -0.5
-                for t in range(800):
+                for t in range(tier['num_steps']):
                     if handle is not None and t % 10 == 0:
                         handle.sync()
                         input(f"Press Enter to continue..., {t}")
@@ -167,9 +200,10 @@ def main(model_root, gripper_idx: int=0, object_name: str='BUNNY_RACER', object_
         "obj_theta": np.asarray([quaternions.quat2axangle(quat)[-1] for quat in init_poses[..., 3:].reshape((-1, 4))], dtype=np.float32),
         "delta_theta": np.asarray([continuous_signed_delta(quaternions.quat2axangle(last_quat)[-1], quaternions.quat2axangle(quat)[-1]) for last_quat, quat in zip(init_poses[..., 3:].reshape((-1, 4)), final_poses[..., 3:].reshape((-1, 4)))], dtype=np.float32),
         "delta_pos": (final_poses[..., :3] - init_poses[..., :3]).reshape((-1, 3)),
+        "fidelity": fidelity,
+        "num_rot": tier['num_rot'],
     }
-    os.makedirs(save_dir, exist_ok=True)
-    np.savez_compressed(os.path.join(save_dir, "%d_%d.npz" % (object_idx, gripper_idx)), save_data)
+    save_result(save_dir, result_filename(object_idx, gripper_idx, fidelity), object_idx, save_data, aggregator)
 
 if __name__ == "__main__":
     model_root = sys.argv[1]
@@ -179,14 +213,30 @@ if __name__ == "__main__":
     num_object_parallel = int(sys.argv[5])
     save_dir = sys.argv[6]
     num_cpus = int(sys.argv[7])
+    high_fidelity_ratio = float(sys.argv[8]) if len(sys.argv) > 8 else 1.0
+    shard_size = int(sys.argv[9]) if len(sys.argv) > 9 else 0
+    backend = 'ray' if shard_size > 0 else (sys.argv[10] if len(sys.argv) > 10 else 'auto')
     object_names = read_object_names()
 
-    ray.init(num_cpus=num_cpus, log_to_driver=False)
-    ray_tasks = [main.remote(model_root=model_root, gripper_idx=g_idx, object_name=object_names[object_idx], object_idx=o_idx, save_dir=save_dir, gui=False) for g_idx in range(gripper_idx, gripper_idx+num_gripper_parallel) for o_idx in range(object_idx, object_idx+num_object_parallel)]
-    while len(ray_tasks) > 0:
-        ready, ray_tasks = ray.wait(ray_tasks, num_returns=1)
-        try:
-            ray.get(ready[0], timeout=1)
-        except Exception as e:
-            print(e)
-            continue
\ No newline at end of file
+    pairs = [(g_idx, o_idx) for g_idx in range(gripper_idx, gripper_idx+num_gripper_parallel) for o_idx in range(object_idx, object_idx+num_object_parallel)]
+    # finger meshes are decomposed up front by multi-core tasks, `main` then only simulates
+    fidelities = {pair: select_fidelity(pair[0], pair[1], high_fidelity_ratio) for pair in pairs}
+    prepare_tasks = {}
+    for (g_idx, o_idx), fidelity in fidelities.items():
+        prepare_tasks[(g_idx, fidelity)] = (prepare_gripper, g_idx, fidelity_model_root(model_root, fidelity), FIDELITY_TIERS[fidelity]['max_hulls'])
+    warmup_key = next(iter(prepare_tasks.keys()))
+    plan = autotune('sim_3d', lambda: dict(zip(['prepare_wall', 'prepare_cpu'], measure(*prepare_tasks.pop(warmup_key))[1:])), num_cpus, len(pairs), FIDELITY_TIERS['high']['num_rot'])
+
+    executor = make_executor(num_cpus, len(pairs), FIDELITY_TIERS['high']['num_rot'], backend)
+    aggregator = ResultAggregator.remote(save_dir, CLASS_THRESHOLDS, expected_per_object=num_gripper_parallel, shard_size=shard_size) if shard_size > 0 else None
+    # prepares write the assets in place, a speculative copy would find them half written
+    _, prepare_status = gather_with_deadlines(executor, lambda key: executor.submit(*prepare_tasks[key], num_cpus=plan['prepare_cpus']), list(prepare_tasks.keys()), max_in_flight=max(1, num_cpus // plan['prepare_cpus']), expected_runtime=EXPECTED_SETUP_TIME, speculate=False)
+    # pairs missing their gripper are not simulated, every copy of `main` would prepare it again
+    status = {pair: prepare_status[(pair[0], fidelity)] for pair, fidelity in fidelities.items() if (pair[0], fidelity) in prepare_status}
+    _, pair_status = gather_with_deadlines(executor, lambda pair: executor.submit(main, num_cpus=plan['step_cpus'], model_root=model_root, gripper_idx=pair[0], object_name=object_names[object_idx], object_idx=pair[1], save_dir=save_dir, gui=False, fidelity=fidelities[pair], aggregator=aggregator), [pair for pair in pairs if pair not in status], max_in_flight=max(1, num_cpus // plan['step_cpus']), expected_runtime=lambda pair: pair_runtime(fidelities[pair]))
+    status.update(pair_status)
+    for (g_idx, o_idx), state in sorted(status.items()):
+        print('gripper %d object %d: %s' % (g_idx, o_idx, state))
+    if aggregator is not None:
+        print(ray.get(aggregator.close.remote()))
+    executor.shutdown()
@@ -0,0 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from sim.autotune import chunk_ranges
+from sim.pool import load_model
+
+
+def simulate_threads(simulate, scene_path, z_rots, rot_ids, num_videos, num_threads, render=True, render_last=False, **kwargs):
+    """
+    Runs `simulate(scene_path, z_rots, rot_ids, num_videos, ...)` (of sim_test_mj or sim_test_mj_3d) with its
+    orientations split over `num_threads` threads. Every thread steps its own MjData of the one MjModel
+    compiled for the scene, mujoco releases the GIL while stepping. The recorded orientations run in the
+    calling thread, which owns the renderer; the other threads do not render.
+    Returns what `simulate` returns, the poses in the order of `rot_ids`.
+    """
+    # compiled once here, the threads find it in the model cache
+    load_model(scene_path)
+    recorded = [k for k in rot_ids if (render or render_last) and k % 36 == 0 and k // 36 < num_videos]
+    recorded_set = set(recorded)
+    others = [k for k in rot_ids if k not in recorded_set]
+    chunks = [others[start:stop] for start, stop in chunk_ranges(len(others), num_threads)]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        stepping = {'steady_cycles': kwargs['steady_cycles']} if 'steady_cycles' in kwargs else {}
+        futures = [pool.submit(simulate, scene_path, z_rots, chunk, num_videos, render=False, render_last=False, **stepping) for chunk in chunks]
+        results = [simulate(scene_path, z_rots, recorded, num_videos, render=render, render_last=render_last, **kwargs)] if len(recorded) > 0 else []
+        results += [future.result() for future in futures]
+    order = recorded + [k for chunk in chunks for k in chunk]
+    position = {k: n for n, k in enumerate(order)}
+    perm = [position[k] for k in rot_ids]
+    poses = [np.concatenate([result[j] for result in results], axis=0)[perm] for j in range(3)]
+    frames = {}
+    for result in results:
+        frames.update(result[3])
+    return poses[0], poses[1], poses[2], frames
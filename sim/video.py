@@ -0,0 +1,43 @@
+import os
+from collections import deque
+
+import imageio
+
+
+class VideoStream(object):
+    """
+    Encodes frames into the mp4 at `path` as they are rendered, `transform(frame)` turns a rendered frame into
+    the uint8 image written. Only the encoder state is kept in memory, the file is opened on the first frame.
+    """
+    def __init__(self, path, fps=20, transform=None):
+        self.path = path
+        self.fps = fps
+        self.transform = transform
+        self.writer = None
+
+    def append(self, frame):
+        if self.writer is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.writer = imageio.get_writer(self.path, fps=self.fps)
+        self.writer.append_data(self.transform(frame) if self.transform is not None else frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        return self.path
+
+
+class FrameBuffer(object):
+    """Keeps the first frame and the last `maxlen - 1` frames appended, for still images of a rollout."""
+    def __init__(self, maxlen=1):
+        self.first = None
+        self.frames = deque(maxlen=maxlen)
+
+    def append(self, frame):
+        if self.first is None:
+            self.first = frame.copy()
+        self.frames.append(frame.copy())
+
+    def close(self):
+        return [self.first] + list(self.frames)